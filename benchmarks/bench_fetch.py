@@ -0,0 +1,79 @@
+'''
+Compares messages/sec of per-message and batched UID FETCH downloads,
+of headers only syncs and of the asyncio engine (AsyncEmailGetter)
+against a local fake IMAP server.
+
+Usage: python benchmarks/bench_fetch.py [messages] [latency_ms]
+'''
+from imaplib import IMAP4
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python_email_client'))
+
+from async_conn import AsyncEmailGetter, AsyncIMAPConnection
+from email_conn import ConnectionPool, EmailGetter, RESERVED_CONNECTIONS
+from fake_imap import FakeIMAPServer, FakeMailbox, make_messages
+
+def connect(port):
+    conn = IMAP4('127.0.0.1', port)
+    conn.login('user@example.com', 'password')
+    return conn
+
+def run(port, amount, threads, batch_size, headers_only=False):
+    # Syncs leave RESERVED_CONNECTIONS pooled connections free
+    pool = ConnectionPool(lambda: connect(port),
+                          threads + RESERVED_CONNECTIONS)
+    getter = EmailGetter(connect(port), threads, lambda msg: None,
+                         batch_size=batch_size, pool=pool,
+                         headers_only=headers_only)
+    start = time.perf_counter()
+    getter.get_emails_online(threads, None)
+    elapsed = time.perf_counter() - start
+    pool.close()
+    assert len(getter.emails) == amount, len(getter.emails)
+    return amount / elapsed
+
+def run_async(port, amount, connections, batch_size):
+    async def connect():
+        conn = await AsyncIMAPConnection.open('127.0.0.1', port,
+                                              use_ssl=False)
+        await conn.login('user@example.com', 'password')
+        return conn
+
+    getter = AsyncEmailGetter(lambda msg: None, batch_size=batch_size,
+                              connect_func=connect)
+    start = time.perf_counter()
+    getter.get_emails_online(connections, None)
+    elapsed = time.perf_counter() - start
+    assert len(getter.emails) == amount, len(getter.emails)
+    return amount / elapsed
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 2.0 / 1000
+    server = FakeIMAPServer(FakeMailbox(make_messages(amount,
+                                                      attachment_size=20000)),
+                            latency).start()
+    try:
+        print(f'{amount} messages, {latency * 1000:.1f}ms per command')
+        for threads, batch_size, headers_only in ((4, 1, False),
+                                                  (4, 100, False),
+                                                  (4, 500, False),
+                                                  (1, 500, False),
+                                                  (4, 500, True)):
+            rate = run(server.port, amount, threads, batch_size, headers_only)
+            print(f'threads={threads:<3} batch_size={batch_size:<5}'
+                  f' headers_only={headers_only!s:<5}'
+                  f' {rate:10.1f} messages/sec')
+        for connections, batch_size in ((1, 100), (2, 100)):
+            rate = run_async(server.port, amount, connections, batch_size)
+            print(f'asyncio connections={connections:<3}'
+                  f' batch_size={batch_size:<5} {rate:10.1f} messages/sec')
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
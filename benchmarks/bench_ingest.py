@@ -0,0 +1,44 @@
+'''
+Reports inserts/sec of EmailDatabase.save_emails for synthetic messages,
+saved one email per transaction and in batches.
+
+Usage: python benchmarks/bench_ingest.py [messages]
+'''
+from email import message_from_bytes
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python_email_client'))
+
+from database import EmailDatabase
+from fake_imap import make_messages
+
+def run(emails, batch_size):
+    with tempfile.TemporaryDirectory() as home:
+        # utils.get_store_path() is inside the home folder
+        os.environ['HOME'] = os.environ['USERPROFILE'] = home
+        database = EmailDatabase(lambda msg: None, None)
+        start = time.perf_counter()
+        database.save_emails(emails, batch_size)
+        elapsed = time.perf_counter() - start
+        saved = database.manager.execute(
+            'SELECT COUNT(*) FROM emails').fetchone()[0]
+        database.manager.close()
+        database.store.close()
+        assert saved == len(emails), saved
+        return len(emails) / elapsed
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    emails = [(message_from_bytes(raw), str(num).encode())
+              for num, raw in enumerate(make_messages(amount), 1)]
+    print(f'{amount} messages')
+    for batch_size in (1, 100, 500):
+        print(f'batch size {batch_size:4d}: '
+              f'{run(emails, batch_size):10.1f} inserts/sec')
+
+if __name__ == '__main__':
+    main()
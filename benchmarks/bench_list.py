@@ -0,0 +1,88 @@
+'''
+Times pages of EmailDatabase.list_emails for all emails and for tags of
+different sizes, and checks that the pages of a tag are read through
+email_tags instead of scanning every email.
+
+Usage: python benchmarks/bench_list.py [emails]
+'''
+from datetime import datetime, timedelta
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python_email_client'))
+
+from database import EmailDatabase
+
+def add_emails(database, amount):
+    '''Inserts amount header rows straight into manager.db, listing does
+    not read the message store.'''
+    start = datetime(2020, 1, 1)
+    database.manager.executemany(
+        'INSERT INTO emails (id, subject, created, to_address, from_address,'
+        ' read, message_key) VALUES (?, ?, ?, ?, ?, 0, ?)',
+        [(num, f'Subject {num}', str(start + timedelta(minutes=num * 7 % amount)),
+          'to@example.com', 'from@example.com', f'key{num}')
+         for num in range(1, amount + 1)]
+    )
+    database.manager.commit()
+
+def query_plan(database, func):
+    '''Returns the EXPLAIN QUERY PLAN details of the statements func runs.'''
+    statements = []
+    database.manager.set_trace_callback(statements.append)
+    func()
+    database.manager.set_trace_callback(None)
+    return [row[3] for statement in statements
+            if statement.lstrip().upper().startswith('SELECT')
+            for row in database.manager.execute(
+                'EXPLAIN QUERY PLAN ' + statement)]
+
+def time_pages(func, pages=5):
+    '''Returns the ms of the first page and the mean ms of the next ones.'''
+    times = []
+    after = None
+    for _ in range(pages):
+        start = time.perf_counter()
+        rows = func(after=after)
+        times.append(time.perf_counter() - start)
+        if len(rows) == 0:
+            break
+        after = (rows[-1]['Date'], rows[-1]['id'])
+    rest = times[1:] or times
+    return times[0] * 1000, sum(rest) / len(rest) * 1000
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with tempfile.TemporaryDirectory() as home:
+        # utils.get_store_path() is inside the home folder
+        os.environ['HOME'] = os.environ['USERPROFILE'] = home
+        database = EmailDatabase(lambda msg: None, None)
+        add_emails(database, amount)
+        ids = list(range(1, amount + 1))
+        sizes = {'rare': ids[::amount // 5][:5], 'tenth': ids[::10],
+                 'half': ids[::2]}
+        for name, tagged in sizes.items():
+            database.tag_emails([{'id': email_id} for email_id in tagged],
+                                name)
+
+        print(f'{amount} emails, pages of 100')
+        for tags in (None, 'rare', 'tenth', 'half', 'rare,tenth'):
+            plan = query_plan(database,
+                              lambda: database.list_emails(tags, limit=100))
+            if tags is not None:
+                assert not any(detail.startswith('SCAN emails')
+                               for detail in plan), plan
+                assert any('email_tags_created' in detail
+                           for detail in plan), plan
+            first, rest = time_pages(
+                lambda after: database.list_emails(tags, after, 100))
+            print(f'{str(tags):>11}: first page {first:7.2f} ms,'
+                  f' next pages {rest:7.2f} ms')
+        database.manager.close()
+        database.store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Compares the time of utils.parse_payload and of the character by
+character decoder of older versions, for large text bodies and for
+bodies full of emoji.
+
+Usage: python benchmarks/bench_payload.py [kilobytes]
+'''
+from email.message import EmailMessage
+import os
+import quopri
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python_email_client'))
+
+import utils
+
+def old_parse_payload(payload):
+    '''utils.parse_payload of older versions, given the raw payload.'''
+    decoded = payload.encode(encoding='ascii', errors='ignore').decode('utf-8')
+    decoded = quopri.decodestring(decoded).decode(encoding='utf-8',
+                                                  errors='ignore')
+    count = 0
+    terms = []
+    while count < len(decoded):
+        if ord(decoded[count]) > 65535:
+            terms.append(decoded[count])
+        count += 1
+
+    for t in terms:
+        decoded = decoded.replace(t, ''.join(('{U', str(ord(t)), '}')))
+
+    return decoded
+
+def make_part(text, cte):
+    message = EmailMessage()
+    message.set_content(text, charset='utf-8', cte=cte)
+    return message
+
+def best_time(func, arg, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    kilobytes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    line = 'The quick brown fox jumps over the lazy dog. Café naïve.\n'
+    plain = line * (kilobytes * 1024 // len(line))
+    # Every tenth character is one of 1000 different emoji and symbols
+    emoji = ''.join(chr(0x1F300 + index % 1000) + 'abcdefghi'
+                    for index in range(kilobytes * 1024 // 13))
+    print(f'{kilobytes} KB bodies, quoted-printable')
+    for name, text in (('plain text', plain), ('emoji', emoji)):
+        part = make_part(text, 'quoted-printable')
+        # The old decoder only handled quoted-printable bodies
+        assert old_parse_payload(part.get_payload()) == utils.parse_payload(
+            part).replace('\r\n', '\n')
+        old_time = best_time(old_parse_payload, part.get_payload())
+        new_time = best_time(utils.parse_payload, part)
+        print(f'{name:>10}: old {old_time * 1000:9.2f} ms,'
+              f' new {new_time * 1000:9.2f} ms,'
+              f' {old_time / new_time:7.1f}x')
+
+if __name__ == '__main__':
+    main()
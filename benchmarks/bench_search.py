@@ -0,0 +1,84 @@
+'''
+Compares the time of a search through the full text index
+(EmailDatabase.search_emails), through a SearchPool whose workers read
+emails by id, and through loading every email and sending it to a new
+process pool running parse_mail.process_message.
+
+Usage: python benchmarks/bench_search.py [messages]
+'''
+from email import message_from_bytes
+from functools import partial
+from multiprocessing import Pool
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python_email_client'))
+
+from database import EmailDatabase
+from fake_imap import make_messages
+import parse_mail
+from search_pool import SearchPool
+
+SEARCHES = (
+    (['1234'], True, False, False, False),
+    (['sender7', 'example'], False, False, True, True),
+    (['consectetur'], False, False, False, False),
+    (['consectetru', 'lorme'], False, False, False, False),
+)
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    with tempfile.TemporaryDirectory() as home:
+        # utils.get_store_path() is inside the home folder
+        os.environ['HOME'] = os.environ['USERPROFILE'] = home
+        database = EmailDatabase(lambda msg: None, None)
+        database.save_emails([(message_from_bytes(raw), str(num).encode())
+                              for num, raw in enumerate(
+                                  make_messages(amount), 1)])
+
+        email_ids = database.get_email_ids()
+        database.cache_tokens(email_ids)
+        search_pool = SearchPool(database.database_path, database.store_path)
+        # Starts the workers
+        search_pool.search(email_ids[:1], False, False, False,
+                           parse_mail.SearchQuery(['x']))
+
+        print(f'{amount} messages')
+        for terms, subject, to_ln, from_ln, all_match in SEARCHES:
+            start = time.perf_counter()
+            found = database.search_emails(terms, subject, to_ln, from_ln,
+                                           all_match)
+            fts_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            pooled = search_pool.search(
+                email_ids, subject, to_ln, from_ln,
+                parse_mail.SearchQuery(terms, all_match))
+            pool_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            messages = [email[1] for email in database.load_emails()]
+            search = partial(parse_mail.process_message, subject=subject,
+                             to_ln=to_ln, from_ln=from_ln,
+                             search_list=terms, all_match=all_match)
+            with Pool() as pool:
+                scanned = [result for result in pool.imap_unordered(
+                    search, messages, chunksize=64) if result]
+            scan_time = time.perf_counter() - start
+
+            print(f'{",".join(terms):20s}'
+                  f' full text index: {len(found):6d} in'
+                  f' {fts_time * 1000:9.2f} ms'
+                  f'   SearchPool: {len(pooled):6d} in'
+                  f' {pool_time * 1000:9.2f} ms'
+                  f'   messages to Pool(): {len(scanned):6d} in'
+                  f' {scan_time * 1000:9.2f} ms')
+        search_pool.close()
+        database.manager.close()
+        database.store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''
+Compares disk use and load time of emails pickled one file per email
+(the layout of older versions) and of the raw RFC822 message store,
+for loading the Subject header and for loading the text parts.
+
+Cold loads open the store again (no segment is mapped yet) after
+dropping the files from the OS page cache where the OS allows it, warm
+loads read the same emails again.
+
+Usage: python benchmarks/bench_store.py [messages]
+'''
+from email import message_from_bytes
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python_email_client'))
+
+import config
+from fake_imap import make_messages
+from message_store import MessageStore, text_parts
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+def drop_cache(paths):
+    '''Asks the OS to drop the files at paths from its page cache.'''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    # Pages that are not written back yet are not dropped
+    os.sync()
+    for path in paths:
+        with open(path, 'rb') as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def files(folder):
+    return [os.path.join(folder, name) for name in os.listdir(folder)]
+
+def time_loads(func, amount):
+    start = time.perf_counter()
+    for num in range(1, amount + 1):
+        func(num)
+    return amount / (time.perf_counter() - start)
+
+def pickle_subject(pickle_path, num):
+    with open(os.path.join(pickle_path, f'{num}.pkl'), 'rb') as f:
+        pickle.load(f)[0].get('Subject')
+
+def pickle_parts(pickle_path, num):
+    with open(os.path.join(pickle_path, f'{num}.pkl'), 'rb') as f:
+        for part in text_parts(pickle.load(f)[0]):
+            part.get_payload()
+
+def store_subject(store, num):
+    store.get(num).get('Subject')
+
+def store_parts(store, num):
+    for part in text_parts(store.get(num)):
+        part.get_payload()
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    raws = make_messages(amount, attachment_size=8000)
+    with tempfile.TemporaryDirectory() as folder:
+        pickle_path = os.path.join(folder, 'saved')
+        os.mkdir(pickle_path)
+        for num, raw in enumerate(raws, 1):
+            email = (message_from_bytes(raw), str(num).encode())
+            with open(os.path.join(pickle_path, f'{num}.pkl'), 'wb') as out:
+                pickle.dump(email, out, pickle.HIGHEST_PROTOCOL)
+
+        db_path = os.path.join(folder, 'manager.db')
+        store_path = os.path.join(folder, 'store')
+        db = sqlite3.connect(db_path)
+        db.executescript(config.SCHEMA)
+        for script in config.MIGRATIONS:
+            db.executescript(script)
+        store = MessageStore(db, store_path)
+        for num, raw in enumerate(raws, 1):
+            store.put(num, raw)
+        db.commit()
+        store.close()
+        db.close()
+
+        results = {}
+        for name, pickle_func, store_func in (
+                ('subject', pickle_subject, store_subject),
+                ('text parts', pickle_parts, store_parts)):
+            drop_cache(files(pickle_path))
+            loads = [time_loads(lambda num: pickle_func(pickle_path, num),
+                                amount) for _ in ('cold', 'warm')]
+            results[('pickle files', name)] = loads
+
+            drop_cache(files(store_path) + [db_path])
+            db = sqlite3.connect(db_path)
+            store = MessageStore(db, store_path)
+            loads = [time_loads(lambda num: store_func(store, num), amount)
+                     for _ in ('cold', 'warm')]
+            results[('message store', name)] = loads
+            store.close()
+            db.close()
+
+        print(f'{amount} messages, loads/sec cold and warm')
+        for layout, path in (('pickle files', pickle_path),
+                             ('message store', store_path)):
+            subject = results[(layout, 'subject')]
+            parts = results[(layout, 'text parts')]
+            print(f'{layout + ":":14} {folder_size(path) / 2**20:8.2f} MB'
+                  f'  subject {subject[0]:9.1f} {subject[1]:9.1f}'
+                  f'  text parts {parts[0]:9.1f} {parts[1]:9.1f}')
+
+if __name__ == '__main__':
+    main()
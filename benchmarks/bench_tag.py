@@ -0,0 +1,43 @@
+'''
+Times EmailDatabase.tag_emails for growing amounts of search results.
+
+Usage: python benchmarks/bench_tag.py [messages]
+'''
+from email import message_from_bytes
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python_email_client'))
+
+from database import EmailDatabase
+from fake_imap import make_messages
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as home:
+        # utils.get_store_path() is inside the home folder
+        os.environ['HOME'] = os.environ['USERPROFILE'] = home
+        database = EmailDatabase(lambda msg: None, None)
+        database.save_emails([(message_from_bytes(raw), str(num).encode())
+                              for num, raw in enumerate(
+                                  make_messages(amount), 1)])
+        # Results like search_emails returns them
+        results = [{'id': email_id} for email_id in database.get_email_ids()]
+
+        print(f'{amount} messages')
+        sizes = [size for size in (1000, 5000, 10000, 20000, 50000)
+                 if size < amount] + [amount]
+        for size in sizes:
+            start = time.perf_counter()
+            database.tag_emails(results[:size], f'tag{size},common')
+            tag_time = time.perf_counter() - start
+            print(f'{size:7d} results tagged with 2 tags in'
+                  f' {tag_time * 1000:9.2f} ms')
+        database.manager.close()
+        database.store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+'''
+A small in-process IMAP4rev1 server used by the benchmarks.
+It only implements the commands the client sends (LOGIN, SELECT, SEARCH,
+FETCH and their UID forms) over plain TCP, with an optional artificial
+delay before every tagged response to imitate network latency.
+'''
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.utils import format_datetime, getaddresses
+from datetime import datetime, timedelta
+import re
+import socketserver
+import threading
+import time
+
+COMMAND = re.compile(rb'^(\S+) (\S+)(?: (.*))?$')
+
+def make_messages(amount, body_size=2000, attachment_size=0):
+    '''
+    Returns a list of amount raw RFC822 test messages. If
+    attachment_size is not 0, every message gets a binary attachment of
+    that many bytes.
+    '''
+    messages = []
+    start = datetime(2020, 8, 1, 12, 0, 0)
+    filler = ('lorem ipsum dolor sit amet consectetur ' * (body_size // 40 + 1))
+    for num in range(1, amount + 1):
+        msg = EmailMessage()
+        msg['Subject'] = f'Test message {num}'
+        msg['From'] = f'sender{num % 50}@example.com'
+        msg['To'] = 'user@example.com'
+        msg['Date'] = format_datetime(start + timedelta(minutes=num))
+        msg['Message-ID'] = f'<{num}@fake.example.com>'
+        msg.set_content(filler[:body_size])
+        if attachment_size:
+            msg.add_attachment(bytes(range(256)) * (attachment_size // 256),
+                               maintype='application', subtype='octet-stream',
+                               filename=f'file{num}.bin')
+        messages.append(msg.as_bytes())
+    return messages
+
+def quote(value):
+    if value is None:
+        return 'NIL'
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+def envelope(msg):
+    '''Returns the ENVELOPE of a message.'''
+    def addresses(value):
+        if value is None:
+            return 'NIL'
+        items = []
+        for name, address in getaddresses([value]):
+            mailbox, _, host = address.partition('@')
+            items.append(f'({quote(name or None)} NIL {quote(mailbox)}'
+                         f' {quote(host)})')
+        return f'({"".join(items)})'
+
+    sender = addresses(msg['From'])
+    fields = [quote(msg['Date']), quote(msg['Subject']), sender, sender,
+              sender, addresses(msg['To']), addresses(msg['Cc']), 'NIL',
+              quote(msg['In-Reply-To']), quote(msg['Message-ID'])]
+    return f'({" ".join(fields)})'
+
+def split_part(part):
+    '''Returns the (header, body) bytes of a message or MIME part.'''
+    raw = part.as_bytes()
+    header, _, body = raw.partition(b'\n\n')
+    return header + b'\n\n', body
+
+def bodystructure(part):
+    '''Returns the BODYSTRUCTURE of a message or MIME part.'''
+    if part.is_multipart():
+        children = ''.join(bodystructure(child)
+                           for child in part.get_payload())
+        return f'({children} {quote(part.get_content_subtype().upper())})'
+
+    params = ' '.join(f'{quote(key.upper())} {quote(value)}'
+                      for key, value in (part.get_params() or [])[1:])
+    body = split_part(part)[1]
+    fields = [quote(part.get_content_maintype().upper()),
+              quote(part.get_content_subtype().upper()),
+              f'({params})' if params else 'NIL', 'NIL', 'NIL',
+              quote(part.get('Content-Transfer-Encoding', '7BIT').upper()),
+              str(len(body))]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(body.count(b'\n')))
+    fields.append('NIL')
+    disposition = part.get_content_disposition()
+    if disposition is None:
+        fields.append('NIL')
+    elif part.get_filename() is None:
+        fields.append(f'({quote(disposition.upper())} NIL)')
+    else:
+        fields.append(f'({quote(disposition.upper())}'
+                      f' ("FILENAME" {quote(part.get_filename())}))')
+    return f'({" ".join(fields)})'
+
+def body_section(raw, section):
+    '''Returns the bytes of BODY[section] of a raw message.'''
+    msg = message_from_bytes(raw)
+    header, _, text = raw.partition(b'\n\n')
+    if section == 'HEADER':
+        return header + b'\n\n'
+    if section in ('', 'TEXT'):
+        return raw if section == '' else text
+    spec = section.split('.')
+    mime = spec[-1] == 'MIME'
+    if mime:
+        spec = spec[:-1]
+    part = msg
+    for number in spec:
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    header, body = split_part(part)
+    return header if mime else body
+
+def parse_set(msg_set, highest):
+    '''Returns the set of numbers in an IMAP message set string.'''
+    numbers = set()
+    for item in msg_set.split(','):
+        if ':' in item:
+            low, high = item.split(':')
+            low = highest if low == '*' else int(low)
+            high = highest if high == '*' else int(high)
+            if low > high:
+                low, high = high, low
+            numbers.update(range(low, high + 1))
+        else:
+            numbers.add(highest if item == '*' else int(item))
+    return numbers
+
+class FakeMailbox():
+    def __init__(self, messages, uidvalidity=1, first_uid=1):
+        '''
+        Keyword arguments:
+        messages -- a list of raw RFC822 message bytes
+        uidvalidity -- the UIDVALIDITY value reported on SELECT
+        first_uid -- the UID of the first message
+        '''
+        self.uidvalidity = uidvalidity
+        self.lock = threading.Lock()
+        self.messages = [] # [(uid, raw, flags, modseq)]
+        self.next_uid = first_uid
+        self.highestmodseq = 1
+        # ENVELOPE and BODYSTRUCTURE by UID, worked out once so they do
+        # not count towards the time of a benchmark
+        self.summaries = {}
+        for raw in messages:
+            self.append(raw)
+
+    def append(self, raw, flags=()):
+        msg = message_from_bytes(raw)
+        with self.lock:
+            self.summaries[self.next_uid] = (envelope(msg), bodystructure(msg))
+            self.highestmodseq += 1
+            self.messages.append(
+                (self.next_uid, raw, tuple(flags), self.highestmodseq))
+            self.next_uid += 1
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    # Responses are buffered and flushed once per command so small
+    # writes do not run into delayed ACKs.
+    wbufsize = 65536
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode('ascii')
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send('* OK [CAPABILITY IMAP4rev1 CONDSTORE] fake IMAP ready')
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            found = COMMAND.match(line.rstrip(b'\r\n'))
+            if found is None:
+                self.send('* BAD unknown line')
+                self.wfile.flush()
+                continue
+            tag = found.group(1).decode()
+            command = found.group(2).decode().upper()
+            args = (found.group(3) or b'').decode()
+            use_uid = False
+            if command == 'UID':
+                use_uid = True
+                command, _, args = args.partition(' ')
+                command = command.upper()
+
+            if self.server.latency:
+                time.sleep(self.server.latency)
+
+            if command == 'CAPABILITY':
+                self.send('* CAPABILITY IMAP4rev1 CONDSTORE')
+            elif command in ('SELECT', 'EXAMINE'):
+                self.send(f'* {len(mailbox.messages)} EXISTS')
+                self.send('* 0 RECENT')
+                self.send(f'* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs')
+                self.send(f'* OK [UIDNEXT {mailbox.next_uid}] next')
+                self.send(f'* OK [HIGHESTMODSEQ {mailbox.highestmodseq}]'
+                          ' modseq')
+            elif command == 'SEARCH':
+                self.search(args, use_uid)
+            elif command == 'FETCH':
+                self.fetch(args, use_uid)
+            elif command == 'LOGOUT':
+                self.send('* BYE logging out')
+                self.send(f'{tag} OK LOGOUT completed')
+                self.wfile.flush()
+                return
+            elif command not in ('LOGIN', 'NOOP', 'CLOSE'):
+                self.send(f'{tag} BAD unsupported command')
+                self.wfile.flush()
+                continue
+            self.send(f'{tag} OK {command} completed')
+            self.wfile.flush()
+
+    def selected(self, msg_set, use_uid):
+        '''Returns (sequence number, message) pairs inside msg_set.'''
+        messages = self.server.mailbox.messages
+        if not messages:
+            return []
+        if use_uid:
+            wanted = parse_set(msg_set, messages[-1][0])
+            return [(num, msg) for num, msg in enumerate(messages, 1)
+                    if msg[0] in wanted]
+        wanted = parse_set(msg_set, len(messages))
+        return [(num, messages[num - 1]) for num in sorted(wanted)
+                if 0 < num <= len(messages)]
+
+    def search(self, args, use_uid):
+        criteria = args.upper().split()
+        if len(criteria) >= 2 and criteria[0] == 'UID':
+            found = self.selected(criteria[1], True)
+        else:
+            # ALL and SINCE both return the whole mailbox
+            found = list(enumerate(self.server.mailbox.messages, 1))
+        if use_uid:
+            nums = [str(msg[0]) for num, msg in found]
+        else:
+            nums = [str(num) for num, msg in found]
+        self.send(' '.join(['* SEARCH'] + nums))
+
+    def fetch(self, args, use_uid):
+        msg_set, _, items = args.partition(' ')
+        items = items.strip('()').upper().split()
+        if use_uid and 'UID' not in items:
+            items.insert(0, 'UID')
+        for num, (uid, raw, flags, modseq) in self.selected(msg_set, use_uid):
+            parts = []
+            for item in items:
+                if item == 'UID':
+                    parts.append(f'UID {uid}')
+                elif item == 'FLAGS':
+                    parts.append(f'FLAGS ({" ".join(flags)})')
+                elif item == 'RFC822.SIZE':
+                    parts.append(f'RFC822.SIZE {len(raw)}')
+                elif item == 'ENVELOPE':
+                    parts.append('ENVELOPE '
+                                 + self.server.mailbox.summaries[uid][0])
+                elif item == 'BODYSTRUCTURE':
+                    parts.append('BODYSTRUCTURE '
+                                 + self.server.mailbox.summaries[uid][1])
+                elif item == 'RFC822':
+                    parts.append(('RFC822', raw))
+                elif item.startswith('BODY'):
+                    section = item[item.index('[') + 1:item.index(']')]
+                    parts.append((f'BODY[{section}]',
+                                  body_section(raw, section)))
+
+            self.wfile.write(f'* {num} FETCH ('.encode('ascii'))
+            for index, part in enumerate(parts):
+                if index > 0:
+                    self.wfile.write(b' ')
+                if isinstance(part, tuple):
+                    name, literal = part
+                    self.wfile.write(
+                        f'{name} {{{len(literal)}}}\r\n'.encode('ascii'))
+                    self.wfile.write(literal)
+                else:
+                    self.wfile.write(part.encode('utf-8'))
+            self.send(')')
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox, latency=0.0):
+        '''
+        Keyword arguments:
+        mailbox -- a FakeMailbox served as INBOX
+        latency -- seconds to wait before answering each command
+        '''
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), FakeIMAPHandler)
+        self.mailbox = mailbox
+        self.latency = latency
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,20 +1,21 @@
-from multiprocessing import Pool
-from queue import Queue
+from collections import OrderedDict
 from functools import partial
 import tkinter as tk
 from tkinter import ttk
 import tkinter.messagebox
 import tkinter.scrolledtext
-from threading import Thread, active_count
+import tkinter.simpledialog
+from threading import active_count
 from datetime import datetime
-import gc
-import time
 
 # Custom modules:
 import parse_mail
 import utils
 from database import *
 from email_conn import *
+from async_conn import AsyncEmailGetter
+from event_bus import EventBus, Cancelled, HIGH, NORMAL, LOW
+from search_pool import SearchPool
 from gui_elements import *
 
 import config
@@ -23,21 +24,29 @@ VERSION = config.VERSION
 class Application():
     def __init__(self):
         # Application objects
-        self.tasks = []
-        self.log = Queue()
-        self.bar_log = Queue()
+        # Jobs and events of worker threads, handled in the Tk main loop
+        self.bus = EventBus(self.update_status, config.JOB_WORKERS)
+        self.closing = False
         self.email_app = None   # EmailConnection()
         self.email_get = None   # EmailGetter()
         self.emails = None      # Email list
         self.searched = None    # Searched list
+        self.search_pool = None # SearchPool(), started by the first search
+        self.selected = None    # Id of the email selected in the list
+        # {email id: (payload, can_view, attached, email_info)} of the
+        # last emails shown, least recently shown first
+        self.rendered = OrderedDict()
 
         # For Toplevel() dialog
         self.progress_w = None
         self.w_status = None
         self.w_status_lb = None
-        self.w_progress_br = None
+        # {Task: (frame, name and status StringVar, Progressbar)}
+        self.w_tasks = {}
 
-        self.database = EmailDatabase(self.put_msg, self.add_bar)
+        self.database = EmailDatabase(
+            self.put_msg, self.add_bar,
+            partial(self.bus.post, tk.messagebox.showerror))
 
         # Arrange the basics of window
         self.root = tk.Tk()
@@ -52,54 +61,76 @@ class Application():
             anchor=tk.W)
         self.fTop = tk.Frame(self.root)
 
-        self.root.config(menu=OverMenu(self.root, self.database.reset_db))
+        self.root.config(menu=OverMenu(self.root, self._reset_db))
 
         self.pane = OverviewPane(self.fTop,
-                                 lambda: self.wrapper(self._search, search_val),
+                                 lambda search_val: self.wrapper(
+                                     self._search, search_val,
+                                     name='Search'),
                                  VERSION,
-                                 lambda: self.wrapper(self._show_tags, tags),
-                                 lambda: self.wrapper(self.display_mail),
-                                 lambda: self.wrapper(self._conv_mail))
+                                 lambda tags: self.wrapper(
+                                     self._show_tags, tags,
+                                     name='Show tags', priority=HIGH),
+                                 lambda: self.wrapper(
+                                     self.display_mail,
+                                     name='Show emails', priority=HIGH),
+                                 lambda: self.wrapper(
+                                     self._conv_mail,
+                                     name='Sync with server', priority=LOW))
         self.pane.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        self.scrolling_frame = ScrollingFrameAndView(self.fTop)
+        self.scrolling_frame = ScrollingFrameAndView(
+            self.fTop, self.open_attachments, self.select_email)
         self.scrolling_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         self.fTop.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
         # Tags
         self.tags = []
-        database_tags = self.database.load_json()
-        if database_tags is not None:
-            if 'tags' in database_tags:
-                database_tags = database_tags['tags']
-                if not database_tags.isspace() and database_tags != '':
-                    self.put_tags_wrapper(database_tags)
-
-        # Updater
-        self.tasks.append(Thread(target=self.update_status))
-        self.tasks[-1].daemon = True
-        self.tasks[-1].start()
+        database_tags = self.database.get_folders()
+        if len(database_tags) > 0:
+            self.put_tags_wrapper(','.join(database_tags))
+
+        self.bus.start(self.root)
 
     def close(self):
-        for task in self.tasks:
-            if task.is_alive() and not task.isDaemon():
-                error_msg = 'Cannot close, task in progress.'
-                self.put_msg(error_msg)
-                tk.messagebox.showwarning(
-                    'Error',
-                    message=error_msg)
+        if self.closing:
+            return False
+        if len(self.bus.running()) > 0:
+            if not tk.messagebox.askyesno(
+                    'Warning',
+                    'Tasks are in progress. Cancel them and close?'):
                 return False
+            self.put_msg('Cancelling tasks...')
+            self.closing = True
+            self.bus.cancel_all()
+            self.root.after(100, self._close_when_done)
+            return False
+        if self.email_app is not None:
+            self.email_app.close()
+            self.email_app.pool.close()
+        self._close_search_pool()
         self.root.destroy()
         return True
 
-    def wrapper(self, func, *args):
-        '''Wraps the function (func) with args (args) into a thread.
-        Allows easy execution without blocking the Tkinter loop
+    def _close_when_done(self):
+        '''Closes the application once the cancelled tasks stopped.'''
+        if len(self.bus.running()) > 0:
+            self.root.after(100, self._close_when_done)
+            return
+        self.closing = False
+        self.close()
+
+    def wrapper(self, func, *args, name=None, priority=NORMAL):
+        '''Wraps the function (func) with args (args) into a job of
+        self.bus. Allows easy execution without blocking the Tkinter
+        loop; clicking a button again while its job has not finished
+        does not start it twice. The function must only use Tk through
+        self.bus.
+        Keyword arguments:
+        name -- the name of the job in the progress window
+                (Default the name of func)
+        priority -- event_bus.HIGH, NORMAL or LOW (Default NORMAL)
         '''
-        if len(args) == 0:
-            self.tasks.append(Thread(target=func))
-        else:
-            self.tasks.append(Thread(target=func, args=args))
-        self.tasks[-1].start()
+        return self.bus.schedule(func, *args, name=name, priority=priority)
 
     def _connect(self):
         if self.email_app == None:
@@ -107,31 +138,71 @@ class Application():
             self.email_app = EmailConnection()
             if self.email_app.conn is None:
                 self.put_msg('Not Connected: Connection error/No internet!')
-                tk.messagebox.showerror('Error', 'No internet/Connection error.'
-                                                 ' The app was unable to connect'
-                                                 ' to the IMAP server.')
+                self.bus.post(tk.messagebox.showerror,
+                              'Error', 'No internet/Connection error.'
+                                       ' The app was unable to connect'
+                                       ' to the IMAP server.')
+            self.database.body_func = self._fetch_body
             self.put_msg('Connected!')
         else:
-            self.log.put('Already connected!')
+            self.put_msg('Already connected!')
 
-    def _get_mail(self, threads=None):
+    def _fetch_body(self, mailbox, uid, sections):
+        '''Downloads body parts of a message for self.database.'''
+        with self.email_app.pool.connection() as conn:
+            conn.select(mailbox, readonly=True)
+            return fetch_parts(conn, uid, sections)
+
+    def _get_mail(self, threads=None, state=None, stream=False):
+        '''Downloads new emails into self.email_get.
+        Keyword arguments:
+        threads -- the amount of threads/connections to download with.
+                   None asks the user. (Default None)
+        state -- the stored sync state of INBOX (Default None)
+        stream -- whether to save emails to the database while they are
+                  downloaded instead of keeping them in
+                  self.email_get.emails (Default False)
+        '''
         if self.email_app != None:
             if self.email_get == None:
+                task = self.bus.current()
                 self.put_msg('Getting messages')
                 if threads == None:
-                    l_threads = tk.simpledialog.askinteger(
+                    l_threads = self.bus.ask(partial(
+                        tk.simpledialog.askinteger,
                         'Get messages',
                         'Enter amount of threads for search (Min 1, Max 10)',
                         minvalue=1, maxvalue=10
-                    )
+                    ))
                     if l_threads == None:
                         self.put_msg('Cancelled.')
                         return False
                 else:
                     l_threads = threads
-                self.email_get = EmailGetter(self.email_app.conn, threads,
-                                     self.put_msg, self.add_bar)
-                self.email_get.get_emails_online(threads, self.database.get_datestr())
+                # The threads of the getter report to the task directly
+                if config.ASYNC_ENGINE:
+                    self.email_get = AsyncEmailGetter(
+                        task.set_status, task.add_progress,
+                        headers_only=config.HEADERS_FIRST, stream=stream)
+                else:
+                    self.email_get = EmailGetter(self.email_app.conn, l_threads,
+                                         task.set_status, task.add_progress,
+                                         pool=self.email_app.pool,
+                                         headers_only=config.HEADERS_FIRST,
+                                         stream=stream)
+                task.token.on_cancel(self.email_get.cancel)
+                if stream:
+                    writer = self.bus.run(self.database.save_email_stream,
+                                          self.email_get.finished_queue,
+                                          200, task.token)
+                self.email_get.get_emails_online(l_threads,
+                                                 self.database.get_datestr(),
+                                                 state)
+                if stream:
+                    writer.wait()
+                    if writer.state != 'done' or writer.result is None:
+                        # Emails were downloaded but not saved
+                        self.email_get.sync_state = None
                 return True
             else:
                 self.put_msg('Emails already received.')
@@ -145,7 +216,8 @@ class Application():
 
     def _save_mail(self, emails=None):
         if emails is not None:
-            self.database.save_emails(emails)
+            self.database.save_emails(emails,
+                                      cancel=self.bus.current().token)
         else:
             self.put_msg('No emails to save...')
 
@@ -154,14 +226,31 @@ class Application():
         Uses other defined methods during operation.
         '''
         self._connect()
-        self._get_mail(threads=10)
-        self._save_mail(self.email_get.emails)
+        self.email_get = None
+        self._get_mail(threads=10,
+                       state=self.database.get_sync_state('INBOX'),
+                       stream=True)
+        # A cancelled sync keeps the emails it saved, but not its sync
+        # state or load date, so the next sync gets the rest
+        self.bus.current().token.check()
+        if self.email_get.sync_state is None:
+            self.bus.post(tk.messagebox.showwarning,
+                          'Warning', 'Not all emails could be saved.'
+                                     ' Sync again to get the rest.')
+            return False
+        self.database.save_sync_state('INBOX', **self.email_get.sync_state)
         self.database.save_last_date(datetime.now())
-        self.pane.set_status(
+        if config.HEADERS_FIRST:
+            self.bus.schedule(self.database.prefetch_bodies,
+                              name='Download bodies', priority=LOW,
+                              daemon=True)
+        self.bus.post(
+            self.pane.set_status,
             f'PythonEmail Client version {VERSION}.'
             '\nEmails loaded and saved.'
             '\nUse the search function to group and view emails')
-        tk.messagebox.showinfo('Info:', 'Finished getting all emails.')
+        self.bus.post(tk.messagebox.showinfo,
+                      'Info:', 'Finished getting all emails.')
 
     def _search(self, search_val):
         '''
@@ -170,110 +259,130 @@ class Application():
         search_val -- The search values to search for, in a string:
                       'value1,value2' format
         '''
-        self.pane.disable_search()
-        self.root.update_idletasks()
+        self.bus.post(self.pane.disable_search)
 
-        subject, to_ln, from_ln, all_match = self.pane.get_checkboxes()
+        subject, to_ln, from_ln, all_match = self.bus.ask(
+            self.pane.get_checkboxes)
         search_terms = search_val.replace(' ', '').lower().split(',')
         if len(search_terms) == 0 or search_terms[0] == '':
-            tk.messagebox.showerror('Error:', 'No search terms provided.')
-            self.pane.enable_search()
+            self.bus.post(tk.messagebox.showerror,
+                          'Error:', 'No search terms provided.')
+            self.bus.post(self.pane.enable_search)
             return False
         
-        self.pane.set_search_terms(search_terms)
-        self._load_mail()
-        if self.emails == None:
+        self.bus.post(self.pane.set_search_terms, search_terms)
+        if self.database.email_count() == 0:
             error_msg = (
                 'Cannot search: No emails. '
                 'Use "Get Emails!" to get emails.')
-            tk.messagebox.showwarning(
-                'Error',
-                message=error_msg
-            )
+            self.bus.post(tk.messagebox.showwarning, 'Error', error_msg)
             self.put_msg(error_msg)
-            self.pane.enable_search()
+            self.bus.post(self.pane.enable_search)
             return False
 
         if not all_match and len(search_terms) > 1:
-            if not tk.messagebox.askyesno('Warning', ('If multiple tags are'
-                                                      ' searched without the'
-                                                      ' "All items must match"'
-                                                      ' parameter, all the'
-                                                      ' results will be tagged'
-                                                      ' with every searched tag')):
+            if not self.bus.ask(tk.messagebox.askyesno,
+                                'Warning', ('If multiple tags are'
+                                            ' searched without the'
+                                            ' "All items must match"'
+                                            ' parameter, all the'
+                                            ' results will be tagged'
+                                            ' with every searched tag')):
                 self.put_msg('Cancelled.')
-                tk.messagebox.showinfo('Info:', 'Cancelled search.')
-                self.pane.enable_search()
+                self.bus.post(tk.messagebox.showinfo,
+                              'Info:', 'Cancelled search.')
+                self.bus.post(self.pane.enable_search)
                 return False
 
-        process_message_searches = partial(
-            parse_mail.process_message,
-            subject=subject,
-            to_ln=to_ln,
-            from_ln=from_ln,
-            search_list=search_terms,
-            all_match=all_match)
         self.put_msg('Searching messages...')
-        search_list = []
-        messages = [ msg[1] for msg in self.emails ]
-
+        if self.database.fts:
+            search_func = partial(self.database.search_emails, search_terms,
+                                  subject, to_ln, from_ln, all_match)
+        else:
+            search_func = partial(self._search_loaded, search_terms, subject,
+                                  to_ln, from_ln, all_match)
         try:
-            email_amt = 100 / len(messages)
-        except ZeroDivisionError:
-            email_amt = 0
-        
-        with Pool() as pool:
-            for i in pool.imap_unordered(process_message_searches, messages):
-                self.add_bar(email_amt)
-                if i != False:
-                    search_list.append(i)
+            search_list = self.database.cached_search(
+                search_terms, subject, to_ln, from_ln, all_match,
+                search_func, 'fts' if self.database.fts else 'scan')
+        except Cancelled:
+            self.put_msg('Cancelled search.')
+            self.bus.post(self.pane.enable_search)
+            raise
 
         self.put_msg('Finished processing emails.')
         self.searched = search_list
         tags = ','.join(search_terms)
         self.database.tag_emails(search_list, tags)
         self.put_msg('Finished tagging emails.')
-        self.display_mail(tags)
-        self.pane.enable_search()
-        self.pane.set_search_terms('')
+        self.display_mail(tags, (search_terms, subject, to_ln, from_ln,
+                                 all_match))
+        self.bus.post(self.pane.enable_search)
+        self.bus.post(self.pane.set_search_terms, '')
 
-    def display_mail(self, tags=None):
+    def _search_loaded(self, search_terms, subject, to_ln, from_ln,
+                       all_match, since_generation=None):
+        '''
+        Searches emails with parse_mail.process_message in
+        self.search_pool. Used when SQLite has no FTS5. See
+        EmailDatabase.search_emails for the arguments.
+        '''
+        cancel = self.bus.current().token
+        email_ids = self.database.get_email_ids(since_generation)
+        # Workers only read the cache, words are extracted here once
+        self.database.cache_tokens(email_ids, cancel)
+        if self.search_pool is None:
+            self.search_pool = SearchPool(self.database.database_path,
+                                          self.database.store_path)
+        return self.search_pool.search(
+            email_ids, subject, to_ln, from_ln,
+            parse_mail.SearchQuery(search_terms, all_match), self.add_bar,
+            cancel)
+
+    def _close_search_pool(self):
+        if self.search_pool is not None:
+            self.search_pool.close()
+            self.search_pool = None
+
+    def _reset_db(self):
+        # Search workers keep the old manager.db open
+        self._close_search_pool()
+        self.rendered.clear()
+        self.database.reset_db()
+
+    def display_mail(self, tags=None, rule=None):
         '''Displays mail onto scrolling_frame and updates grouped tags.
         Wraps on top of self._display_mail
         Keyword arguments:
         tags -- the tags provided to update and display. Default is
                 None, which gets all emails.
+        rule -- the (search_terms, subject, to_ln, from_ln, all_match)
+                of the search that found the tagged emails, saved as a
+                tag rule if the user keeps the tags. (Default None)
         '''
-        self.scrolling_frame.reset_frame()
-        self.root.update_idletasks()
-        if tags is not None:
-            emails = self.database.get_tagged_emails(tags)
-        else:
-            emails = self.database.get_all_emails()
-        
-        self.put_msg('Finished getting tagged emails.')
-
-        if not emails or len(emails) == 0:
-            tk.messagebox.showinfo('Info', 'No searched emails found')
+        self.bus.post(self.scrolling_frame.reset_frame)
+        if not self._display_mail(tags):
+            self.bus.post(tk.messagebox.showinfo,
+                          'Info', 'No searched emails found')
             return False
 
-        self._display_mail(emails)
-
         if tags is not None:
-            if tk.messagebox.askyesno('Info', 'Found emails: Tag emails? If'
-                                              ' emails are not tagged they'
-                                              ' must be searched again to'
-                                              ' view them.'):
+            if self.bus.ask(tk.messagebox.askyesno,
+                            'Info', 'Found emails: Tag emails? If'
+                                    ' emails are not tagged they'
+                                    ' must be searched again to'
+                                    ' view them.'):
+                if rule is not None:
+                    # New emails matching the search are tagged when saved
+                    self.database.save_tag_rule(*rule, tags)
                 self.put_tags_wrapper(tags)
 
-        self.scrolling_frame.update_cnt()
         self.put_msg('Finished displaying mail.')
-        gc.collect()
 
     def put_tags_wrapper(self, tags):
-        '''Wraps _put_tags with a thread for easy access.'''
-        self.tasks.append(Thread(target=self._put_tags, args=(tags,)))
-        self.tasks[-1].start()
+        '''Wraps _put_tags with a job for easy access.'''
+        return self.wrapper(self._put_tags, tags, name='Add tags',
+                            priority=HIGH)
 
     def _put_tags(self, tags):
         '''Displays tags (folders) on GUI as well as storing any new
@@ -283,132 +392,157 @@ class Application():
         '''
         l_tags = [ x for x in tags.split(',') if not x.isspace() and x != '' ]
         if len(l_tags) == 0:
-            tk.messagebox.showwarning('Warning',
-                                      'Operation aborted, no emails to tag.')
+            self.bus.post(tk.messagebox.showwarning, 'Warning',
+                          'Operation aborted, no emails to tag.')
             return False
 
         bar_amt = 100 / len(l_tags)
         for tag in l_tags:
             if tag not in self.tags:
-                self.pane.add_button(tag, tag)
+                self.bus.post(self.pane.add_button, tag, tag)
                 self.tags.append(tag)
             self.add_bar(bar_amt)
 
         self.database.store_tags(tags)
 
     def _show_tags(self, tags):
-        self.scrolling_frame.reset_frame()
-        self.root.update_idletasks()
-        emails = self.database.get_tagged_emails(tags)
-        if len(emails) == 0:
+        self.bus.post(self.scrolling_frame.reset_frame)
+        return self._display_mail(tags)
+
+    def _display_mail(self, tags=None):
+        '''Lists the emails of tags (or all emails if None) in
+        self.scrolling_frame. Emails are only read from the database a
+        page at a time as the list is scrolled, and loaded when selected
+        (see select_email).
+        Returns: False if there are no emails to list, True otherwise
+        '''
+        count = self.database.email_count(tags)
+        if count == 0:
             return False
-        self._display_mail(emails)
-        self.scrolling_frame.update_cnt()
-        gc.collect()
-
-    def _display_mail(self, emails):
-        '''Displays mail by adding buttons to self.scrolling_frame.
-        Should never be called on except when used by other methods of
-        this class as they handle user input before this step.
-        Keyword arguments:
-            emails -- list of (email, attached) tuples, where
-                      attached is also a list of attached filename paths.
+        self.bus.post(self.scrolling_frame.show_emails,
+                      partial(self.database.list_emails, tags), count)
+        return True
+
+    def select_email(self, email_id):
+        '''Shows an email selected in self.scrolling_frame. Emails are
+        rendered when they are selected, in a daemon job as their body
+        may have to be downloaded first. Selecting another email before
+        the job starts replaces it.
         '''
-        payload = None
-        can_view = False
-
-        for email, attached in emails:
-            for part in email[0].walk():
-                if part.get_content_maintype() == 'text':
-                    payload = utils.parse_payload(part.get_payload())
-                    if part.get_content_subtype() == 'html':
-                        can_view = True
-                    break
-
-            email_info = {
-                'Subject:': utils.parse_complete_sub(email[0].get('Subject')),
-                'Date sent:': email[0].get('Date'),
-                'To:': utils.parse_complete_sub(email[0].get('To')),
-                'From:': utils.parse_complete_sub(email[0].get('From'))}
-
-            if attached is not None:
-                self.scrolling_frame.add_button(
-                    utils.parse_sub(email[0].get('Subject')),
-                    payload, can_view, attached, email_info)
-            else:
-                self.scrolling_frame.add_button(
-                    utils.parse_sub(email[0].get('Subject')),
-                    payload, can_view, None, email_info)
+        self.selected = email_id
+        if email_id in self.rendered:
+            self.rendered.move_to_end(email_id)
+            self.scrolling_frame.display(*self.rendered[email_id])
+            return True
+        self.bus.schedule(self._render_email, email_id, name='Show email',
+                          priority=HIGH, key='render email', replace=True,
+                          daemon=True)
+
+    def open_attachments(self, paths, open_func):
+        '''Downloads the attachments at paths that are not downloaded yet
+        in a job, as they may have to be fetched from the server, then
+        opens them with open_func on the main thread.
+        '''
+        return self.wrapper(self._fetch_attachments, paths, open_func,
+                            name='Download attachments', priority=HIGH)
+
+    def _fetch_attachments(self, paths, open_func):
+        self.database.fetch_attachments(paths)
+        self.bus.current().token.check()
+        self.bus.post(open_func, paths)
+        return True
+
+    def _render_email(self, email_id):
+        email = self.database.get_email(email_id)
+        if email is None:
+            self.put_msg('Email not found.')
+            return False
+        email, attached = email
+        payload, can_view, email_info = parse_mail.render_message(email[0])
+        self.bus.post(self._show_email, email_id,
+                      (payload, can_view, attached, email_info))
+        return True
+
+    def _show_email(self, email_id, rendered):
+        '''Shows a rendered email (see _render_email) if it is still
+        selected. Runs on the main thread.
+        '''
+        # Emails of a headers only sync have no text until their body is
+        # downloaded, so are rendered again
+        if rendered[0] is not None:
+            self.rendered[email_id] = rendered
+            while len(self.rendered) > config.RENDER_CACHE_SIZE:
+                self.rendered.popitem(last=False)
+        # Another email may have been selected while this one loaded
+        if self.selected == email_id:
+            self.scrolling_frame.display(*rendered)
 
     def put_msg(self, msg):
         '''Put message (msg) into the queue to be shown by status bar'''
-        self.log.put(msg)
+        self.bus.status(msg)
 
     def add_bar(self, amt):
         '''Add to the progress bar (amt)'''
-        self.bar_log.put(amt)
-
-    def update_status(self):
-        while True:
-            '''Refreshes self.root with status of various infos'''
-            task_alive = False
-            for task in self.tasks: # TODO: make task a tuple of (task_name, actual thread tasks)
-                if task.is_alive() and not task.isDaemon():
-                    task_alive = True
-                    break
-            
-            if task_alive:
-                if self.progress_w is None:
-                    self.progress_w = tk.Toplevel()
-                    self.progress_w.geometry('300x50')
-                    self.progress_w.title('Task running...')
-                    self.progress_w.iconbitmap('favicon.ico')
-                    self.w_status = tk.StringVar()
-                    self.w_status.set(' ')
-                    self.w_status_lb = ttk.Label(self.progress_w,
-                                                textvariable=self.w_status)
-                    self.w_progress_br = ttk.Progressbar(self.progress_w,
-                                                        orient=tk.HORIZONTAL,
-                                                        mode='determinate',
-                                                        maximum=100)
-                    self.w_progress_br['value'] = 0
-                    self.w_status_lb.pack(fill=tk.X)
-                    self.w_progress_br.pack(fill=tk.X)
-                    center(self.progress_w)
-                
-                set_val = ''
-                if not self.log.empty():
-                    while not self.log.empty():
-                        set_val = self.log.get()
-                        self.log.task_done()
-                    self.w_status.set(set_val)
-
-                add_val = 0
-                if not self.bar_log.empty():
-                    while not self.bar_log.empty():
-                        add_val += self.bar_log.get()
-                        self.bar_log.task_done()
-                    
-                    if self.w_progress_br['value'] + add_val > 100:
-                        self.w_progress_br['value'] = 100
-                    else:
-                        self.w_progress_br['value'] += add_val
-
-            elif self.progress_w is not None:
-                self.w_status_lb.destroy()
-                self.w_progress_br.destroy()
-                self.progress_w.destroy()
-                self.progress_w = None
-                self.w_status = None
-                self.w_status_lb = None
-                self.w_progress_br = None
-
-            active_threads = active_count()
-            if self.pane.get_thread_cnt() != active_threads:
-                self.pane.set_thread_cnt(active_threads)
-
-            self.root.update_idletasks()
-            time.sleep(0.02)
+        self.bus.progress(amt)
+
+    def update_status(self, status, tasks):
+        '''Refreshes self.root with status of various infos. Called by
+        self.bus on the main thread, see EventBus. The progress window
+        shows a row per task with its status, progress and a button to
+        cancel it.
+        '''
+        if len(tasks) > 0:
+            if self.progress_w is None:
+                self.progress_w = tk.Toplevel()
+                self.progress_w.title('Task running...')
+                self.progress_w.iconbitmap('favicon.ico')
+                self.w_status = tk.StringVar()
+                self.w_status.set(' ')
+                self.w_status_lb = ttk.Label(self.progress_w,
+                                            textvariable=self.w_status)
+                self.w_status_lb.pack(fill=tk.X)
+                center(self.progress_w)
+
+            for task in list(self.w_tasks):
+                if task not in tasks:
+                    self.w_tasks.pop(task)[0].destroy()
+            for task in tasks:
+                if task not in self.w_tasks:
+                    frame = ttk.Frame(self.progress_w)
+                    text = tk.StringVar()
+                    ttk.Label(frame, textvariable=text).pack(fill=tk.X)
+                    bar = ttk.Progressbar(frame, orient=tk.HORIZONTAL,
+                                          mode='determinate', maximum=100)
+                    bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+                    ttk.Button(frame, text='Cancel',
+                               command=task.cancel).pack(side=tk.LEFT)
+                    frame.pack(fill=tk.X)
+                    self.w_tasks[task] = (frame, text, bar)
+                frame, text, bar = self.w_tasks[task]
+                if task.token.cancelled:
+                    text.set(f'{task.name}: Cancelling...')
+                elif task.state == 'pending':
+                    text.set(f'{task.name}: Waiting...')
+                else:
+                    text.set(f'{task.name}: {task.status}')
+                bar['value'] = task.progress
+            # Every task has a row of two lines
+            self.progress_w.geometry(f'300x{25 + 50 * len(tasks)}')
+
+            if status is not None:
+                self.w_status.set(status)
+
+        elif self.progress_w is not None:
+            self.w_status_lb.destroy()
+            self.progress_w.destroy()
+            self.progress_w = None
+            self.w_status = None
+            self.w_status_lb = None
+            self.w_tasks = {}
+
+        active_threads = active_count()
+        if self.pane.get_thread_cnt() != active_threads:
+            self.pane.set_thread_cnt(active_threads)
 
 if __name__ == '__main__':
     app=Application()
@@ -0,0 +1,351 @@
+from queue import Queue
+from threading import Lock
+import asyncio
+import re
+import ssl
+
+# Own modules
+import imap_parse
+import utils
+from email_conn import (EmailGetter, HEADER_ITEMS, STREAM_QUEUE_SIZE,
+                        make_message_sets, parse_fetch_response)
+from message_store import LazyMessage
+
+LITERAL = re.compile(rb'\{(\d+)\}$')
+RESPONSE_CODE = re.compile(rb'\[([A-Z-]+) ?([^\]]*)\]')
+UNTAGGED = re.compile(rb'^\* (?:(\d+) )?([A-Z-]+) ?(.*)$', re.S)
+
+class AsyncIMAPError(Exception):
+    '''Raised when the server answers a command with NO or BAD.'''
+
+class AsyncIMAPConnection():
+    def __init__(self, reader, writer):
+        '''
+        An IMAP connection that can have several tagged commands in
+        flight at once. Use AsyncIMAPConnection.open to create one.
+        '''
+        self.reader = reader
+        self.writer = writer
+        self.tag_num = 0
+        self.pending = {}      # {tag: (future, untagged dict)}
+        self.capabilities = ()
+        self.reader_task = None
+
+    @classmethod
+    async def open(cls, host, port, use_ssl=True):
+        '''Connects to an IMAP server and reads its greeting.'''
+        context = ssl.create_default_context() if use_ssl else None
+        reader, writer = await asyncio.open_connection(host, port,
+                                                       ssl=context)
+        conn = cls(reader, writer)
+        greeting = await reader.readline()
+        found = RESPONSE_CODE.search(greeting)
+        if found is not None and found.group(1) == b'CAPABILITY':
+            conn.capabilities = tuple(found.group(2).decode().upper().split())
+        conn.reader_task = asyncio.ensure_future(conn._read_responses())
+        if not conn.capabilities:
+            untagged = await conn.command('CAPABILITY')
+            if untagged.get('CAPABILITY'):
+                conn.capabilities = tuple(
+                    untagged['CAPABILITY'][-1].decode().upper().split())
+        return conn
+
+    async def command(self, *args):
+        '''
+        Sends a command and waits for its tagged response, without
+        blocking other commands on this connection.
+        Returns: dict of untagged responses sent for the command, by
+                 type (eg. 'FETCH', 'SEARCH', 'UIDVALIDITY'), in the form
+                 imaplib returns their data.
+        '''
+        self.tag_num += 1
+        tag = f'A{self.tag_num:04d}'
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tag] = (future, {})
+        line = ' '.join((tag,) + args)
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await future
+
+    async def login(self, user, password):
+        return await self.command('LOGIN', _quote(user), _quote(password))
+
+    async def select(self, mailbox='INBOX'):
+        return await self.command('SELECT', _quote(mailbox))
+
+    async def uid(self, command, *args):
+        return await self.command('UID', command, *args)
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        except (AsyncIMAPError, ConnectionError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        self.writer.close()
+
+    async def _read_line(self):
+        '''Reads one response line, joining any literals into a list
+        like imaplib does: [(head, literal), ..., tail].
+        '''
+        parts = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('IMAP connection closed')
+            line = line.rstrip(b'\r\n')
+            found = LITERAL.search(line)
+            if found is None:
+                parts.append(line)
+                return parts
+            literal = await self.reader.readexactly(int(found.group(1)))
+            parts.append((line, literal))
+
+    async def _read_responses(self):
+        try:
+            while True:
+                parts = await self._read_line()
+                first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+                if first.startswith(b'* '):
+                    self._add_untagged(parts)
+                elif first.startswith(b'+'):
+                    continue
+                else:
+                    self._complete(first)
+        except (ConnectionError, asyncio.IncompleteReadError) as error:
+            for future, untagged in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(str(error)))
+            self.pending = {}
+
+    def _add_untagged(self, parts):
+        # Responses are sent in the order commands are completed, so they
+        # belong to the oldest command still waiting.
+        if len(self.pending) == 0:
+            return
+        untagged = next(iter(self.pending.values()))[1]
+        first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+        found = UNTAGGED.match(first)
+        if found is None:
+            return
+        num, kind, rest = found.groups()
+        kind = kind.decode('ascii')
+        for code in RESPONSE_CODE.finditer(rest):
+            untagged.setdefault(code.group(1).decode('ascii'), []).append(
+                code.group(2))
+
+        # Strip '* ' and the response type like imaplib
+        head = rest
+        if num is not None:
+            head = b' '.join((num, rest)) if rest else num
+        if isinstance(parts[0], tuple):
+            parts = [(head, parts[0][1])] + parts[1:]
+        else:
+            parts = [head] + parts[1:]
+        untagged.setdefault(kind, []).extend(parts)
+
+    def _complete(self, line):
+        tag, _, rest = line.partition(b' ')
+        tag = tag.decode('ascii')
+        if tag not in self.pending:
+            return
+        future, untagged = self.pending.pop(tag)
+        status = rest.split(b' ', 1)[0]
+        for code in RESPONSE_CODE.finditer(rest):
+            untagged.setdefault(code.group(1).decode('ascii'), []).append(
+                code.group(2))
+        if future.done():
+            return
+        if status != b'OK':
+            future.set_exception(AsyncIMAPError(rest.decode('utf-8',
+                                                            'replace')))
+        else:
+            future.set_result(untagged)
+## End class AsyncIMAPConnection ##
+
+def _quote(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+class AsyncEmailGetter(EmailGetter):
+    def __init__(self, print_func, bar_func=None, batch_size=500,
+                 headers_only=False, connect_func=None, pipeline=4,
+                 queue_size=1000, stream=False):
+        '''
+        Downloads emails like EmailGetter, but with one asyncio event
+        loop instead of a thread per connection.
+        Keyword arguments:
+        print_func -- An Application() class's put_msg function
+        bar_func -- An Application() class's add_bar function
+        batch_size -- The amount of messages requested by one UID FETCH
+                      command. (Default 500)
+        headers_only -- Whether to only download the ENVELOPE and
+                        BODYSTRUCTURE of messages. (Default False)
+        connect_func -- A coroutine function returning a logged in
+                        AsyncIMAPConnection. (Default logs in with the
+                        values of utils.get_config)
+        pipeline -- The amount of FETCH commands in flight at once on
+                    each connection. (Default 4)
+        queue_size -- The amount of downloaded messages that may wait
+                      to be processed before fetching pauses. (Default 1000)
+        stream -- Whether downloaded emails are only handed on through
+                  self.finished_queue. See EmailGetter. (Default False)
+        '''
+        self.active = True
+        self.cancelled = False
+        self.batch_size = max(1, batch_size)
+        self.headers_only = headers_only
+        self.connect_func = connect_func or self._connect
+        self.pipeline = max(1, pipeline)
+        self.queue_size = queue_size
+        self.stream = stream
+        self.finished_queue = Queue(STREAM_QUEUE_SIZE if stream else 0)
+        self.uids = []
+        self.downloaded = set()
+        self.failed = []
+        self.uid_lock = Lock()
+        self.print = print_func
+        self.bar = bar_func
+        self.emails = None
+        self.sync_state = None
+        self.loop = None
+        self.task = None
+
+    async def _connect(self):
+        config = utils.get_config()
+        conn = await AsyncIMAPConnection.open(config['imap'],
+                                              int(config['port']))
+        await conn.login(config['email'], config['pswrd'])
+        return conn
+
+    def _download(self, threads, since, state):
+        '''
+        Downloads new messages in an event loop. Blocks until finished or
+        until cancel() is called. See EmailGetter.get_emails_online for
+        the arguments; threads is the amount of connections opened.
+        '''
+        try:
+            return asyncio.run(self._sync(threads, since, state))
+        except asyncio.CancelledError:
+            self.print('Sync cancelled.')
+            return False
+        except (AsyncIMAPError, ConnectionError, OSError) as error:
+            self.print(f'Sync failed: {error}')
+            return False
+        finally:
+            # asyncio.run closed the loop, see cancel
+            self.loop = self.task = None
+
+    def cancel(self):
+        '''Stops a running sync. Safe to call from any thread.'''
+        self.cancelled = True
+        self.active = False
+        loop, task = self.loop, self.task
+        if loop is not None and task is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                # The loop closed meanwhile, the sync already finished
+                pass
+
+    async def _sync(self, connections, since, state):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        if not self.active:
+            raise asyncio.CancelledError()
+
+        self.print('Connecting...')
+        conn = await self.connect_func()
+        conns = [conn]
+        try:
+            selected = await conn.select('INBOX')
+            self.print(
+                'There are '
+                + str(_response_int(selected, 'EXISTS'))
+                + ' messages in INBOX'
+            )
+            uidvalidity = _response_int(selected, 'UIDVALIDITY')
+            highestmodseq = None
+            if 'CONDSTORE' in conn.capabilities:
+                highestmodseq = _response_int(selected, 'HIGHESTMODSEQ')
+            search_str = self._search_criteria(uidvalidity, highestmodseq,
+                                               state, since)
+            if search_str is None:
+                self.print('No new messages.')
+                return False
+
+            self.print('Searching messages... ')
+            uids = self._new_uids((await conn.uid('SEARCH', search_str))
+                                  .get('SEARCH'))
+            if len(uids) == 0:
+                self.print('No message response')
+                return False
+
+            msg_sets = make_message_sets(uids, self.batch_size)
+            extra = min(connections, len(msg_sets)) - 1
+            conns.extend(await asyncio.gather(
+                *(self.connect_func() for x in range(extra))))
+            await asyncio.gather(*(extra_conn.select('INBOX')
+                                   for extra_conn in conns[1:]))
+
+            self.print('Downloading messages -> ')
+            results = asyncio.Queue(self.queue_size)
+            msg_bar = 100 / len(uids)
+            fetchers = [
+                asyncio.ensure_future(self._fetch(fetch_conn, msg_sets,
+                                                  results, msg_bar))
+                for fetch_conn in conns for x in range(self.pipeline)
+            ]
+            consumer = asyncio.ensure_future(self._collect(results))
+            try:
+                await asyncio.gather(*fetchers)
+                await results.put(None)
+                await consumer
+            finally:
+                for task in fetchers + [consumer]:
+                    task.cancel()
+            self.print('Finished!')
+            return True
+        finally:
+            self.active = False
+            await asyncio.gather(*(done_conn.logout() for done_conn in conns),
+                                 return_exceptions=True)
+
+    async def _fetch(self, conn, msg_sets, results, inc_amt):
+        '''Runs FETCH commands on conn until msg_sets is empty.'''
+        items = HEADER_ITEMS if self.headers_only else '(UID RFC822)'
+        while len(msg_sets) > 0:
+            msg_set, msg_cnt = msg_sets.pop(0)
+            untagged = await conn.uid('FETCH', msg_set, items)
+            data = untagged.get('FETCH', [])
+            if self.headers_only:
+                for response in imap_parse.parse_fetch(data):
+                    await results.put(self._header_email(response))
+            else:
+                for msg_num, raw in parse_fetch_response(data):
+                    await results.put((LazyMessage(raw), msg_num))
+            self.print(f'Got messages {msg_set}')
+            if self.bar != None:
+                self.bar(inc_amt * msg_cnt)
+
+    async def _collect(self, results):
+        '''Hands downloaded messages from results on to finished_queue.'''
+        while True:
+            email = await results.get()
+            if email is None:
+                return
+            if self.stream:
+                # finished_queue is bounded and may block
+                await self.loop.run_in_executor(None, self._put_email, email)
+            else:
+                self._put_email(email)
+## End class AsyncEmailGetter ##
+
+def _response_int(untagged, code):
+    if not untagged.get(code):
+        return None
+    return int(untagged[code][-1])
@@ -31,4 +31,180 @@ CREATE TABLE profiles (
 );
 '''
 
+# Each item upgrades manager.db by one version (PRAGMA user_version).
+# New databases are created with SCHEMA and then run through all of them.
+MIGRATIONS = [
+'''CREATE TABLE IF NOT EXISTS mailboxes (
+    name TEXT PRIMARY KEY,
+    uidvalidity INTEGER NOT NULL,
+    last_uid INTEGER NOT NULL DEFAULT 0,
+    highestmodseq INTEGER
+);
+''',
+'''ALTER TABLE emails ADD COLUMN mailbox TEXT;
+ALTER TABLE emails ADD COLUMN uid INTEGER;
+ALTER TABLE emails ADD COLUMN size INTEGER;
+ALTER TABLE emails ADD COLUMN structure TEXT;
+ALTER TABLE emails ADD COLUMN fetched INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE files ADD COLUMN section TEXT;
+ALTER TABLE files ADD COLUMN fetched INTEGER NOT NULL DEFAULT 1;
+''',
+'''CREATE TABLE IF NOT EXISTS messages_store (
+    email_id INTEGER PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    compressed INTEGER NOT NULL,
+    FOREIGN KEY (email_id) REFERENCES emails (id)
+);
+''',
+'''CREATE TABLE IF NOT EXISTS message_parts (
+    email_id INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    type TEXT NOT NULL,
+    attachment INTEGER NOT NULL DEFAULT 0,
+    header_start INTEGER NOT NULL,
+    body_start INTEGER NOT NULL,
+    body_end INTEGER NOT NULL,
+    PRIMARY KEY (email_id, section),
+    FOREIGN KEY (email_id) REFERENCES emails (id)
+);
+''',
+'''CREATE INDEX IF NOT EXISTS emails_headers
+    ON emails (subject, created, to_address, from_address);
+''',
+'''ALTER TABLE emails ADD COLUMN message_key TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS emails_message_key ON emails (message_key);
+DROP INDEX IF EXISTS emails_headers;
+''',
+'''CREATE TABLE IF NOT EXISTS words (
+    id INTEGER PRIMARY KEY,
+    word TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS email_words (
+    email_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL,
+    word_ids BLOB NOT NULL,
+    FOREIGN KEY (email_id) REFERENCES emails (id)
+);
+''',
+'''ALTER TABLE emails ADD COLUMN generation INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS emails_generation ON emails (generation);
+CREATE TABLE IF NOT EXISTS searches (
+    id INTEGER PRIMARY KEY,
+    query_key TEXT NOT NULL UNIQUE,
+    token_version INTEGER NOT NULL,
+    generation INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS search_results (
+    search_id INTEGER NOT NULL,
+    email_id INTEGER NOT NULL,
+    PRIMARY KEY (search_id, email_id),
+    FOREIGN KEY (search_id) REFERENCES searches (id),
+    FOREIGN KEY (email_id) REFERENCES emails (id)
+);
+''',
+'''CREATE TABLE IF NOT EXISTS tag_rules (
+    id INTEGER PRIMARY KEY,
+    query_key TEXT NOT NULL UNIQUE,
+    terms TEXT NOT NULL,
+    subject INTEGER NOT NULL,
+    to_ln INTEGER NOT NULL,
+    from_ln INTEGER NOT NULL,
+    all_match INTEGER NOT NULL,
+    tags TEXT NOT NULL
+);
+''',
+# Moves the comma separated emails.tags strings into tags/email_tags.
+# Tags of the data.json tag list are moved by EmailDatabase._migrate_tags.
+'''CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    folder INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS email_tags (
+    tag_id INTEGER NOT NULL,
+    email_id INTEGER NOT NULL,
+    PRIMARY KEY (tag_id, email_id),
+    FOREIGN KEY (tag_id) REFERENCES tags (id),
+    FOREIGN KEY (email_id) REFERENCES emails (id)
+);
+CREATE INDEX IF NOT EXISTS email_tags_email ON email_tags (email_id);
+CREATE TEMP TABLE split_tags AS
+    WITH RECURSIVE split (email_id, name, rest) AS (
+        SELECT id, '', tags || ',' FROM emails WHERE tags IS NOT NULL
+        UNION ALL
+        SELECT email_id, substr(rest, 1, instr(rest, ',') - 1),
+               substr(rest, instr(rest, ',') + 1)
+        FROM split WHERE rest != ''
+    )
+    SELECT email_id, name FROM split WHERE trim(name) != '';
+INSERT OR IGNORE INTO tags (name) SELECT name FROM split_tags ORDER BY rowid;
+INSERT OR IGNORE INTO email_tags (tag_id, email_id)
+    SELECT tags.id, split_tags.email_id
+    FROM split_tags JOIN tags ON tags.name = split_tags.name;
+DROP TABLE split_tags;
+UPDATE emails SET tags = NULL;
+''',
+'''CREATE INDEX IF NOT EXISTS emails_created ON emails (created, id);
+CREATE INDEX IF NOT EXISTS files_email ON files (email_lk);
+''',
+# Copies emails.created into email_tags, so the emails of a tag are paged
+# by date through email_tags_created (see EmailDatabase.list_emails).
+# emails.created never changes once an email is saved.
+'''ALTER TABLE email_tags ADD COLUMN created TIMESTAMP;
+UPDATE email_tags SET created = (
+    SELECT emails.created FROM emails WHERE emails.id = email_tags.email_id
+);
+CREATE INDEX IF NOT EXISTS email_tags_created
+    ON email_tags (tag_id, created, email_id);
+CREATE TRIGGER IF NOT EXISTS email_tags_insert AFTER INSERT ON email_tags
+BEGIN
+    UPDATE email_tags SET created = (
+        SELECT emails.created FROM emails WHERE emails.id = NEW.email_id
+    ) WHERE tag_id = NEW.tag_id AND email_id = NEW.email_id;
+END;
+''',
+]
+
+# Full text index of emails, keyed by emails.id (its rowid). Created
+# outside of MIGRATIONS as SQLite may be built without FTS5.
+FTS_SCHEMA = '''CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+    subject,
+    to_address,
+    from_address,
+    body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts_vocab
+    USING fts5vocab(emails_fts, 'col');
+'''
+
+# Whether syncs only download headers and BODYSTRUCTURE first, leaving
+# bodies and attachments to be downloaded when they are needed.
+HEADERS_FIRST = True
+
+# The amount of searches whose results are kept in manager.db. The least
+# recently used searches are removed first.
+SEARCH_CACHE_SIZE = 50
+
+# The most jobs (syncs, searches, tagging...) running at once, see
+# event_bus.EventBus.schedule. Jobs waiting for a worker run by priority.
+JOB_WORKERS = 3
+
+# The amount of rendered emails the email viewer keeps, so selecting a
+# recently shown email again does not decode it again.
+RENDER_CACHE_SIZE = 20
+
+# Whether the message store compresses emails. Parts of uncompressed
+# emails are read straight from the mapped segment files, compressed
+# emails are only decompressed up to the parts that are read.
+COMPRESS_STORE = True
+
+# Whether syncs use the asyncio engine (async_conn.AsyncEmailGetter)
+# instead of a thread per IMAP connection.
+ASYNC_ENGINE = False
+
 VERSION='0.0.7'
\ No newline at end of file
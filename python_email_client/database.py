@@ -1,3 +1,4 @@
+from array import array
 import email.utils
 import time
 import sys
@@ -7,21 +8,36 @@ import utils
 import sqlite3
 import shutil
 import stat
+from threading import RLock
 from datetime import datetime
+from email.errors import HeaderParseError
+from email.header import decode_header, make_header
 import json
+import re
+import unicodedata
 import tkinter as tk
 import tkinter.messagebox
 
 # Own functions
 import config
+from fuzzy import FuzzyIndex
+import imap_parse
+import parse_mail
+from message_store import MessageStore, raw_bytes
+
+# Words of a text as the unicode61 tokenizer of emails_fts splits it
+FTS_WORD = re.compile(r'[^\W_]+')
 
 class EmailDatabase():
-    def __init__(self, print_func=None, bar_func=None):
+    def __init__(self, print_func=None, bar_func=None, alert_func=None):
         '''
         Initializes an email database.
         Keyword arguments:
             print_func -- a method outputting information to a window
             bar_func -- a method that adds an amount to a ttk.progressBar
+            alert_func -- a method (title, message) showing an error to
+                          the user. Called from worker threads.
+                          (Default tkinter.messagebox.showerror)
         '''
         # Different paths
         self.system_path = utils.get_store_path()
@@ -32,10 +48,13 @@ class EmailDatabase():
         if not os.path.exists(self.resource_path):
             os.makedirs(self.resource_path)
 
+        # Pickled emails of older versions, moved into the message store
         self.save_path = os.path.join(self.system_path, 'resources/saved/')
         if not os.path.exists(self.save_path):
             os.makedirs(self.save_path)
 
+        self.store_path = os.path.join(self.system_path, 'resources/store/')
+
         self.attach_path = os.path.join(self.system_path, 'resources/attach/')
         if not os.path.exists(self.attach_path):
             os.makedirs(self.attach_path)
@@ -44,7 +63,21 @@ class EmailDatabase():
         self.json_path = os.path.join(self.resource_path, 'data.json')
 
         # Functions and DB objects
+        # Threads share self.manager, so every write transaction holds
+        # self.lock until it committed or rolled back
+        self.lock = RLock()
         self.manager = self._load_db() # sqlite3 db connection
+        self.fts = self._create_fts() # Whether emails_fts can be used
+        self.fuzzy = None # FuzzyIndex of the indexed body words
+        self.words = None # {id: word} of the words table, once loaded
+        self.word_ids = None # {word: id} of the words table
+        self.tag_rules = None # [(tags, SearchQuery, subject, to_ln, from_ln)]
+        self.store = MessageStore(self.manager, self.store_path,
+                                  config.COMPRESS_STORE)
+        # Function (mailbox, uid, sections) -> email.message.Message of
+        # the given body parts, used to download bodies of emails saved
+        # from a headers only sync. None when offline.
+        self.body_func = None
 
         # If any functions not provided, default all to standard print func.
         if print_func == bar_func == None:
@@ -53,8 +86,15 @@ class EmailDatabase():
         else:
             self.print = print_func
             self.bar = bar_func
+        if alert_func is None:
+            alert_func = tk.messagebox.showerror
+        self.alert = alert_func
 
         self.last_date = self._load_last_date()
+        self._migrate_tags()
+        self._migrate_pickles()
+        self._add_message_keys()
+        self.index_emails()
 
     def _load_db(self):
         '''
@@ -68,35 +108,537 @@ class EmailDatabase():
                 check_same_thread=False
             )
             db.row_factory = sqlite3.Row
+            # Commits in WAL mode with synchronous=NORMAL do not wait for
+            # the disk, only checkpoints do
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+            self._migrate_db(db)
             return db
         else:
             with open(self.database_path, 'x') as f:
                 pass
-            db = self._load_db()
-            with open('schema.sql', 'r') as f:
-                db.executescript(schema.SCHEMA)
+            db = sqlite3.connect(
+                self.database_path,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                check_same_thread=False
+            )
+            db.executescript(config.SCHEMA)
             db.commit()
-            return db
+            db.close()
+            return self._load_db()
+
+    def _migrate_db(self, db):
+        '''
+        Brings the database db up to date by running every script of
+        config.MIGRATIONS that it has not run yet.
+        '''
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        for number, script in enumerate(config.MIGRATIONS[version:],
+                                        version + 1):
+            db.executescript(script)
+            db.execute(f'PRAGMA user_version = {number}')
+            db.commit()
+
+    def _create_fts(self):
+        '''
+        Creates the emails_fts full text index if it does not exist.
+        Returns: False if SQLite was built without FTS5, True otherwise
+        '''
+        try:
+            self.manager.executescript(config.FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            return False
+        self.manager.commit()
+        return True
 
     def reset_db(self):
         '''Resets the database. Deletes all database contents.'''
-        self.print('Resetting...')
-        self.manager = None
-        os.remove(self.database_path)
-        if os.path.exists(self.json_path):
-            os.remove(self.json_path)
-        shutil.rmtree(self.save_path)
-        os.chmod(self.resource_path, stat.S_IWUSR)
-        os.mkdir(self.save_path)
-        os.chmod(self.save_path, stat.S_IWUSR)
-        shutil.rmtree(self.attach_path)
-        os.mkdir(self.attach_path)
-        os.chmod(self.attach_path, stat.S_IWUSR)
+        with self.lock:
+            self.print('Resetting...')
+            if self.manager is not None:
+                self.manager.close()
+            self.manager = None
+            self.words = self.word_ids = None
+            self.tag_rules = None
+            os.remove(self.database_path)
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(self.database_path + suffix):
+                    os.remove(self.database_path + suffix)
+            if os.path.exists(self.json_path):
+                os.remove(self.json_path)
+            shutil.rmtree(self.save_path)
+            os.chmod(self.resource_path, stat.S_IWUSR)
+            os.mkdir(self.save_path)
+            os.chmod(self.save_path, stat.S_IWUSR)
+            shutil.rmtree(self.attach_path)
+            os.mkdir(self.attach_path)
+            os.chmod(self.attach_path, stat.S_IWUSR)
+            self.store.close()
+            if os.path.exists(self.store_path):
+                shutil.rmtree(self.store_path)
 
         if os.path.exists(os.path.join(self.resource_path, 'temp/data.html')):
             os.remove(os.path.join(self.resource_path, 'temp/data.html'))
         self.print('Resetted database.')
 
+    def _migrate_pickles(self):
+        '''
+        Moves emails pickled into self.save_path by older versions into
+        the message store as raw RFC822 bytes. Files are removed once
+        they are stored, files that cannot be read are left in place.
+        '''
+        pickles = [name for name in os.listdir(self.save_path)
+                   if name.endswith('.pkl')]
+        if len(pickles) == 0:
+            return False
+
+        self.print('Moving saved emails into the message store...')
+        moved = []
+        for name in pickles:
+            file_path = os.path.join(self.save_path, name)
+            try:
+                email_id = int(os.path.splitext(name)[0])
+                with open(file_path, 'rb') as f:
+                    email = pickle.load(f)
+                self.store.put(email_id, raw_bytes(email[0]))
+            except Exception as error:
+                self.print(f'Skipping saved email {name}: {error}')
+                continue
+            moved.append(file_path)
+            if len(moved) >= 200:
+                self._remove_moved(moved)
+        self._remove_moved(moved)
+        self.print('Finished.')
+        return True
+
+    def _remove_moved(self, moved):
+        '''Commits the pickled emails moved into the store and removes
+        their files, so they are not moved twice.
+        '''
+        self.manager.commit()
+        for file_path in moved:
+            os.remove(file_path)
+        moved.clear()
+
+    def _add_message_keys(self):
+        '''
+        Fills in the message_key column of emails saved by older versions.
+        Emails with the same key as an email saved before them are kept,
+        with a key made from their id.
+        '''
+        email_refs = self.manager.execute(
+            'SELECT id, subject, created, to_address, from_address'
+            ' FROM emails WHERE message_key IS NULL ORDER BY id'
+        ).fetchall()
+        if len(email_refs) == 0:
+            return False
+
+        self.print('Adding message keys to saved emails...')
+        used = set(row[0] for row in self.manager.execute(
+            'SELECT message_key FROM emails WHERE message_key IS NOT NULL'
+        ))
+        keys = []
+        for ref in email_refs:
+            try:
+                key = utils.message_key(self.store.get(ref['id']))
+            except (KeyError, TypeError):
+                # Not stored, or stored without a usable Date header
+                key = utils.header_key(ref['subject'], ref['created'],
+                                       ref['to_address'],
+                                       ref['from_address'])
+            if key in used:
+                key = f'id:{ref["id"]}'
+            used.add(key)
+            keys.append((key, ref['id']))
+        self.manager.executemany(
+            'UPDATE emails SET message_key = ? WHERE id = ?',
+            keys
+        )
+        self.manager.commit()
+        self.print('Finished.')
+        return True
+
+    def _fts_row(self, email_id, message):
+        '''Returns the emails_fts values of an email.message.Message.'''
+        values = []
+        for name in ('Subject', 'To', 'From'):
+            try:
+                values.append(str(make_header(decode_header(
+                    message.get(name, '')))))
+            except (HeaderParseError, LookupError, UnicodeError):
+                values.append(str(message.get(name, '')))
+        return (email_id, *values, parse_mail.get_text(message))
+
+    def _index_messages(self, messages):
+        '''
+        Adds (email_id, message) tuples to the full text index, replacing
+        what was indexed for them before. Does not commit.
+        '''
+        if not self.fts:
+            return
+        self.fuzzy = None
+        rows = [self._fts_row(email_id, message)
+                for email_id, message in messages]
+        self.manager.executemany(
+            'DELETE FROM emails_fts WHERE rowid = ?',
+            [(row[0],) for row in rows]
+        )
+        self.manager.executemany(
+            'INSERT INTO emails_fts'
+            ' (rowid, subject, to_address, from_address, body)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            rows
+        )
+
+    def index_emails(self, batch_size=500):
+        '''
+        Adds saved emails that are missing from the full text index, such
+        as emails saved by older versions.
+        '''
+        if not self.fts:
+            return False
+        email_refs = self.manager.execute(
+            'SELECT id FROM emails'
+            ' WHERE id NOT IN (SELECT rowid FROM emails_fts)'
+        ).fetchall()
+        if len(email_refs) == 0:
+            return False
+
+        self.print('Indexing saved emails...')
+        for index in range(0, len(email_refs), batch_size):
+            messages = []
+            for ref in email_refs[index:index + batch_size]:
+                try:
+                    messages.append((ref[0], self.store.get(ref[0])))
+                except KeyError:
+                    continue
+            with self.lock:
+                self._index_messages(messages)
+                self.manager.commit()
+        self.print('Finished.')
+        return True
+
+    def email_count(self, tags=None):
+        '''
+        Returns the amount of saved emails, or of the emails with a tag
+        in the 'tag1,tag2' string tags.
+        '''
+        if tags is None:
+            return self.manager.execute(
+                'SELECT COUNT(*) FROM emails'
+            ).fetchone()[0]
+        names = [ x for x in tags.split(',') if not x.isspace() and x != '' ]
+        return self.manager.execute(
+            'SELECT COUNT(DISTINCT email_tags.email_id)'
+            ' FROM tags JOIN email_tags ON email_tags.tag_id = tags.id'
+            f' WHERE tags.name IN ({",".join("?" * len(names))})',
+            names
+        ).fetchone()[0]
+
+    def _fuzzy_index(self):
+        '''
+        Returns the FuzzyIndex of the words in the bodies of indexed
+        emails, building it if emails were indexed since the last search.
+        '''
+        if self.fuzzy is None:
+            self.fuzzy = FuzzyIndex(row[0] for row in self.manager.execute(
+                "SELECT term FROM emails_fts_vocab WHERE col = 'body'"
+            ))
+        return self.fuzzy
+
+    def search_emails(self, search_terms, subject, to_ln, from_ln,
+                      all_match=False, since_generation=None):
+        '''
+        Searches the full text index: an email matches if the terms match
+        its subject, to or from line (if searched) or its text. Terms
+        match words they are the start of, and in the text also words
+        they fuzzy match (see fuzzy.py). Unlike parse_mail.SearchQuery,
+        which finds terms anywhere in the text, a term does not match
+        inside a word: 'mail' matches 'mailbox' but not 'gmail'. Text is
+        split into words at punctuation too, so 'mail.com' is the words
+        'mail' and 'com'. Results of the two can differ for the same
+        terms.
+        Keyword arguments:
+        search_terms -- a list of search values (as strings)
+        subject -- whether to search in the subject lines of emails
+        to_ln -- whether to search in the to lines of emails
+        from_ln -- whether to search in the from lines of emails
+        all_match -- whether all search terms must match, each in any of
+                     the searched fields. (Default False)
+        since_generation -- only search emails saved or changed after
+                            this generation (see generation()).
+                            (Default None, all emails)
+        Returns: list of dicts with the 'Subject', 'Date', 'To', 'From'
+                 and 'Key' of matching emails (see tag_emails) and their
+                 'id'.
+        '''
+        query = self._fts_query(search_terms, subject, to_ln, from_ln,
+                                all_match)
+        if query is None:
+            return []
+
+        rows = self.manager.execute(
+            'SELECT emails.id, emails.subject, emails.created,'
+            ' emails.to_address, emails.from_address, emails.message_key'
+            ' FROM emails_fts JOIN emails ON emails.id = emails_fts.rowid'
+            ' WHERE emails_fts MATCH ? AND emails.generation > ?',
+            (query, -1 if since_generation is None else since_generation)
+        ).fetchall()
+        return [{'id': row['id'], 'Subject': row['subject'],
+                 'Date': row['created'], 'To': row['to_address'],
+                 'From': row['from_address'], 'Key': row['message_key']}
+                for row in rows]
+
+    def _fts_query(self, search_terms, subject, to_ln, from_ln, all_match,
+                   fuzzy=None):
+        '''
+        Returns the emails_fts MATCH query of a search (see
+        search_emails), or None if it has no search terms.
+        fuzzy -- the FuzzyIndex of the words terms may fuzzy match
+                 (Default the words of all indexed emails)
+        '''
+        search_terms = [term for term in search_terms if term.strip() != '']
+        if len(search_terms) == 0:
+            return None
+        headers = ' '.join(column for column, searched in (
+            ('subject', subject), ('to_address', to_ln),
+            ('from_address', from_ln)) if searched)
+
+        # Each term matches its prefix in a searched header or the text,
+        # or any word of the text it fuzzy matches
+        if fuzzy is None:
+            fuzzy = self._fuzzy_index()
+        groups = []
+        for term in search_terms:
+            prefix = _fts_phrase(term) + '*'
+            body = ' OR '.join([prefix] + [_fts_phrase(word)
+                                           for word in fuzzy.match(term)])
+            group = f'{{body}} : ({body})'
+            if headers != '':
+                group = f'{{{headers}}} : {prefix} OR {group}'
+            groups.append(f'({group})')
+        return (' AND ' if all_match else ' OR ').join(groups)
+
+    def _load_words(self):
+        if self.words is None:
+            self.words = dict(self.manager.execute(
+                'SELECT id, word FROM words'
+            ).fetchall())
+            self.word_ids = {word: word_id
+                             for word_id, word in self.words.items()}
+        return self.words
+
+    def _save_words(self, email_id, words):
+        '''
+        Caches the get_tokens() words of an email as an array of ids into
+        the words table. Does not commit.
+        '''
+        self._load_words()
+        word_ids = array('I')
+        for word in words:
+            if word not in self.word_ids:
+                word_id = self.manager.execute(
+                    'INSERT INTO words (word) VALUES (?)',
+                    (word,)
+                ).lastrowid
+                self.word_ids[word] = word_id
+                self.words[word_id] = word
+            word_ids.append(self.word_ids[word])
+        self.manager.execute(
+            'INSERT OR REPLACE INTO email_words (email_id, version, word_ids)'
+            ' VALUES (?, ?, ?)',
+            (email_id, parse_mail.TOKEN_VERSION, word_ids.tobytes())
+        )
+
+    def cache_tokens(self, email_ids, cancel=None):
+        '''
+        Extracts the parse_mail.get_tokens() words of the emails with the
+        ids email_ids into the email_words cache, if they were not cached
+        yet or were cached by another parse_mail.TOKEN_VERSION.
+        cancel -- an event_bus.CancelToken checked between every 200
+                  emails, the words cached until then are kept
+                  (Default None)
+        '''
+        cached = set(row[0] for row in self.manager.execute(
+            'SELECT email_id FROM email_words WHERE version = ?',
+            (parse_mail.TOKEN_VERSION,)
+        ))
+        missing = [email_id for email_id in email_ids
+                   if email_id not in cached]
+        if len(missing) == 0:
+            return False
+
+        self.print('Caching words of emails...')
+        for index in range(0, len(missing), 200):
+            if cancel is not None:
+                cancel.check()
+            with self.lock:
+                for email_id in missing[index:index + 200]:
+                    try:
+                        message = self.store.get(email_id)
+                    except KeyError:
+                        continue
+                    self._save_words(email_id,
+                                     parse_mail.get_tokens(message))
+                self.manager.commit()
+        return True
+
+    def get_tokens(self, email_ids):
+        '''
+        Returns the parse_mail.get_tokens() words of emails as a dict
+        {email_id: [word, ...]}, read from the email_words cache (see
+        cache_tokens).
+        '''
+        self.cache_tokens(email_ids)
+        words = self._load_words()
+        tokens = {}
+        for index in range(0, len(email_ids), 500):
+            chunk = email_ids[index:index + 500]
+            rows = self.manager.execute(
+                'SELECT email_id, word_ids FROM email_words'
+                ' WHERE version = ? AND email_id IN'
+                f' ({",".join("?" * len(chunk))})',
+                [parse_mail.TOKEN_VERSION] + list(chunk)
+            ).fetchall()
+            for email_id, word_ids in rows:
+                ids = array('I')
+                ids.frombytes(word_ids)
+                tokens[email_id] = [words[word_id] for word_id in ids]
+        return tokens
+
+    def get_email_ids(self, since_generation=None):
+        '''
+        Returns the ids of all saved emails, or of the emails saved or
+        changed after the generation since_generation.
+        '''
+        return [row[0] for row in self.manager.execute(
+            'SELECT id FROM emails WHERE generation > ? ORDER BY id',
+            (-1 if since_generation is None else since_generation,)
+        )]
+
+    def generation(self):
+        '''
+        Returns the generation of the saved emails. Every batch of saved
+        emails and every downloaded body makes a new generation, stored
+        in the generation column of the emails it saved or changed.
+        '''
+        return self.manager.execute(
+            'SELECT MAX(generation) FROM emails'
+        ).fetchone()[0] or 0
+
+    def cached_search(self, search_terms, subject, to_ln, from_ln,
+                      all_match, search_func, engine=''):
+        '''
+        Returns the results of a search from the searches cache, only
+        searching the emails saved or changed since it was cached.
+        Keyword arguments:
+        search_terms, subject, to_ln, from_ln, all_match -- see
+            search_emails
+        search_func -- a function (since_generation) returning the
+                       results of the search among the emails saved or
+                       changed after since_generation (None for all
+                       emails), as dicts with an 'id' (see search_emails)
+        engine -- the name of the search method, part of the cache key
+                  (Default '')
+        Returns: list of dicts like search_emails
+        '''
+        terms = sorted(set(term for term in search_terms
+                           if term.strip() != ''))
+        query_key = json.dumps([engine, terms, bool(subject), bool(to_ln),
+                                bool(from_ln), bool(all_match)])
+        generation = self.generation()
+        cached = self.manager.execute(
+            'SELECT id, token_version, generation FROM searches'
+            ' WHERE query_key = ?',
+            (query_key,)
+        ).fetchone()
+
+        current = (cached is not None
+                   and cached['token_version'] == parse_mail.TOKEN_VERSION)
+        # Searched without the lock, so emails can be saved meanwhile
+        found = None
+        if not current:
+            found = search_func(None)
+        elif cached['generation'] < generation:
+            self.print('Updating cached search...')
+            found = search_func(cached['generation'])
+
+        with self.lock:
+            try:
+                if current:
+                    search_id = cached['id']
+                    if found is not None:
+                        self.manager.execute(
+                            'DELETE FROM search_results WHERE search_id = ?'
+                            ' AND email_id IN'
+                            ' (SELECT id FROM emails WHERE generation > ?)',
+                            (search_id, cached['generation'])
+                        )
+                        self._save_results(search_id, found)
+                else:
+                    if cached is not None:
+                        self.manager.execute(
+                            'DELETE FROM search_results WHERE search_id = ?',
+                            (cached['id'],)
+                        )
+                    search_id = self.manager.execute(
+                        'INSERT OR REPLACE INTO searches'
+                        ' (id, query_key, token_version, generation,'
+                        ' last_used) VALUES (?, ?, ?, ?, ?)',
+                        (None if cached is None else cached['id'],
+                         query_key, parse_mail.TOKEN_VERSION, generation,
+                         time.time())
+                    ).lastrowid
+                    self._save_results(search_id, found)
+
+                self.manager.execute(
+                    'UPDATE searches SET generation = ?, last_used = ?'
+                    ' WHERE id = ?',
+                    (generation, time.time(), search_id)
+                )
+                self._evict_searches()
+                self.manager.commit()
+            except Exception:
+                self.manager.rollback()
+                raise
+
+        rows = self.manager.execute(
+            'SELECT emails.id, emails.subject, emails.created,'
+            ' emails.to_address, emails.from_address, emails.message_key'
+            ' FROM search_results JOIN emails'
+            ' ON emails.id = search_results.email_id'
+            ' WHERE search_results.search_id = ?',
+            (search_id,)
+        ).fetchall()
+        return [{'id': row['id'], 'Subject': row['subject'],
+                 'Date': row['created'], 'To': row['to_address'],
+                 'From': row['from_address'], 'Key': row['message_key']}
+                for row in rows]
+
+    def _save_results(self, search_id, found):
+        self.manager.executemany(
+            'INSERT OR IGNORE INTO search_results (search_id, email_id)'
+            ' VALUES (?, ?)',
+            [(search_id, result['id']) for result in found]
+        )
+
+    def _evict_searches(self):
+        '''Removes the least recently used searches past SEARCH_CACHE_SIZE.'''
+        old = self.manager.execute(
+            'SELECT id FROM searches ORDER BY last_used DESC'
+            ' LIMIT -1 OFFSET ?',
+            (config.SEARCH_CACHE_SIZE,)
+        ).fetchall()
+        for row in old:
+            self.manager.execute(
+                'DELETE FROM search_results WHERE search_id = ?',
+                (row[0],)
+            )
+            self.manager.execute(
+                'DELETE FROM searches WHERE id = ?',
+                (row[0],)
+            )
+
     def save_last_date(self, date):
         '''
         Save a datetime.datetime object as a string POSIX timestamp.
@@ -137,17 +679,61 @@ class EmailDatabase():
         except FileNotFoundError:
             return None
 
+    def get_sync_state(self, mailbox='INBOX'):
+        '''
+        Returns the stored IMAP sync state of a mailbox as a dict with
+        the 'uidvalidity', 'last_uid' and 'highestmodseq' keys, or None
+        if the mailbox was never synchronized.
+        '''
+        state = self.manager.execute(
+            'SELECT uidvalidity, last_uid, highestmodseq FROM mailboxes'
+            ' WHERE name = ?',
+            (mailbox,)
+        ).fetchone()
+        if state is None:
+            return None
+        return dict(state)
+
+    def save_sync_state(self, mailbox, uidvalidity, last_uid,
+                        highestmodseq=None):
+        '''
+        Saves the IMAP sync state of a mailbox after a sync.
+        Keyword arguments:
+        mailbox -- the name of the mailbox, eg. 'INBOX'
+        uidvalidity -- the UIDVALIDITY value of the mailbox
+        last_uid -- the highest UID that was downloaded
+        highestmodseq -- the HIGHESTMODSEQ value of the mailbox, or None
+                         if the server does not support CONDSTORE.
+        '''
+        if uidvalidity is None:
+            return False
+        with self.lock:
+            self.manager.execute(
+                'INSERT OR REPLACE INTO mailboxes'
+                ' (name, uidvalidity, last_uid, highestmodseq)'
+                ' VALUES (?, ?, ?, ?)',
+                (mailbox, uidvalidity, last_uid, highestmodseq)
+            )
+            self.manager.commit()
+        return True
+
     def get_datestr(self): 
         if self.last_date == None:
             return None
         else:
             return self.last_date.strftime('%d-%b-%Y')
 
-    def save_emails(self, email_list):
+    def save_emails(self, email_list, batch_size=500, cancel=None):
         '''
         Keyword arguments:
         email_list -- The EmailGetter() class's self.emails method, 
-                      a list of email tuples of format (message, num)
+                      a list of email tuples of format (message, num),
+                      or (message, num, summary) for emails of a headers
+                      only sync (see EmailGetter._header_email).
+        batch_size -- the amount of emails saved per transaction
+                      (Default 500)
+        cancel -- an event_bus.CancelToken checked between batches, the
+                  batches saved until then are kept (Default None)
         '''
         self.print('Saving emails...')
         if len(email_list) == 0:
@@ -155,84 +741,193 @@ class EmailDatabase():
             return False
 
         email_amt = 100 / len(email_list)
-        for email in email_list:
-            # Get header values
-            subject = email[0].get('Subject')
-            if subject is None:
-                subject = 'No subject provided...'
-            date = utils.email_to_datetime(email[0].get('Date'))
-            to_line = email[0].get('To')
-            from_line = email[0].get('From')
-
-            if (not (isinstance(subject, str)
-                    and isinstance(date, datetime)
-                    and isinstance(to_line, str)
-                    and isinstance(from_line, str))):
-                # Check if all inputs are correct
-                tk.messagebox.showerror('Error', 'Aborting... connection error. Resetting.')
-                self.print('Aborting... connection error. Resetting.')
-                self.reset_db()
+        for index in range(0, len(email_list), batch_size):
+            if cancel is not None:
+                cancel.check()
+            batch = email_list[index:index + batch_size]
+            if self._save_batch(batch) is None:
                 return False
-            
-            exists = self.manager.execute(
-                'SELECT * FROM emails'
-                ' WHERE subject = ? AND created = ?'
-                ' AND to_address = ? AND from_address = ?',
-                (subject, date, to_line, from_line)
-            ).fetchone()
+            if self.bar != None:
+                self.bar(email_amt * len(batch))
 
-            if exists is None: # only get new emails
-                self.manager.execute(
-                    'INSERT INTO emails'
-                    ' (subject, created, to_address, from_address, read)'
-                    ' VALUES (?, ?, ?, ?, ?)',
-                    (subject, date, to_line, from_line, 0),
-                )
-                self.manager.commit()
-                mail_id = self.manager.execute(
-                    'SELECT last_insert_rowid() FROM emails'
-                ).fetchone()
-                mail_path = os.path.join(
-                    self.save_path,
-                    "".join( (str(mail_id[0]), '.pkl') )
-                )
-                with open(mail_path, 'wb') as out:
-                    pickle.dump(email, out, pickle.HIGHEST_PROTOCOL)
+        self.print('Finished')
 
-                # Also save potential attachments
-                for part in email[0].walk():
-                    if part.get_content_maintype() == 'multipart':
-                        continue
-                    if not part.get('Content-Disposition'):
-                        continue
+    def save_email_stream(self, email_queue, batch_size=200, cancel=None):
+        '''
+        Saves emails from a queue as they arrive, in one transaction per
+        batch_size emails, until None is taken from the queue. Meant to
+        run in its own thread while an EmailGetter(stream=True) fills
+        its finished_queue.
+        Keyword arguments:
+        email_queue -- a queue.Queue of email tuples, see save_emails
+        batch_size -- the amount of emails saved per transaction
+                      (Default 200)
+        cancel -- an event_bus.CancelToken. Once it is cancelled, the
+                  emails still arriving are not saved, but the queue is
+                  emptied until None so the download can finish.
+                  (Default None)
+        If a batch cannot be saved, the emails after it are not saved
+        either, but the queue is still emptied until None.
+        Returns: the amount of emails saved, or None if saving was
+                 cancelled or aborted
+        '''
+        self.print('Saving emails...')
+        saved = 0
+        batch = []
+        aborted = False
+        while True:
+            email = email_queue.get()
+            if cancel is not None and cancel.cancelled:
+                aborted = True
+                batch = []
+            if email is not None and not aborted:
+                batch.append(email)
+            if len(batch) >= batch_size or (email is None and batch):
+                try:
+                    result = self._save_batch(batch)
+                except Exception as error:
+                    self.alert('Error', f'Could not save emails: {error}')
+                    self.print(f'Could not save emails: {error}')
+                    result = None
+                batch = []
+                if result is None:
+                    # Keep emptying the queue so the downloads can finish
+                    aborted = True
+                else:
+                    saved += result
+                    self.print(f'Saved {saved} emails...')
+            if email is None:
+                break
 
-                    if part.get_filename() is None:
-                        continue
-                    elif part.get_filename().isspace() or part.get_filename() == '':
-                        continue
+        if aborted:
+            self.print(f'Stopped saving after {saved} emails.')
+            return None
+        self.print(f'Finished saving {saved} emails.')
+        return saved
 
-                    filename, file_ext = os.path.splitext(part.get_filename())
-                    self.manager.execute(
-                        'INSERT INTO files (filename, extension, email_lk)'
-                        ' VALUES (?, ?, ?)',
-                        (filename, file_ext, mail_id[0]),
-                    )
-                    self.manager.commit()
-                    
-                    file_id = self.manager.execute(
-                        'SELECT last_insert_rowid() FROM files'
-                    ).fetchone()
-                    file_path = os.path.join(
-                        self.attach_path,
-                        ''.join( (str(file_id[0]), file_ext) )
+    def _email_row(self, email):
+        '''
+        Returns the (subject, created, to_address, from_address,
+        message_key) values of an email tuple, or None if its headers are
+        missing.
+        '''
+        subject = email[0].get('Subject')
+        if subject is None:
+            subject = 'No subject provided...'
+        date = utils.email_to_datetime(email[0].get('Date'))
+        to_line = email[0].get('To')
+        from_line = email[0].get('From')
+
+        if (not (isinstance(subject, str)
+                and isinstance(date, datetime)
+                and isinstance(to_line, str)
+                and isinstance(from_line, str))):
+            return None
+        return (subject, date, to_line, from_line,
+                utils.message_key(email[0]))
+
+    def _save_batch(self, emails):
+        '''
+        Saves a list of email tuples (see save_emails) in one transaction.
+        Emails that were already saved are skipped.
+        Returns: the amount of emails saved, or None if an email was
+                 invalid and the database was reset.
+        '''
+        rows = [self._email_row(email) for email in emails]
+        if None in rows:
+            # Check if all inputs are correct
+            self.alert('Error', 'Aborting... connection error. Resetting.')
+            self.print('Aborting... connection error. Resetting.')
+            self.reset_db()
+            return None
+
+        with self.lock:
+            cursor = self.manager.cursor()
+            try:
+                saved = []
+                generation = self.generation() + 1
+                for email, row in zip(emails, rows):
+                    summary = email[2] if len(email) > 2 else None
+                    if summary is not None:
+                        read = int('\\Seen' in summary['flags'])
+                        size = summary['size']
+                        structure = json.dumps(summary['parts'])
+                    else:
+                        read = 0
+                        size = None
+                        structure = None
+                    # Emails that were already saved are skipped by the unique
+                    # index on message_key
+                    cursor.execute(
+                        'INSERT INTO emails'
+                        ' (subject, created, to_address, from_address,'
+                        ' message_key, read, mailbox, uid, size, structure,'
+                        ' fetched, generation)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                        ' ON CONFLICT (message_key) DO NOTHING',
+                        row + (read, 'INBOX', int(email[1]), size, structure,
+                               int(summary is None), generation),
                     )
-                    with open(file_path, 'wb') as out:
-                        out.write(part.get_payload(decode=1))
+                    if cursor.rowcount == 0:
+                        continue
+                    saved.append((cursor.lastrowid, email, summary))
 
-            if self.bar != None:
-                self.bar(email_amt)
+                self.store.put_many([(mail_id, raw_bytes(email[0]))
+                                     for mail_id, email, summary in saved])
 
-        self.print('Finished')
+                # Attachments of headers only syncs are downloaded by
+                # fetch_attachments
+                cursor.executemany(
+                    'INSERT INTO files (filename, extension,'
+                    ' email_lk, section, fetched)'
+                    ' VALUES (?, ?, ?, ?, 0)',
+                    [os.path.splitext(part['filename'])
+                     + (mail_id, part['section'])
+                     for mail_id, email, summary in saved
+                     if summary is not None
+                     for part in summary['parts']
+                     if imap_parse.is_attachment(part)]
+                )
+
+                for mail_id, email, summary in saved:
+                    self._save_attachments(cursor, mail_id, email[0])
+                messages = [(mail_id, email[0])
+                            for mail_id, email, summary in saved]
+                self._index_messages(messages)
+                self._apply_tag_rules(messages)
+                self.manager.commit()
+            except Exception:
+                self.manager.rollback()
+                # Ids of words added by the batch were rolled back too
+                self.words = self.word_ids = None
+                raise
+        return len(saved)
+
+    def _save_attachments(self, cursor, mail_id, message):
+        '''Saves the attachments of a downloaded email to self.attach_path.'''
+        for part in message.walk():
+            if part.get_content_maintype() == 'multipart':
+                continue
+            if not part.get('Content-Disposition'):
+                continue
+
+            if part.get_filename() is None:
+                continue
+            elif part.get_filename().isspace() or part.get_filename() == '':
+                continue
+
+            filename, file_ext = os.path.splitext(part.get_filename())
+            cursor.execute(
+                'INSERT INTO files (filename, extension, email_lk)'
+                ' VALUES (?, ?, ?)',
+                (filename, file_ext, mail_id),
+            )
+            file_path = os.path.join(
+                self.attach_path,
+                ''.join( (str(cursor.lastrowid), file_ext) )
+            )
+            with open(file_path, 'wb') as out:
+                out.write(part.get_payload(decode=1))
 
     def load_emails(self):
         '''Returns a tuple of (id, email_msg) values.'''
@@ -247,13 +942,9 @@ class EmailDatabase():
             email_list = []
             directory_corrupt = False
             for ref in email_refs:
-                mail_path = os.path.join(
-                    self.save_path,
-                    "".join( ( str(ref[0]), '.pkl' ) ))
                 try:
-                    with open(mail_path, 'rb') as f:
-                        email_list.append( (ref[0], pickle.load(f)) )
-                except FileNotFoundError:
+                    email_list.append( (ref[0], self._load_message(ref[0])) )
+                except KeyError:
                     directory_corrupt = True
                     break
                 counter += 1
@@ -263,9 +954,9 @@ class EmailDatabase():
             if directory_corrupt:
                 self.print('Loading database failed... corrupt elements.')
                 self.print('Deleting existing database...')
-                tk.messagebox.showerror('Error:', 'Loading database failed...'
-                                                  ' Corrupt elements.'
-                                                  ' Reinitializing.')
+                self.alert('Error:', 'Loading database failed...'
+                                     ' Corrupt elements.'
+                                     ' Reinitializing.')
                 self.reset_db()
                 self.print('Finished.')
                 return None
@@ -276,22 +967,55 @@ class EmailDatabase():
         self.print('No emails present.')
 
     def store_tags(self, tags):
-        data = self.load_json()
-        if data is None:
-            data = {}
-            data['tags'] = tags
-        elif 'tags' not in data:
-            data['tags'] = tags
-        else:
-            old_tags = [ x for x in data['tags'].split(',') if not x.isspace() and x != '' ]
-            new_tags = [ x for x in tags.split(',') if not x.isspace() and x != '' ]
-            for tag in new_tags:
-                if tag not in old_tags:
-                    old_tags.append(tag)
-            data['tags'] = ','.join(old_tags)
+        '''
+        Keeps tags as folders, shown as buttons of the OverviewPane.
+        Keyword arguments:
+        tags -- the tags in a 'tag1,tag2' string
+        '''
+        with self.lock:
+            self._tag_ids(tags, folder=True)
+            self.manager.commit()
 
+    def get_folders(self):
+        '''Returns the names of the tags kept as folders (see store_tags).'''
+        return [row[0] for row in self.manager.execute(
+            'SELECT name FROM tags WHERE folder = 1 ORDER BY id'
+        )]
+
+    def _tag_ids(self, tags, folder=False):
+        '''
+        Returns the ids of the tags in the 'tag1,tag2' string tags,
+        adding the tags that are not in the tags table yet. Does not
+        commit.
+        '''
+        names = [ x for x in tags.split(',') if not x.isspace() and x != '' ]
+        if len(names) == 0:
+            return []
+        self.manager.executemany(
+            'INSERT INTO tags (name, folder) VALUES (?, ?)'
+            ' ON CONFLICT (name) DO UPDATE'
+            ' SET folder = MAX(folder, excluded.folder)',
+            [(name, int(folder)) for name in names]
+        )
+        ids = dict(self.manager.execute(
+            'SELECT name, id FROM tags WHERE name IN'
+            f' ({",".join("?" * len(names))})',
+            names
+        ).fetchall())
+        return [ids[name] for name in dict.fromkeys(names)]
+
+    def _migrate_tags(self):
+        '''
+        Moves the tag list that older versions kept in data.json into the
+        tags table, as folders.
+        '''
+        data = self.load_json()
+        if data is None or 'tags' not in data:
+            return False
+        self.store_tags(data.pop('tags'))
         with open(self.json_path, 'w') as f:
             json.dump(data, f)
+        return True
 
     def store_json(self, tags):
         data = {
@@ -310,76 +1034,212 @@ class EmailDatabase():
     def tag_emails(self, key_list, tags):
         '''Tags emails in database
         Keyword arguments:
-        key_list -- A list/tuple of dicts. Each dict should contain
-                    * a subject (str non formatted) as dict['Subject]
-                    * a date created (datetime.datetime obj) as dict['Date']
-                    * a to address (str non formatted) as dict['To']
-                    * a from address (str non formatted) as dict['From']
+        key_list -- A list/tuple of search results (see search_emails).
+                    Each dict should contain
+                    * the database id of the email as dict['id'], or
+                    * the identity key of the email (see
+                      utils.message_key) as dict['Key']
+        tags -- the tags in a 'tag1,tag2' string
         '''
         self.print('Tagging emails...')
         if len(key_list) == 0:
             self.print('No emails to tag.')
             return False
-        key_amt = 100 / len(key_list)
-
-        for key in key_list:
-            tag_info = self.manager.execute(
-                'SELECT id, tags FROM emails'
-                ' WHERE subject = ? AND created = ?'
-                ' AND to_address = ? AND from_address = ?',
-                (key['Subject'], key['Date'], key['To'], key['From']),
-            ).fetchone()
 
-            if tag_info['tags'] is not None:
-                add_tags = [ x for x in tag_info['tags'].split(',') if not x.isspace() and x != '' ]
-                search_tags = [ x for x in tags.split(',') if not x.isspace() and x != '']
-                for tag in search_tags:
-                    if tag not in add_tags:
-                        add_tags.append(tag)
-                str_tags = ','.join(add_tags)
-            else:
-                str_tags = tags
+        with self.lock:
+            try:
+                tag_ids = self._tag_ids(tags)
+                email_ids = set(key['id'] for key in key_list if 'id' in key)
+                self.manager.executemany(
+                    'INSERT OR IGNORE INTO email_tags (tag_id, email_id)'
+                    ' VALUES (?, ?)',
+                    [(tag_id, email_id)
+                     for email_id in email_ids for tag_id in tag_ids]
+                )
+                # Results of parse_mail.process_message have no id
+                self.manager.executemany(
+                    'INSERT OR IGNORE INTO email_tags (tag_id, email_id)'
+                    ' SELECT ?, id FROM emails WHERE message_key = ?',
+                    [(tag_id, key['Key'])
+                     for key in key_list if 'id' not in key
+                     for tag_id in tag_ids]
+                )
+                self.manager.commit()
+            except Exception:
+                self.manager.rollback()
+                raise
+        if self.bar != None:
+            self.bar(100)
 
-            self.manager.execute(
-                'UPDATE emails SET tags = ?'
-                ' WHERE subject = ? AND created = ?'
-                ' AND to_address = ? AND from_address = ?',
-                (str_tags, key['Subject'], key['Date'], key['To'], key['From']),
-            )
+        self.print('Finished.')
+        return True
+
+    def save_tag_rule(self, search_terms, subject, to_ln, from_ln,
+                      all_match, tags):
+        '''
+        Saves a search as a tag rule: emails matching it are tagged with
+        tags when they are saved (see _apply_tag_rules), without
+        searching again. Saving a rule of the same search again adds its
+        tags to the rule.
+        Keyword arguments:
+        search_terms, subject, to_ln, from_ln, all_match -- see
+            search_emails
+        tags -- the tags of matching emails, in a 'tag1,tag2' string
+        '''
+        terms = sorted(set(term for term in search_terms
+                           if term.strip() != ''))
+        if len(terms) == 0:
+            return False
+        options = (int(bool(subject)), int(bool(to_ln)),
+                   int(bool(from_ln)), int(bool(all_match)))
+        query_key = json.dumps([terms, *options])
+        with self.lock:
+            rule = self.manager.execute(
+                'SELECT tags FROM tag_rules WHERE query_key = ?',
+                (query_key,)
+            ).fetchone()
+            if rule is None:
+                self.manager.execute(
+                    'INSERT INTO tag_rules (query_key, terms, subject, to_ln,'
+                    ' from_ln, all_match, tags) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (query_key, json.dumps(terms), *options, tags)
+                )
+            else:
+                self.manager.execute(
+                    'UPDATE tag_rules SET tags = ? WHERE query_key = ?',
+                    (_merge_tags(rule['tags'], tags), query_key)
+                )
+            self._tag_ids(tags)
             self.manager.commit()
-            if self.bar != None:
-                self.bar(key_amt)
+        self.tag_rules = None
+        return True
 
-        self.print('Finished.')
+    def _load_tag_rules(self):
+        '''
+        Returns the saved tag rules as (tag_ids, SearchQuery, subject,
+        to_ln, from_ln) tuples. The SearchQuery objects are kept, so
+        their fuzzy matches are reused by every saved batch.
+        '''
+        if self.tag_rules is None:
+            self.tag_rules = [
+                (self._tag_ids(row['tags']),
+                 parse_mail.SearchQuery(json.loads(row['terms']),
+                                        row['all_match']),
+                 row['subject'], row['to_ln'], row['from_ln'])
+                for row in self.manager.execute(
+                    'SELECT tags, terms, subject, to_ln, from_ln, all_match'
+                    ' FROM tag_rules ORDER BY id'
+                ).fetchall()
+            ]
+        return self.tag_rules
+
+    def _apply_tag_rules(self, messages):
+        '''
+        Tags (email_id, message) tuples of newly saved emails with the
+        tags of every tag rule they match. Rules are matched like the
+        searches that made them: with the full text index query of
+        search_emails if it can be used, otherwise like
+        parse_mail.match_fields, in which case the words of the emails
+        are cached for later searches. The emails must be in the full
+        text index already. Does not commit.
+        '''
+        rules = self._load_tag_rules()
+        if len(rules) == 0 or len(messages) == 0:
+            return False
+        if self.fts:
+            return self._apply_fts_rules(rules, messages)
+        rows = {}
+        for index in range(0, len(messages), 500):
+            chunk = [email_id for email_id, message
+                     in messages[index:index + 500]]
+            for row in self.manager.execute(
+                    'SELECT id, subject, to_address, from_address'
+                    ' FROM emails WHERE id IN'
+                    f' ({",".join("?" * len(chunk))})',
+                    chunk):
+                rows[row['id']] = row
+
+        tagged = []
+        for email_id, message in messages:
+            row = rows.get(email_id)
+            if row is None:
+                continue
+            words = parse_mail.get_tokens(message)
+            self._save_words(email_id, words)
+            important_keys = {'Subject': row['subject'],
+                              'To': row['to_address'],
+                              'From': row['from_address']}
+            for tag_ids, query, subject, to_ln, from_ln in rules:
+                if parse_mail.match_fields(important_keys, words, subject,
+                                           to_ln, from_ln, query):
+                    tagged.extend((tag_id, email_id) for tag_id in tag_ids)
+        self.manager.executemany(
+            'INSERT OR IGNORE INTO email_tags (tag_id, email_id)'
+            ' VALUES (?, ?)',
+            tagged
+        )
+        return True
+
+    def _apply_fts_rules(self, rules, messages):
+        '''Matches tag rules through the full text index, see
+        _apply_tag_rules.
+        '''
+        chunks = []
+        words = set()
+        for index in range(0, len(messages), 500):
+            chunk = [email_id for email_id, message
+                     in messages[index:index + 500]]
+            chunks.append(chunk)
+            for row in self.manager.execute(
+                    'SELECT body FROM emails_fts WHERE rowid IN'
+                    f' ({",".join("?" * len(chunk))})',
+                    chunk):
+                words.update(FTS_WORD.findall(_fts_fold(row[0])))
+        # Terms can only fuzzy match the emails with words of the emails,
+        # which is much less than the words of the whole index
+        fuzzy = FuzzyIndex(words)
+
+        tagged = []
+        for tag_ids, query, subject, to_ln, from_ln in rules:
+            match = self._fts_query(query.terms, subject, to_ln, from_ln,
+                                    query.all_match, fuzzy)
+            if match is None:
+                continue
+            for chunk in chunks:
+                for row in self.manager.execute(
+                        'SELECT rowid FROM emails_fts'
+                        ' WHERE emails_fts MATCH ? AND rowid IN'
+                        f' ({",".join("?" * len(chunk))})',
+                        [match] + chunk):
+                    tagged.extend((tag_id, row[0]) for tag_id in tag_ids)
+        self.manager.executemany(
+            'INSERT OR IGNORE INTO email_tags (tag_id, email_id)'
+            ' VALUES (?, ?)',
+            tagged
+        )
         return True
 
     def get_tagged_emails(self, tags):
-        '''Gets emails tagged with a tag in list/tuple (tags).
+        '''Gets emails tagged with a tag in the 'tag1,tag2' string (tags).
         Returns list of email, attachment file name tuples:
         ->    [(email, filename), ...]
         '''
         self.print('Loading emails...')
-        counter = 1
+        names = [ x for x in tags.split(',') if not x.isspace() and x != '' ]
+        if len(names) == 0:
+            self.print('Finished.')
+            return False
         email_refs = self.manager.execute(
-            'SELECT id, tags FROM emails'
+            'SELECT DISTINCT email_tags.email_id AS id'
+            ' FROM tags JOIN email_tags ON email_tags.tag_id = tags.id'
+            f' WHERE tags.name IN ({",".join("?" * len(names))})'
+            ' ORDER BY email_tags.email_id',
+            names
         ).fetchall()
 
-        new_tags = tags.split(',')
         if len(email_refs) > 0:
-            email_list = []
             self.print('Getting emails...')
-            for ref in email_refs:
-                is_match = False
-                if ref['tags'] != None:
-                    ref_tags = ref['tags'].split(',')
-                    for tag in ref_tags:
-                        if tag in new_tags:
-                            is_match = True
-                            break
-                
-                if is_match == True:
-                    email_list.append(self.get_message_details(ref))
-
+            email_list = [self.get_message_details(ref) for ref in email_refs]
             self.print('Finished.')
             return email_list
         self.print('Finished.')
@@ -404,6 +1264,93 @@ class EmailDatabase():
         self.print('Finished.')
         return False
 
+    def list_emails(self, tags=None, after=None, limit=100,
+                    descending=True):
+        '''
+        Returns one page of the header values of saved emails, ordered
+        by date sent and id, without loading the emails. Pages are read
+        through the emails_created index, or the email_tags_created index
+        when listing the emails of a tag, so every page takes the same
+        time however many emails there are.
+        Keyword arguments:
+        tags -- only list emails with a tag in this 'tag1,tag2' string
+                (Default None, all emails)
+        after -- the (row['Date'], row['id']) of the last row of the
+                 previous page (Default None, the first page)
+        limit -- the amount of rows in a page (Default 100)
+        descending -- whether the newest emails come first
+                      (Default True)
+        Returns: list of dicts with the 'id', 'Subject', 'Date', 'To',
+                 'From' and 'Key' of the emails (see search_emails),
+                 'Read' and their amount of 'Attachments'. Load an email
+                 with get_email(row['id']).
+        '''
+        order = 'DESC' if descending else 'ASC'
+        compare = '< (?, ?)' if descending else '> (?, ?)'
+        if tags is None:
+            key = ('emails.created', 'emails.id')
+            source = 'emails'
+            where = []
+            params = []
+            if after is not None:
+                where.append(f'(emails.created, emails.id) {compare}')
+                params.extend(after)
+        else:
+            names = [ x for x in tags.split(',') if not x.isspace() and x != '' ]
+            if len(names) == 0:
+                return []
+            tag_ids = [row[0] for row in self.manager.execute(
+                f'SELECT id FROM tags WHERE name IN ({",".join("?" * len(names))})',
+                names
+            )]
+            if len(tag_ids) == 0:
+                return []
+            # A page of every tag is read through the email_tags_created
+            # index and the pages are merged, UNION lists an email with
+            # several of the tags once. CROSS JOIN keeps SQLite from
+            # scanning emails_created for the tagged emails instead.
+            page = ('SELECT * FROM (SELECT created, email_id FROM email_tags'
+                    ' WHERE tag_id = ?'
+                    + ('' if after is None
+                       else f' AND (created, email_id) {compare}')
+                    + f' ORDER BY created {order}, email_id {order}'
+                    ' LIMIT ?)')
+            key = ('tagged.created', 'tagged.email_id')
+            source = (f'({" UNION ".join([page] * len(tag_ids))}) AS tagged'
+                      ' CROSS JOIN emails ON emails.id = tagged.email_id')
+            where = []
+            params = []
+            for tag_id in tag_ids:
+                params.extend([tag_id] + ([] if after is None else list(after))
+                              + [limit])
+        rows = self.manager.execute(
+            'SELECT emails.id, emails.subject, emails.created,'
+            ' emails.to_address, emails.from_address, emails.message_key,'
+            ' emails.read, (SELECT COUNT(*) FROM files'
+            ' WHERE files.email_lk = emails.id) AS attachments'
+            f' FROM {source}'
+            + (' WHERE ' + ' AND '.join(where) if where else '')
+            + f' ORDER BY {key[0]} {order}, {key[1]} {order}'
+            ' LIMIT ?',
+            params + [limit]
+        ).fetchall()
+        return [{'id': row['id'], 'Subject': row['subject'],
+                 'Date': row['created'], 'To': row['to_address'],
+                 'From': row['from_address'], 'Key': row['message_key'],
+                 'Read': bool(row['read']),
+                 'Attachments': row['attachments']}
+                for row in rows]
+
+    def get_email(self, email_id):
+        '''
+        Returns the (email, attached) tuple of the email with the id
+        email_id (see get_message_details), or None if it is not saved.
+        '''
+        try:
+            return self.get_message_details({'id': email_id})
+        except KeyError:
+            return None
+
     def get_message_details(self, ref):
         '''Get one email message and all of its attachments
         Keyword arguments:
@@ -421,9 +1368,125 @@ class EmailDatabase():
                 filename = ''.join( (str(attached['id']), attached['extension']) )
                 attach_ls.append(os.path.join(self.attach_path, filename))
 
-        file_path = os.path.join(
-            self.save_path,
-            "".join( ( str(ref['id']), '.pkl' ) )
-        )
-        with open(file_path, 'rb') as f:
-            return (pickle.load(f), attach_ls)
\ No newline at end of file
+        return (self._load_message(ref['id']), attach_ls)
+
+    def _load_message(self, email_id):
+        '''
+        Returns the stored (message, num) tuple of an email, where num
+        is its UID as bytes (or None for emails of older versions). The
+        text parts of emails saved by a headers only sync are downloaded
+        through self.body_func first, if it is set.
+        Raises KeyError if the email is not in the message store.
+        '''
+        info = self.manager.execute(
+            'SELECT mailbox, uid, structure, fetched FROM emails'
+            ' WHERE id = ?',
+            (email_id,)
+        ).fetchone()
+        num = None
+        if info is not None and info['uid'] is not None:
+            num = str(info['uid']).encode('ascii')
+        if info is None or info['fetched'] or self.body_func is None:
+            return (self.store.get(email_id), num)
+
+        sections = imap_parse.text_sections(json.loads(info['structure']))
+        message = self.body_func(info['mailbox'], info['uid'], sections)
+        if message is None:
+            return (self.store.get(email_id), num)
+        # The body was downloaded without the lock, so other threads can
+        # keep saving meanwhile
+        with self.lock:
+            try:
+                self.store.put(email_id, message.as_bytes())
+                self.manager.execute(
+                    'UPDATE emails SET fetched = 1, generation = ?'
+                    ' WHERE id = ?',
+                    (self.generation() + 1, email_id)
+                )
+                self._index_messages([(email_id, message)])
+                self.manager.execute(
+                    'DELETE FROM email_words WHERE email_id = ?',
+                    (email_id,)
+                )
+                # Rules matching the text could not match the headers
+                # only email
+                self._apply_tag_rules([(email_id, message)])
+                self.manager.commit()
+            except Exception:
+                self.manager.rollback()
+                self.words = self.word_ids = None
+                raise
+        return (self.store.get(email_id), num)
+
+    def prefetch_bodies(self):
+        '''
+        Downloads the text parts of all emails saved by a headers only
+        sync, newest first. Meant to run in a background thread.
+        '''
+        if self.body_func is None:
+            return False
+        email_refs = self.manager.execute(
+            'SELECT id FROM emails WHERE fetched = 0'
+            ' ORDER BY created DESC'
+        ).fetchall()
+        for ref in email_refs:
+            try:
+                self._load_message(ref['id'])
+            except KeyError:
+                continue
+        return True
+
+    def fetch_attachments(self, paths):
+        '''
+        Downloads the attachment files at paths (as returned by
+        get_message_details) that were not downloaded yet.
+        '''
+        for path in paths:
+            if os.path.exists(path) or self.body_func is None:
+                continue
+            file_id = os.path.splitext(os.path.basename(path))[0]
+            info = self.manager.execute(
+                'SELECT files.section, emails.mailbox, emails.uid'
+                ' FROM files JOIN emails ON files.email_lk = emails.id'
+                ' WHERE files.id = ?',
+                (file_id,)
+            ).fetchone()
+            if info is None:
+                continue
+            message = self.body_func(info['mailbox'], info['uid'],
+                                     [info['section']])
+            if message is None:
+                continue
+            if message.is_multipart():
+                message = message.get_payload()[0]
+            with open(path, 'wb') as out:
+                out.write(message.get_payload(decode=True))
+            with self.lock:
+                self.manager.execute(
+                    'UPDATE files SET fetched = 1 WHERE id = ?',
+                    (file_id,)
+                )
+                self.manager.commit()
+
+def _merge_tags(old_tags, tags):
+    '''
+    Returns the 'tag1,tag2' string of the tags old_tags (or None) with
+    the tags of the string tags added.
+    '''
+    if old_tags is None:
+        return tags
+    add_tags = [ x for x in old_tags.split(',') if not x.isspace() and x != '' ]
+    for tag in tags.split(','):
+        if tag not in add_tags and not tag.isspace() and tag != '':
+            add_tags.append(tag)
+    return ','.join(add_tags)
+
+def _fts_fold(text):
+    '''Lower cases text and removes its diacritics like emails_fts.'''
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed
+                   if not unicodedata.combining(char))
+
+def _fts_phrase(text):
+    '''Quotes text as an FTS5 phrase.'''
+    return '"' + text.replace('"', '""') + '"'
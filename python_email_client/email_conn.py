@@ -1,37 +1,162 @@
+from contextlib import contextmanager
 from email import message_from_bytes
-from imaplib import IMAP4_SSL
-from queue import Queue
-from threading import Thread
+from imaplib import IMAP4, IMAP4_SSL
+from queue import Full, Queue
+from threading import Condition, Lock, Thread
+import re
+import time
+import imap_parse
+from message_store import LazyMessage
 import utils
 import tkinter as tk
 import socket
 
+MAX_CONNECTIONS = 8     # Per IMAP server and account
+RESERVED_CONNECTIONS = 1 # Pooled connections a sync leaves for body fetches
+HEALTH_CHECK_AFTER = 10 # Seconds idle before a pooled connection is NOOPed
+
+class ConnectionPool():
+    def __init__(self, connect_func, max_size=MAX_CONNECTIONS):
+        '''
+        A bounded, thread safe pool of logged in IMAP connections.
+        Keyword arguments:
+        connect_func -- a function returning a new logged in IMAP4
+                        connection
+        max_size -- the maximum amount of open connections
+        '''
+        self.connect_func = connect_func
+        self.max_size = max_size
+        self.idle = [] # [(conn, time released)], most recent last
+        self.opened = 0
+        self.lock = Condition()
+
+    def acquire(self):
+        '''
+        Returns a logged in connection, reusing an idle one if possible.
+        Blocks while max_size connections are in use.
+        '''
+        with self.lock:
+            while len(self.idle) == 0 and self.opened >= self.max_size:
+                self.lock.wait()
+            if len(self.idle) > 0:
+                conn, released = self.idle.pop()
+            else:
+                conn = None
+                self.opened += 1
+
+        if conn is not None:
+            if (time.monotonic() - released < HEALTH_CHECK_AFTER
+                    or self._is_alive(conn)):
+                return conn
+            self._logout(conn)
+        try:
+            return self.connect_func()
+        except:
+            with self.lock:
+                self.opened -= 1
+                self.lock.notify()
+            raise
+
+    def release(self, conn, broken=False):
+        '''
+        Returns a connection to the pool.
+        Keyword arguments:
+        conn -- a connection from acquire()
+        broken -- whether the connection had an error, in which case it
+                  is logged out instead of reused. (Default False)
+        '''
+        if broken:
+            self._logout(conn)
+        with self.lock:
+            if broken:
+                self.opened -= 1
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.lock.notify()
+
+    @contextmanager
+    def connection(self):
+        '''Acquires a connection for the duration of a with block.'''
+        conn = self.acquire()
+        try:
+            yield conn
+        except (IMAP4.abort, OSError):
+            self.release(conn, broken=True)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        '''Logs out all idle connections.'''
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+            self.opened -= len(idle)
+        for conn, released in idle:
+            self._logout(conn)
+
+    def _is_alive(self, conn):
+        try:
+            return conn.noop()[0] == 'OK'
+        except (IMAP4.error, OSError):
+            return False
+
+    def _logout(self, conn):
+        try:
+            conn.logout()
+        except (IMAP4.error, OSError):
+            pass
+## End class ConnectionPool ##
+
+_pools = {}
+_pools_lock = Lock()
+
+def get_pool(key, connect_func, max_size=MAX_CONNECTIONS):
+    '''Returns the ConnectionPool for key, creating it if needed.'''
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(connect_func, max_size)
+        return _pools[key]
+
 class EmailConnection():
     def __init__(self, print_func=None):
         '''
         Defines an email connection to our IMAP server.
         Requires a valid dotenv file to be present.
-        Be sure to delete the object afterwards to log out of the server.
+        self.conn is a connection of its own. Workers and body downloads
+        take connections from a pool shared by every EmailConnection of
+        the same server and account (self.pool). Call close() to log
+        self.conn out.
 
         Keyword arguments
         print_func -- An Application() class's put_msg function
         '''
         self.get_config()
+        self.pool = get_pool((self.imap, self.port, self.email),
+                             self._open_conn)
         try:
-            self.conn = IMAP4_SSL(self.imap, self.port)
-            self.conn.login(self.email, self.pswrd)
-        except socket.gaierror:
+            self.conn = self._open_conn()
+        except (IMAP4.error, OSError):
             self.conn = None
 
         self.print = print_func
 
     def __del__(self):
-        if self.conn is not None:
+        self.close()
+
+    def _open_conn(self):
+        conn = IMAP4_SSL(self.imap, self.port)
+        conn.login(self.email, self.pswrd)
+        return conn
+
+    def close(self):
+        '''Logs self.conn out.'''
+        if getattr(self, 'conn', None) is not None:
             try:
-                self.conn.close()
                 self.conn.logout()
-            except:
+            except (IMAP4.error, OSError):
                 pass
+            self.conn = None
 
     def get_config(self):
         self.config = utils.get_config()
@@ -54,28 +179,205 @@ class EmailConnection():
         return False
 ## End class EmailConnection ##
 
+FETCH_UID = re.compile(rb'UID (\d+)')
+
+def make_message_sets(uids, batch_size):
+    '''
+    Splits a list of UIDs into IMAP message sets of at most batch_size
+    messages each. Consecutive UIDs are collapsed into ranges, so a
+    contiguous mailbox becomes sets like '1:500', '501:1000'.
+    Keyword arguments:
+    uids -- a list of UIDs (as integers or bytes)
+    batch_size -- the maximum amount of messages in one message set
+    Returns: list of (message_set str, message count int) tuples
+    '''
+    uids = sorted(int(uid) for uid in uids)
+    message_sets = []
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        ranges = []
+        low = high = batch[0]
+        for uid in batch[1:]:
+            if uid == high + 1:
+                high = uid
+                continue
+            ranges.append(f'{low}:{high}' if low != high else str(low))
+            low = high = uid
+        ranges.append(f'{low}:{high}' if low != high else str(low))
+        message_sets.append((','.join(ranges), len(batch)))
+    return message_sets
+
+def parse_fetch_response(data):
+    '''
+    Parses the data of a UID FETCH (UID RFC822) response into
+    (uid bytes, raw message bytes) tuples.
+    The UID may be sent either before or after the message literal, in
+    which case it is found in the bytes item following the literal.
+    '''
+    messages = []
+    for index, item in enumerate(data):
+        if not isinstance(item, tuple):
+            continue
+        found = FETCH_UID.search(item[0])
+        if found is None and index + 1 < len(data):
+            trailing = data[index + 1]
+            if isinstance(trailing, bytes):
+                found = FETCH_UID.search(trailing)
+        if found is None:
+            continue
+        messages.append((found.group(1), item[1]))
+    return messages
+
+HEADER_ITEMS = '(UID ENVELOPE BODYSTRUCTURE RFC822.SIZE FLAGS)'
+
+def fetch_parts(conn, uid, sections):
+    '''
+    Downloads the header and some body parts of one message without
+    setting its \\Seen flag.
+    Keyword arguments:
+    conn -- an IMAP4 connection with the message's mailbox selected
+    uid -- the UID of the message
+    sections -- a list of imap_parse.structure_parts sections to
+                download, eg. ['1.1'], or ['TEXT'] for a single part
+                message.
+    Returns: an email.message.Message with only those parts, or None
+    '''
+    items = ['BODY.PEEK[HEADER]']
+    for section in sections:
+        if section != 'TEXT':
+            items.append(f'BODY.PEEK[{section}.MIME]')
+        items.append(f'BODY.PEEK[{section}]')
+    status, data = conn.uid('FETCH', str(uid), f'({" ".join(items)})')
+    responses = imap_parse.parse_fetch(data) if status == 'OK' else []
+    if len(responses) == 0:
+        return None
+    response = responses[0]
+    message = message_from_bytes(response['BODY[HEADER]'])
+    if 'TEXT' in sections:
+        message.set_payload((response['BODY[TEXT]'] or b'').decode(
+            'ascii', errors='surrogateescape'))
+        return message
+
+    parts = []
+    for section in sections:
+        parts.append(message_from_bytes(
+            (response[f'BODY[{section}.MIME]'] or b'')
+            + (response[f'BODY[{section}]'] or b'')))
+    message.set_payload(parts)
+    return message
+
+STREAM_QUEUE_SIZE = 500 # Emails waiting to be saved before fetching pauses
+
 class EmailGetter:
-    def __init__(self, conn, threads, print_func, bar_func=None):
+    def __init__(self, conn, threads, print_func, bar_func=None,
+                 batch_size=500, pool=None, headers_only=False,
+                 stream=False):
         """
         Keyword arguments:
         conn -- An EmailConnection connection (EmailConnection.conn)
         threads -- An integer representing the amount of threads to spawn
         print_func -- An Application() class's put_msg function
         bar_func -- An Application() class's add_bar function
+        batch_size -- The amount of messages requested by one UID FETCH
+                      command. 1 fetches every message separately.
+                      (Default 500)
+        pool -- The ConnectionPool the workers take connections from.
+                (Default is the pool of a new EmailConnection)
+        headers_only -- Whether to only download the ENVELOPE and
+                        BODYSTRUCTURE of messages. Bodies are then
+                        downloaded later with fetch_parts. (Default False)
+        stream -- Whether downloaded emails are only handed on through
+                  self.finished_queue, which then holds at most
+                  STREAM_QUEUE_SIZE emails and ends with None, instead of
+                  being collected into self.emails. (Default False)
         """
         self.active = True
+        self.cancelled = False
         self.conn = conn
+        self.batch_size = max(1, batch_size)
+        self.headers_only = headers_only
+        if pool is None:
+            pool = EmailConnection(print_func).pool
+        self.pool = pool
         self.message_queue = Queue()
-        self.finished_queue = Queue()
+        self.stream = stream
+        self.finished_queue = Queue(STREAM_QUEUE_SIZE if stream else 0)
+        self.uids = []          # New UIDs to download, sorted
+        self.downloaded = set() # UIDs downloaded so far
+        self.failed = []        # Message sets whose FETCH failed
+        self.uid_lock = Lock()
         self.workers = []
         self.print = print_func
         self.bar = bar_func
         self.emails = None
+        self.sync_state = None
 
     def __del__(self):
         self.active = False
 
-    def get_emails_online(self, threads, since):
+    def cancel(self):
+        '''
+        Stops a running sync: message sets that were not fetched yet are
+        skipped. Safe to call from any thread.
+        '''
+        self.cancelled = True
+        self.active = False
+
+    def get_emails_online(self, threads, since, state=None):
+        '''
+        Downloads new messages of INBOX into self.emails.
+        Keyword arguments:
+        threads -- the amount of worker threads to download with
+        since -- a 'dd-Mon-YYYY' date string to search from, used when
+                 there is no usable sync state. None gets all emails.
+        state -- the stored sync state of INBOX, a dict with the
+                 'uidvalidity', 'last_uid' and 'highestmodseq' keys
+                 (see EmailDatabase.get_sync_state). (Default None)
+
+        The new sync state is stored in self.sync_state afterwards, or
+        None if the sync was cancelled. If some messages could not be
+        downloaded, its last_uid is only the highest UID below the first
+        missing message, so the next sync downloads them again.
+        Returns: whether any messages were downloaded.
+        '''
+        try:
+            found = self._download(threads, since, state)
+        finally:
+            self.active = False
+            if self.stream:
+                self.finished_queue.put(None)
+        if self.stream:
+            self.emails = []
+        else:
+            self.emails = list(self.finished_queue.queue)
+        if self.cancelled:
+            self.sync_state = None
+        if self.sync_state is not None:
+            self._update_last_uid()
+        return found
+
+    def _update_last_uid(self):
+        '''
+        Raises self.sync_state's last_uid to the highest new UID that has
+        no missing message (one that was not downloaded) below it.
+        '''
+        missing = [uid for uid in self.uids if uid not in self.downloaded]
+        if len(missing) == 0:
+            if len(self.uids) > 0:
+                self.sync_state['last_uid'] = max(
+                    self.sync_state['last_uid'], self.uids[-1])
+            return
+        self.print(f'{len(missing)} messages could not be downloaded,'
+                   ' they are downloaded by the next sync.')
+        self.sync_state['last_uid'] = max(self.sync_state['last_uid'],
+                                          missing[0] - 1)
+        # An unchanged HIGHESTMODSEQ would skip the next sync
+        self.sync_state['highestmodseq'] = None
+
+    def _download(self, threads, since, state):
+        '''Downloads new messages with worker threads. See
+        get_emails_online.
+        '''
         self.print('Creating threads...')
         msg_amt = int(self.conn.select('INBOX')[1][0].decode('utf-8'))
         self.print(
@@ -83,32 +385,41 @@ class EmailGetter:
             + str(msg_amt)
             + ' messages in INBOX'
         )
-        msg_bar = 100 / msg_amt
-        
-        self.conn.select('INBOX')
-
-        # Search code
-        last_date = since
-        search_str = ''
-        if last_date == None:
-            search_str = 'ALL'
-        else:
-            search_str = f'(SINCE "{last_date}")'
-        typ, messages = self.conn.search(
+        uidvalidity = self._get_response_int('UIDVALIDITY')
+        highestmodseq = None
+        if 'CONDSTORE' in self.conn.capabilities:
+            highestmodseq = self._get_response_int('HIGHESTMODSEQ')
+
+        search_str = self._search_criteria(uidvalidity, highestmodseq, state,
+                                           since)
+        if search_str is None:
+            self.print('No new messages.')
+            return False
+
+        typ, messages = self.conn.uid(
+            'SEARCH',
             None, 
             search_str
         )
         self.print('Searching messages... ')
-        if typ == 'OK' and messages[0]:
-            for x in range(threads):
+        uids = []
+        if typ == 'OK':
+            uids = self._new_uids(messages)
+        if len(uids) > 0:
+            msg_bar = 100 / len(uids)
+            # Some pooled connections are left free, so bodies of
+            # selected emails can be downloaded during the sync
+            workers = max(1, min(threads,
+                                 self.pool.max_size - RESERVED_CONNECTIONS))
+            for x in range(workers):
                 self.workers.append(Thread(target=self.fetch, args=(msg_bar,)))
-                self.workers[-1].setDaemon(True)
+                self.workers[-1].daemon = True
                 self.workers[-1].start()
 
             self.print('Got list of messages!')
             self.print('Downloading messages -> ')
-            for index, num in enumerate(messages[0].split()):
-                self.message_queue.put(num)
+            for msg_set in make_message_sets(uids, self.batch_size):
+                self.message_queue.put(msg_set)
 
             self.message_queue.join()
             self.print('Finished!')
@@ -118,44 +429,155 @@ class EmailGetter:
             
             self.message_queue.join()
             self.print('Threads finished.')
-            self.print('Sorting messages... ')
-            msg_list = list(self.finished_queue.queue)
-            self.print('Finished sorting messages!')
-            self.active = False
-            self.emails = msg_list
             return True
         else:
             self.print('No message response')
-            self.emails = []
             return False
 
+    def _search_criteria(self, uidvalidity, highestmodseq, state, since):
+        '''
+        Sets self.sync_state from the SELECT response values and returns
+        the UID SEARCH criteria for the messages to download, or None if
+        nothing in the mailbox changed since the stored state.
+        See get_emails_online for the state and since arguments.
+        '''
+        last_uid = 0
+        if state is not None and state['uidvalidity'] == uidvalidity:
+            last_uid = state['last_uid']
+        elif state is not None:
+            self.print('UIDVALIDITY changed, synchronizing all messages.')
+            since = None
+        self.sync_state = {
+            'uidvalidity': uidvalidity,
+            'last_uid': last_uid,
+            'highestmodseq': highestmodseq
+        }
+
+        if (last_uid > 0 and highestmodseq is not None
+                and state['highestmodseq'] == highestmodseq):
+            return None
+        if last_uid > 0:
+            return f'UID {last_uid + 1}:*'
+        elif since == None:
+            return 'ALL'
+        return f'(SINCE "{since}")'
+
+    def _new_uids(self, messages):
+        '''Returns the UIDs of a UID SEARCH response above the last UID.'''
+        if not messages or not messages[0]:
+            return []
+        last_uid = self.sync_state['last_uid']
+        # 'n:*' always matches the highest UID, even if it is below n
+        uids = [uid for uid in messages[0].split() if int(uid) > last_uid]
+        self.uids = sorted(int(uid) for uid in uids)
+        return uids
+
+    def _put_email(self, email):
+        '''Hands a downloaded email on and remembers its UID.'''
+        # A full stream queue blocks until the email is taken, unless the
+        # sync is cancelled meanwhile
+        while True:
+            try:
+                self.finished_queue.put(email, timeout=1)
+                break
+            except Full:
+                if not self.active:
+                    return
+        with self.uid_lock:
+            self.downloaded.add(int(email[1]))
+
+    def _get_response_int(self, code):
+        '''Returns the integer value of a response code from the last
+        command, eg. UIDVALIDITY after a SELECT, or None if not sent.
+        '''
+        typ, data = self.conn.response(code)
+        if not data or data[0] is None:
+            return None
+        return int(data[-1])
+
     def fetch(self, inc_amt):
         """
         Keyword arguments:
         inc_amt -- the amount that progress bar should 
                    increment for message proccessed.
         """
-        email = EmailConnection()
-        conn = email.conn
         try:
-            conn.select('INBOX')
-        except:
-            return False
-        
-        while self.active:
-            msg_num = self.message_queue.get()
-            if msg_num == None:
+            conn = self._get_conn()
+        except (IMAP4.error, OSError):
+            conn = None
+
+        items = HEADER_ITEMS if self.headers_only else '(UID RFC822)'
+        while True:
+            msg_set = self.message_queue.get()
+            if msg_set == None:
+                self.message_queue.task_done()
+                break
+            if not self.active:
+                # Cancelled, the rest of the queue is only emptied
                 self.message_queue.task_done()
-                return True
-            status, data = conn.fetch(msg_num, '(RFC822)')
-            message = message_from_bytes(data[0][1])
-            self.finished_queue.put((message, msg_num))
+                continue
+            msg_set, msg_cnt = msg_set
+            try:
+                if conn is None:
+                    conn = self._get_conn()
+                status, data = conn.uid('FETCH', msg_set, items)
+            except (IMAP4.error, OSError):
+                # Reconnect once, then give up on this message set
+                if conn is not None:
+                    self.pool.release(conn, broken=True)
+                conn = None
+                try:
+                    conn = self._get_conn()
+                    status, data = conn.uid('FETCH', msg_set, items)
+                except (IMAP4.error, OSError):
+                    status, data = 'NO', []
+            if status != 'OK':
+                # Its messages stay missing, see _update_last_uid
+                self.failed.append(msg_set)
+                self.print(f'Could not get messages {msg_set}')
+            elif self.headers_only:
+                for response in imap_parse.parse_fetch(data):
+                    self._put_email(self._header_email(response))
+                self.print(f'Got messages {msg_set}')
+            else:
+                for msg_num, raw in parse_fetch_response(data):
+                    # Kept as downloaded, so the store gets the raw bytes
+                    self._put_email((LazyMessage(raw), msg_num))
+                self.print(f'Got messages {msg_set}')
             self.message_queue.task_done()
-            self.print(f'Got message {msg_num}')
             if self.bar != None:
-                self.bar(inc_amt)
+                self.bar(inc_amt * msg_cnt)
+
+        if conn is not None:
+            self.pool.release(conn)
         return True
 
+    def _header_email(self, response):
+        '''
+        Turns a parsed HEADER_ITEMS response into a (message, num,
+        summary) tuple, where message only has headers and summary is a
+        dict with the 'size', 'flags' and 'parts' (see
+        imap_parse.structure_parts) of the message.
+        '''
+        summary = {
+            'size': int(response.get('RFC822.SIZE') or 0),
+            'flags': [flag.decode('ascii')
+                      for flag in response.get('FLAGS') or []],
+            'parts': imap_parse.structure_parts(response['BODYSTRUCTURE'])
+        }
+        return (imap_parse.envelope_to_message(response['ENVELOPE']),
+                response['UID'], summary)
+
+    def _get_conn(self):
+        '''Acquires a pooled connection with INBOX selected.'''
+        conn = self.pool.acquire()
+        try:
+            conn.select('INBOX')
+        except (IMAP4.error, OSError):
+            self.pool.release(conn, broken=True)
+            raise
+        return conn
+
     def get_subjects(self, num_list):
         subject_list = []
         for item in self.emails:
@@ -0,0 +1,347 @@
+from queue import Queue, Empty
+import heapq
+import itertools
+import sys
+from threading import (Condition, Event, Lock, Thread, current_thread,
+                       local, main_thread)
+
+# Events of EventBus.events besides function calls
+STATUS = 'status'
+PROGRESS = 'progress'
+TASK_DONE = 'task done'
+
+# Priorities of scheduled jobs, lower runs first
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+_current = local() # .task: the Task run by the current thread
+
+class Cancelled(Exception):
+    '''Raised by CancelToken.check in a cancelled job.'''
+
+class CancelToken():
+    def __init__(self):
+        '''
+        Tells a job that it was cancelled. Long loops check it with
+        check() or the cancelled attribute, blocking calls can be
+        stopped with on_cancel.
+        '''
+        self.cancelled = False
+        self.callbacks = []
+        self.lock = Lock()
+
+    def cancel(self):
+        '''
+        Cancels the job. Safe to call from any thread. Errors of the
+        on_cancel functions are reported, and do not keep the others
+        from being called.
+        '''
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = self.callbacks
+            self.callbacks = []
+        for func in callbacks:
+            try:
+                func()
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+
+    def on_cancel(self, func):
+        '''Calls func when the job is cancelled, now if it already is.'''
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(func)
+                return
+        func()
+
+    def check(self):
+        '''Raises Cancelled if the job was cancelled.'''
+        if self.cancelled:
+            raise Cancelled()
+## End class CancelToken ##
+
+class Task():
+    def __init__(self, bus, name, func, args=(), daemon=False,
+                 priority=NORMAL, key=None):
+        '''
+        A job run by an EventBus, in its own thread (see EventBus.run)
+        or by one of the worker threads of the bus (see
+        EventBus.schedule).
+        Keyword arguments:
+        bus -- the EventBus the task belongs to
+        name -- a name for the task, shown in the progress window
+        func -- the function to run
+        args -- the arguments of func (Default ())
+        daemon -- whether the task may be stopped by closing the
+                  application, and runs without the progress window
+                  (Default False)
+        priority -- HIGH, NORMAL or LOW (Default NORMAL)
+        key -- tasks with the same key are not scheduled twice
+               (Default None)
+        '''
+        self.bus = bus
+        self.name = name
+        self.func = func
+        self.args = args
+        self.daemon = daemon
+        self.priority = priority
+        self.key = key
+        self.token = CancelToken()
+        self.parent = None      # Task that started this one with run()
+        self.state = 'pending'  # 'running', 'done', 'cancelled', 'failed'
+        self.status = ''        # Last status message, set on the main thread
+        self.progress = 0       # Progress out of 100, set on the main thread
+        self.result = None
+        self.finished = Event()
+
+    def _run(self):
+        _current.task = self
+        self.state = 'running'
+        try:
+            self.token.check()
+            self.result = self.func(*self.args)
+            self.state = 'done'
+        except Cancelled:
+            self.state = 'cancelled'
+        except Exception:
+            self.state = 'failed'
+            raise
+        finally:
+            _current.task = None
+            self.finished.set()
+            self.bus.events.put((TASK_DONE, self))
+
+    def cancel(self):
+        '''Cancels the task, and the tasks it started with run().'''
+        self.token.cancel()
+        self.bus.events.put((STATUS, (None, None)))
+
+    def set_status(self, msg):
+        '''Shows msg as the status of the task. Safe from any thread.'''
+        self.bus.events.put((STATUS, (self, msg)))
+
+    def add_progress(self, amt):
+        '''Adds amt to the progress of the task. Safe from any thread.'''
+        self.bus.events.put((PROGRESS, (self, amt)))
+
+    def wait(self, timeout=None):
+        '''Waits until the task finished. Returns whether it did.'''
+        return self.finished.wait(timeout)
+
+    def is_alive(self):
+        '''Returns whether the task is pending or running.'''
+        return not self.finished.is_set()
+## End class Task ##
+
+class EventBus():
+    def __init__(self, handler=None, workers=3, busy_interval=50,
+                 idle_interval=250):
+        '''
+        Passes events from worker threads to the Tkinter main loop, so
+        only the main thread calls Tk, and runs jobs on a bounded amount
+        of worker threads. Events are drained by root.after: status and
+        progress events of a drain are combined into one handler call,
+        and function calls run in the order they were posted.
+        Keyword arguments:
+        handler -- a function (status, tasks) called on the main thread
+                   when a drain has status or progress events or tasks
+                   started or finished. status is the last status
+                   message of no task (or None) and tasks the tasks to
+                   show (see running), with their status and progress.
+                   (Default None)
+        workers -- the most jobs of schedule() running at once
+                   (Default 3)
+        busy_interval -- ms between drains while tasks run (Default 50)
+        idle_interval -- ms between drains otherwise (Default 250)
+        '''
+        self.handler = handler
+        self.workers = workers
+        self.busy_interval = busy_interval
+        self.idle_interval = idle_interval
+        self.events = Queue()
+        self.tasks = []     # Pending and running tasks
+        self.root = None
+
+        # Jobs waiting for a worker: a heap of (priority, number, Task)
+        self.pending = []
+        self.counter = itertools.count()
+        self.condition = Condition()
+        self.threads = 0    # Worker threads, which end when idle
+
+    def start(self, root):
+        '''Starts draining events in the main loop of root.'''
+        self.root = root
+        self.root.after(self.idle_interval, self._drain)
+
+    def current(self):
+        '''Returns the Task run by the current thread, or None.'''
+        return getattr(_current, 'task', None)
+
+    def status(self, msg):
+        '''Shows msg as the status of the current task.'''
+        self.events.put((STATUS, (self.current(), msg)))
+
+    def progress(self, amt):
+        '''Adds amt to the progress of the current task.'''
+        self.events.put((PROGRESS, (self.current(), amt)))
+
+    def post(self, func, *args):
+        '''Calls func(*args) on the main thread.'''
+        self.events.put((func, args))
+
+    def ask(self, func, *args):
+        '''
+        Calls func(*args) on the main thread, eg. a tkinter.messagebox
+        dialog, and waits for it.
+        Returns: the result of func
+        '''
+        if current_thread() is main_thread():
+            return func(*args)
+        answered = Event()
+        answer = []
+        def call():
+            try:
+                answer.append(func(*args))
+            finally:
+                answered.set()
+        self.events.put((call, ()))
+        answered.wait()
+        return answer[0] if answer else None
+
+    def run(self, func, *args, daemon=False):
+        '''
+        Runs func(*args) as a Task in its own thread, outside of the
+        worker threads. A task started by another task is part of it:
+        it is cancelled with it and reports its progress to it.
+        Returns: the started Task
+        '''
+        task = Task(self, getattr(func, '__name__', 'task'), func, args,
+                    daemon)
+        parent = self.current()
+        if parent is not None:
+            task.parent = parent
+            parent.token.on_cancel(task.cancel)
+        self.tasks.append(task)
+        self.events.put((STATUS, (None, None)))
+        Thread(target=task._run, name=task.name, daemon=daemon).start()
+        return task
+
+    def schedule(self, func, *args, name=None, priority=NORMAL, key=None,
+                 replace=False, daemon=False):
+        '''
+        Runs func(*args) as a job on one of the worker threads, after
+        the pending jobs of a higher priority and the ones of the same
+        priority scheduled before it. If a job with the same key was
+        scheduled and has not finished or been cancelled, that job is
+        returned instead.
+        Keyword arguments:
+        func, *args -- the function of the job and its arguments
+        name -- the name of the job (Default the name of func)
+        priority -- HIGH, NORMAL or LOW (Default NORMAL)
+        key -- the key of the job (Default the same function with the
+               same arguments)
+        replace -- whether the job replaces the pending jobs of the same
+                   key instead, which are cancelled. Jobs of the key that
+                   already run are left running. (Default False)
+        daemon -- whether the job runs without the progress window, see
+                  Task (Default False)
+        Returns: the Task of the job
+        '''
+        if key is None:
+            key = (getattr(func, '__qualname__', None), repr(args))
+        with self.condition:
+            for task in self.tasks:
+                if (task.key != key or not task.is_alive()
+                        or task.token.cancelled):
+                    continue
+                if not replace:
+                    return task
+                if task.state == 'pending':
+                    # Its worker finds it cancelled and skips it
+                    task.cancel()
+            task = Task(self, name or getattr(func, '__name__', 'job'),
+                        func, args, daemon, priority, key)
+            self.tasks.append(task)
+            heapq.heappush(self.pending,
+                           (priority, next(self.counter), task))
+            if self.threads < self.workers:
+                self.threads += 1
+                Thread(target=self._work, daemon=True).start()
+        self.events.put((STATUS, (None, None)))
+        return task
+
+    def _work(self):
+        '''Runs pending jobs until there are none.'''
+        while True:
+            with self.condition:
+                if len(self.pending) == 0:
+                    self.threads -= 1
+                    return
+                priority, number, task = heapq.heappop(self.pending)
+            try:
+                task._run()
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+
+    def cancel_all(self):
+        '''Cancels all pending and running tasks.'''
+        for task in list(self.tasks):
+            task.cancel()
+
+    def running(self):
+        '''Returns the pending and running tasks that are not daemon
+        tasks or part of another task.
+        '''
+        return [task for task in self.tasks
+                if not task.daemon and task.parent is None]
+
+    def _drain(self):
+        status = None
+        changed = False
+        calls = []
+        while True:
+            try:
+                kind, value = self.events.get_nowait()
+            except Empty:
+                break
+            if kind == STATUS or kind == PROGRESS:
+                changed = True
+                task, amt = value
+                while task is not None and task.parent is not None:
+                    task = task.parent
+                if kind == STATUS and task is not None:
+                    task.status = amt
+                elif kind == STATUS and amt is not None:
+                    status = amt
+                elif kind == PROGRESS:
+                    if task is None:
+                        # Progress of threads that are no task, eg. the
+                        # threads of an EmailGetter, goes to the oldest job
+                        running = self.running()
+                        task = running[0] if running else None
+                    if task is not None:
+                        task.progress = min(100, task.progress + amt)
+            elif kind == TASK_DONE:
+                changed = True
+                if value in self.tasks:
+                    self.tasks.remove(value)
+            else:
+                calls.append((kind, value))
+
+        try:
+            if changed and self.handler is not None:
+                self.handler(status, self.running())
+            for func, args in calls:
+                try:
+                    func(*args)
+                except Exception:
+                    # Reported like exceptions of other Tk callbacks,
+                    # without losing the calls after it
+                    self.root.report_callback_exception(*sys.exc_info())
+        finally:
+            self.root.after(self.busy_interval if self.running()
+                            else self.idle_interval, self._drain)
+## End class EventBus ##
@@ -0,0 +1,54 @@
+from fuzzywuzzy import fuzz
+
+MATCH_SCORE = 90 # fuzz.WRatio score a word must beat to match a term
+
+def trigrams(word):
+    '''Returns the set of trigrams of a word, padded with spaces.'''
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def is_match(word, term):
+    '''
+    Returns whether a word matches a search term like
+    parse_mail.process_message compares them.
+    '''
+    return (len(word) >= len(term) - 1
+            and fuzz.WRatio(word, term) > MATCH_SCORE)
+
+class FuzzyIndex():
+    def __init__(self, words):
+        '''
+        A trigram index over a vocabulary of distinct words, to find the
+        words that fuzzy match a search term without comparing it to
+        every word.
+        Keyword arguments:
+        words -- an iterable of distinct words (str)
+        '''
+        self.words = []
+        self.grams = {}        # {trigram: [index into self.words]}
+        for word in words:
+            index = len(self.words)
+            self.words.append(word)
+            for gram in trigrams(word):
+                self.grams.setdefault(gram, []).append(index)
+
+    def candidates(self, term):
+        '''
+        Returns the words sharing a trigram with term whose length lets
+        them score above MATCH_SCORE. WRatio scales scores of words at
+        least 1.5 times as long as the term down to 90 or less.
+        '''
+        found = set()
+        for gram in trigrams(term):
+            found.update(self.grams.get(gram, ()))
+        longest = len(term) * 1.5
+        return [self.words[index] for index in found
+                if len(term) - 1 <= len(self.words[index]) < longest]
+
+    def match(self, term):
+        '''Returns the words of the vocabulary that fuzzy match term.'''
+        return [word for word in self.candidates(term) if is_match(word, term)]
+
+    def __len__(self):
+        return len(self.words)
+## End class FuzzyIndex ##
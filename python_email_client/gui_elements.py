@@ -102,6 +102,91 @@ class ScrollFrame(tk.Frame):
         self.canvas.configure(scrollregion=self.canvas.bbox('all'))
         gc.collect()
 
+class EmailList(ttk.Frame):
+    def __init__(self, parent, select_func=None, page_size=100):
+        '''A list of emails in a ttk.Treeview that only holds the rows
+        scrolled to. Rows are read a page at a time from a page function
+        (see EmailDatabase.list_emails) when the list is scrolled near
+        its end, so showing a list takes the same time for any amount of
+        emails.
+        Keyword arguments:
+        parent -- the frame's parent Tkinter element.
+        select_func -- a function called with the id of a selected email
+                       (Default None)
+        page_size -- the amount of rows read at a time (Default 100)
+        '''
+        ttk.Frame.__init__(self, parent)
+        self.select_func = select_func
+        self.page_size = page_size
+        self.page_func = None   # (after, limit) -> list of rows
+        self.after = None       # list_emails cursor of the last row shown
+        self.finished = True    # Whether page_func has no more rows
+        self.count = 0          # Amount of emails in the list
+
+        self.tree = ttk.Treeview(self, columns=('subject', 'from', 'date'),
+                                 show='headings', selectmode='browse')
+        self.tree.heading('subject', text='Subject')
+        self.tree.heading('from', text='From')
+        self.tree.heading('date', text='Date sent')
+        self.tree.column('subject', width=160)
+        self.tree.column('from', width=100)
+        self.tree.column('date', width=110, stretch=False)
+        self.vsb = ttk.Scrollbar(self, orient=tk.VERTICAL,
+                                 command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self._on_scroll)
+        self.tree.bind('<<TreeviewSelect>>', self._on_select)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.vsb.pack(side=tk.LEFT, fill=tk.Y)
+
+    def show(self, page_func, count):
+        '''Replaces the list with the emails of page_func.
+        Keyword arguments:
+        page_func -- a function (after, limit) returning the rows after
+                     the cursor after, like EmailDatabase.list_emails
+        count -- the amount of emails page_func lists
+        '''
+        self.reset()
+        self.page_func = page_func
+        self.count = count
+        self.finished = False
+        self.load_page()
+
+    def load_page(self):
+        '''Adds the next page of rows to the list.'''
+        if self.finished:
+            return False
+        rows = self.page_func(self.after, self.page_size)
+        if len(rows) < self.page_size:
+            self.finished = True
+        for row in rows:
+            self.tree.insert('', tk.END, iid=str(row['id']), values=(
+                utils.parse_complete_sub(row['Subject']).decode('ascii'),
+                utils.parse_complete_sub(row['From']).decode('ascii'),
+                row['Date'].strftime('%Y-%m-%d %H:%M')))
+        if len(rows) > 0:
+            self.after = (rows[-1]['Date'], rows[-1]['id'])
+        return True
+
+    def _on_scroll(self, first, last):
+        self.vsb.set(first, last)
+        # Rows are added before the end is reached, and until the view
+        # is full
+        if not self.finished and float(last) > 0.9:
+            self.load_page()
+
+    def _on_select(self, event):
+        selected = self.tree.selection()
+        if len(selected) > 0 and self.select_func is not None:
+            self.select_func(int(selected[0]))
+
+    def reset(self):
+        '''Removes all rows.'''
+        self.tree.delete(*self.tree.get_children())
+        self.page_func = None
+        self.after = None
+        self.finished = True
+        self.count = 0
+
 class ScrollText(tk.scrolledtext.ScrolledText):
     def __init__(self, parent):
         tk.scrolledtext.ScrolledText.__init__(self, parent)
@@ -118,8 +203,19 @@ class ScrollText(tk.scrolledtext.ScrolledText):
         self.display_txt.config(state='disabled')
 
 class ScrollingFrameAndView(tk.Frame):
-    def __init__(self, parent):
+    def __init__(self, parent, attach_func=None, select_func=None):
+        '''
+        Keyword arguments:
+        parent -- the frame's parent Tkinter element.
+        attach_func -- a function given a list of attachment paths and
+                       a function to call with them on the main thread
+                       once the ones that are not downloaded yet are
+                       downloaded (Default None)
+        select_func -- a function called with the id of an email selected
+                       in the list (Default None)
+        '''
         tk.Frame.__init__(self, parent)
+        self.attach_func = attach_func
         self.config = utils.get_config()
         self.save_path = os.path.join(utils.get_store_path(), 'resources/temp/')
         if not os.path.exists(self.save_path):
@@ -130,8 +226,8 @@ class ScrollingFrameAndView(tk.Frame):
         self.email_num.set('0 emails below:')
         self.email_lb = ttk.Label(self.left_fm, textvariable=self.email_num)
         self.email_lb.pack(fill=tk.X)
-        self.scroll_frame = ScrollFrame(self.left_fm, 320)
-        self.scroll_frame.pack(fill=tk.Y, expand=True)
+        self.email_list = EmailList(self.left_fm, select_func)
+        self.email_list.pack(fill=tk.Y, expand=True)
 
         self.display_frame = ttk.Labelframe(self, text='Email Viewer:')
 
@@ -176,10 +272,10 @@ class ScrollingFrameAndView(tk.Frame):
         
         self.email_info_sv.set(email_info)
 
-    def add_button(self, label, text_to_display, can_view, attach_ids=None,
-                   email_info={}):
-        self.scroll_frame.add_button(label, self.display, text_to_display,
-                                     can_view, attach_ids, email_info)
+    def show_emails(self, page_func, count):
+        '''Lists emails, see EmailList.show.'''
+        self.email_list.show(page_func, count)
+        self.update_cnt()
 
     def display(self, text, can_view, attach_ids, email_info):
         '''Displays email information.
@@ -207,11 +303,11 @@ class ScrollingFrameAndView(tk.Frame):
         self.display_txt.config(state='disabled')
 
     def reset_frame(self):
-        self.scroll_frame.reset_frame()
+        self.email_list.reset()
 
     def update_cnt(self):
         '''Updates the count of the amount of emails in frame'''
-        self.email_num.set(f'{len(self.scroll_frame.elements)} emails below:')
+        self.email_num.set(f'{self.email_list.count} emails below:')
 
     def highlight_searches(self, event=None):
         self.display_txt.tag_remove('found', '1.0', tk.END)
@@ -255,7 +351,16 @@ class ScrollingFrameAndView(tk.Frame):
 
         tk.messagebox.showinfo('Info', 'Opening attached file(s) with a default'
                                        ' system application.')
-        for filename in self.attach_ids:
+        if self.attach_func is not None:
+            self.attach_func(list(self.attach_ids), self.open_attached)
+        else:
+            self.open_attached(self.attach_ids)
+
+    def open_attached(self, paths):
+        '''Opens the attachment files at paths with the default system
+        application.
+        '''
+        for filename in paths:
             if sys.platform == 'linux2':
                 subprocess.call(["xdg-open", filename])
             else:
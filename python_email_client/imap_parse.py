@@ -0,0 +1,206 @@
+from email.message import Message
+import re
+
+ATOM_END = re.compile(rb'[\s()]')
+
+class Literal(bytes):
+    '''Bytes sent by the server as an IMAP literal ({size} strings).'''
+
+def _lex(line, tokens):
+    '''Splits one line of an IMAP response into tokens.'''
+    pos = 0
+    while pos < len(line):
+        char = line[pos:pos + 1]
+        if char.isspace():
+            pos += 1
+        elif char in (b'(', b')'):
+            tokens.append(char)
+            pos += 1
+        elif char == b'"':
+            end = pos + 1
+            value = bytearray()
+            while end < len(line) and line[end:end + 1] != b'"':
+                if line[end:end + 1] == b'\\':
+                    end += 1
+                value += line[end:end + 1]
+                end += 1
+            tokens.append(Literal(value))
+            pos = end + 1
+        else:
+            end = pos
+            while end < len(line):
+                if line[end:end + 1] == b'[':
+                    # Section specs like BODY[HEADER.FIELDS (TO)] are atoms
+                    end = line.index(b']', end)
+                elif ATOM_END.match(line, end):
+                    break
+                end += 1
+            tokens.append(line[pos:end])
+            pos = end
+
+def _tokens(data):
+    '''Returns the tokens of an imaplib response data list.'''
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            _lex(head[:head.rindex(b'{')], tokens)
+            tokens.append(Literal(literal))
+        elif item is not None:
+            _lex(item, tokens)
+    return tokens
+
+def _parse_list(tokens, pos):
+    '''Parses a parenthesized list starting after its "(" at pos.
+    Returns (list, position after the closing ")").
+    '''
+    items = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token == b'(' and not isinstance(token, Literal):
+            value, pos = _parse_list(tokens, pos + 1)
+            items.append(value)
+            continue
+        if token == b')' and not isinstance(token, Literal):
+            return items, pos + 1
+        if isinstance(token, Literal):
+            items.append(bytes(token))
+        elif token.upper() == b'NIL':
+            items.append(None)
+        else:
+            items.append(token)
+        pos += 1
+    return items, pos
+
+def parse_fetch(data):
+    '''
+    Parses the data of a FETCH or UID FETCH response.
+    Returns: list of dicts mapping each item name (str, eg. 'UID',
+             'ENVELOPE', 'BODY[1]') to its value. Numbers are returned as
+             bytes, lists as lists and NIL as None.
+    '''
+    tokens = _tokens(data)
+    responses = []
+    pos = 0
+    while pos < len(tokens):
+        if tokens[pos] != b'(' or isinstance(tokens[pos], Literal):
+            # Skips the sequence number and FETCH keyword
+            pos += 1
+            continue
+        items, pos = _parse_list(tokens, pos + 1)
+        response = {}
+        for index in range(0, len(items) - 1, 2):
+            name = items[index].decode('ascii').upper()
+            response[name.replace('.PEEK', '')] = items[index + 1]
+        responses.append(response)
+    return responses
+
+def _text(value):
+    if value is None:
+        return None
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+def _addresses(value):
+    '''Formats an ENVELOPE address list as a header value.'''
+    if value is None:
+        return None
+    addresses = []
+    for name, adl, mailbox, host in value:
+        if host is None:
+            # Start or end of an RFC 2822 group
+            continue
+        address = f'{_text(mailbox)}@{_text(host)}'
+        if name is not None:
+            address = f'{_text(name)} <{address}>'
+        addresses.append(address)
+    return ', '.join(addresses)
+
+def envelope_to_message(envelope):
+    '''
+    Returns an email.message.Message holding only the headers of an
+    ENVELOPE: Date, Subject, From, To, Cc, In-Reply-To and Message-ID.
+    '''
+    message = Message()
+    headers = (
+        ('Date', _text(envelope[0])),
+        ('Subject', _text(envelope[1])),
+        ('From', _addresses(envelope[2])),
+        ('To', _addresses(envelope[5])),
+        ('Cc', _addresses(envelope[6])),
+        ('In-Reply-To', _text(envelope[8])),
+        ('Message-ID', _text(envelope[9]))
+    )
+    for name, value in headers:
+        if value is not None:
+            message[name] = value
+    return message
+
+def _params(value):
+    '''Turns a body parameter list into a dict with lower case keys.'''
+    if not value:
+        return {}
+    return {_text(value[i]).lower(): _text(value[i + 1])
+            for i in range(0, len(value) - 1, 2)}
+
+def _structure_parts(body, section, parts):
+    if isinstance(body[0], list):
+        # Multipart: child bodies followed by the subtype
+        number = 1
+        for child in body:
+            if not isinstance(child, list):
+                break
+            _structure_parts(child, f'{section}.{number}'.lstrip('.'),
+                             parts)
+            number += 1
+        return
+
+    part_type = _text(body[0]).lower()
+    subtype = _text(body[1]).lower()
+    params = _params(body[2])
+    disposition_at = 8
+    if part_type == 'text':
+        disposition_at = 9
+    elif part_type == 'message' and subtype == 'rfc822':
+        disposition_at = 10
+    disposition = None
+    disposition_params = {}
+    if len(body) > disposition_at and isinstance(body[disposition_at], list):
+        disposition = _text(body[disposition_at][0]).lower()
+        disposition_params = _params(body[disposition_at][1])
+
+    parts.append({
+        'section': section or 'TEXT',
+        'type': part_type,
+        'subtype': subtype,
+        'charset': params.get('charset'),
+        'encoding': (_text(body[5]) or '7bit').lower(),
+        'size': int(body[6] or 0),
+        'disposition': disposition,
+        'filename': disposition_params.get('filename', params.get('name'))
+    })
+
+def structure_parts(bodystructure):
+    '''
+    Flattens a BODYSTRUCTURE into a list of dicts, one per leaf part,
+    with the keys 'section' (eg. '1.2', or 'TEXT' if the message is not
+    multipart), 'type', 'subtype', 'charset', 'encoding', 'size',
+    'disposition' and 'filename'.
+    '''
+    parts = []
+    _structure_parts(bodystructure, '', parts)
+    return parts
+
+def is_attachment(part):
+    '''Returns whether a structure_parts() part is an attachment.'''
+    return (part['filename'] is not None
+            and not part['filename'].isspace() and part['filename'] != '')
+
+def text_sections(parts):
+    '''Returns the sections of the text parts that are shown or searched.'''
+    return [part['section'] for part in parts
+            if part['type'] == 'text'
+            and part['subtype'] in ('plain', 'html')
+            and not is_attachment(part)]
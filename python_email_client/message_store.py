@@ -0,0 +1,501 @@
+from email import message_from_bytes
+from email.message import Message
+from email.parser import BytesHeaderParser
+from functools import partial
+from threading import Lock
+import mmap
+import os
+import re
+import zlib
+
+SEGMENT_SIZE = 64 * 1024 * 1024 # Bytes per segment file before a new one
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+HEADER_READ = 2048 # Bytes read at first when looking for the header end
+HEADER_LINE = re.compile(r'[\041-\071\073-\176]+:')
+TEXT_TYPES = ('text/plain', 'text/html')
+PART_KEYS = ('section', 'type', 'attachment', 'header_start', 'body_start',
+             'body_end')
+# Header blocks are parsed with headersonly, so no multipart boundary
+# patterns are compiled for them
+header_parser = BytesHeaderParser()
+
+def _parse_header(text):
+    # Returns the Message of the header lines of text and the index where
+    # they end, or None if the feed parser would read them differently.
+    # Header values are kept like the compat32 policy keeps them.
+    if any(char in text for char in '\x0b\x0c\x1c\x1d\x1e'):
+        # The feed parser only splits lines at \r\n, \r and \n
+        return None
+    message = Message()
+    name = None
+    end = 0
+    for line in text.splitlines(True):
+        end += len(line)
+        if name is not None:
+            if line[0] in ' \t':
+                value += line
+                continue
+            message.set_raw(name, value.rstrip('\r\n'))
+            name = None
+        if line in ('\r\n', '\n', '\r'):
+            return message, end
+        if HEADER_LINE.match(line) is None:
+            return None
+        name, value = line.split(':', 1)
+        value = value.lstrip(' \t')
+    if name is not None:
+        message.set_raw(name, value.rstrip('\r\n'))
+    return message, end
+
+def parse_header(data):
+    '''
+    Parses a header block (ending with its blank line) into an
+    email.message.Message like header_parser.parsebytes, without going
+    through the feed parser. Blocks the feed parser would read with
+    defects, or with a Unix From line, are left to header_parser.
+    '''
+    parsed = _parse_header(bytes(data).decode('ascii', 'surrogateescape'))
+    if parsed is None:
+        return header_parser.parsebytes(bytes(data))
+    return parsed[0]
+
+def _boundary_pattern(boundary):
+    return re.compile(
+        rb'(?:^|\r?\n)--' + re.escape(boundary.encode('ascii', 'replace'))
+        + rb'(--)?[ \t]*(?:\r?\n|$)',
+        re.M
+    )
+
+def _scan_parts(raw, start, end, section, parts):
+    found = HEADER_END.search(raw, start, end)
+    body_start = end if found is None else found.end()
+    header = header_parser.parsebytes(raw[start:body_start])
+    boundary = header.get_boundary()
+    if header.get_content_maintype() == 'multipart' and boundary:
+        number = 0
+        child_start = None
+        for delimiter in _boundary_pattern(boundary).finditer(raw, body_start,
+                                                              end):
+            if child_start is not None:
+                number += 1
+                _scan_parts(raw, child_start, delimiter.start(),
+                            f'{section}.{number}'.lstrip('.'), parts)
+            if delimiter.group(1) is not None:
+                return
+            child_start = delimiter.end()
+        if child_start is not None:
+            # Missing close delimiter, the last part runs to the end
+            _scan_parts(raw, child_start, end,
+                        f'{section}.{number + 1}'.lstrip('.'), parts)
+        return
+
+    filename = header.get_filename()
+    parts.append({
+        'section': section or 'TEXT',
+        'type': header.get_content_type(),
+        'attachment': int(filename is not None and not filename.isspace()
+                          and filename != ''),
+        'header_start': start,
+        'body_start': body_start,
+        'body_end': end
+    })
+
+def scan_parts(raw):
+    '''
+    Finds where each leaf MIME part of raw RFC822 bytes is, without
+    parsing the part bodies.
+    Returns: list of dicts with the keys 'section' (numbered like IMAP
+             BODYSTRUCTURE sections, 'TEXT' if the message is not
+             multipart), 'type' (eg. 'text/plain'), 'attachment',
+             'header_start', 'body_start' and 'body_end' (byte offsets
+             into raw).
+    '''
+    parts = []
+    _scan_parts(raw, 0, len(raw), '', parts)
+    return parts
+
+class _Record():
+    def __init__(self, data, compressed, position=None):
+        '''
+        The stored bytes of one message. Compressed records are only
+        decompressed as far as they are read.
+        Keyword arguments:
+        position -- the (segment, offset) the bytes were read from
+                    (Default None)
+        '''
+        self.data = data
+        self.compressed = compressed
+        self.position = position
+        self._decompressor = None
+        self._out = b''
+        self._tail = data
+
+    def read(self, end=None):
+        '''Returns the raw message bytes up to end (Default all of them).'''
+        if not self.compressed:
+            return self.data if end is None else self.data[:end]
+
+        # New bytes objects are joined instead of growing a bytearray, as
+        # views handed out earlier would keep it from being resized.
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+        while (not self._decompressor.eof and len(self._tail) > 0
+               and (end is None or len(self._out) < end)):
+            if end is None:
+                self._out += self._decompressor.decompress(self._tail)
+            else:
+                self._out += self._decompressor.decompress(
+                    self._tail, end - len(self._out))
+            self._tail = self._decompressor.unconsumed_tail
+        view = memoryview(self._out)
+        return view if end is None else view[:end]
+## End class _Record ##
+
+class LazyMessage():
+    def __init__(self, raw, parts=None):
+        '''
+        Stands in for the email.message.Message of raw RFC822 bytes,
+        which is only parsed when it is first used. Header lookups
+        (get, [], in) only parse the header block, and part() or
+        text_parts() only the parts asked for.
+        Keyword arguments:
+        raw -- the raw bytes (or a _Record) of the message
+        parts -- the scan_parts() list of the message, or a function
+                 returning it that is called when parts are first used
+                 (Default None, parts are found by parsing the whole
+                 message)
+        '''
+        self.record = raw if isinstance(raw, _Record) else _Record(raw, False)
+        self._parts = parts
+        self._headers = None
+        self._message = None
+
+    @property
+    def raw(self):
+        return self.record.read()
+
+    @property
+    def parts(self):
+        if callable(self._parts):
+            self._parts = self._parts()
+        return self._parts
+
+    def _full(self):
+        if self._message is None:
+            self._message = message_from_bytes(bytes(self.record.read()))
+            self._headers = None
+        return self._message
+
+    def _head(self):
+        if self._message is not None:
+            return self._message
+        if self._headers is None:
+            size = HEADER_READ
+            while True:
+                data = self.record.read(size)
+                end = HEADER_END.search(data)
+                if end is not None or len(data) < size:
+                    break
+                size *= 4
+            header = data if end is None else data[:end.end()]
+            self._headers = parse_header(header)
+        return self._headers
+
+    def _part_info(self, section):
+        for part in self.parts:
+            if part['section'] == section:
+                return part
+        raise KeyError(section)
+
+    def part_view(self, section):
+        '''
+        Returns the body of one leaf part (still transfer encoded) as a
+        memoryview into the stored message, without copying it.
+        Raises KeyError if the message has no such part.
+        '''
+        if self.parts is None:
+            raise KeyError(section)
+        part = self._part_info(section)
+        return self.record.read(part['body_end'])[part['body_start']:]
+
+    def part(self, section):
+        '''
+        Returns one leaf part as an email.message.Message, parsing only
+        that part. Raises KeyError if the message has no such part.
+        '''
+        if self.parts is None:
+            raise KeyError(section)
+        part = self._part_info(section)
+        data = bytes(self.record.read(part['body_end'])[part['header_start']:])
+        if part['type'].startswith(('multipart/', 'message/')):
+            return message_from_bytes(data)
+        # A leaf part is its headers and its body as the payload, which
+        # is what the feed parser makes of it
+        text = data.decode('ascii', 'surrogateescape')
+        parsed = _parse_header(text)
+        if parsed is None:
+            return message_from_bytes(data)
+        message, end = parsed
+        message.set_payload(text[end:])
+        return message
+
+    def text_parts(self):
+        '''
+        Returns the text/plain and text/html parts that are not
+        attachments, in message order.
+        '''
+        if self.parts is None or self._message is not None:
+            return [part for part in self._full().walk()
+                    if part.get_content_type() in TEXT_TYPES
+                    and not part.get_filename()]
+        return [self.part(part['section']) for part in self.parts
+                if part['type'] in TEXT_TYPES and not part['attachment']]
+
+    def get(self, name, failobj=None):
+        return self._head().get(name, failobj)
+
+    def __getitem__(self, name):
+        return self._head()[name]
+
+    def __contains__(self, name):
+        return name in self._head()
+
+    def __getattr__(self, name):
+        return getattr(self._full(), name)
+
+    def __reduce__(self):
+        # Pickles as the raw bytes instead of the parsed tree
+        return (LazyMessage, (bytes(self.record.read()), self.parts))
+## End class LazyMessage ##
+
+def text_parts(message):
+    '''
+    Returns the text/plain and text/html parts of an email that are not
+    attachments. Only those parts are parsed for a LazyMessage.
+    '''
+    if isinstance(message, LazyMessage):
+        return message.text_parts()
+    return [part for part in message.walk()
+            if part.get_content_type() in TEXT_TYPES
+            and not part.get_filename()]
+
+def raw_bytes(message):
+    '''
+    Returns the RFC822 bytes of an email to store: the bytes it was
+    downloaded as for a LazyMessage, otherwise the serialised message.
+    '''
+    if isinstance(message, LazyMessage):
+        return bytes(message.raw)
+    return message.as_bytes()
+
+class MessageStore():
+    def __init__(self, db, store_path, compress=True):
+        '''
+        Stores raw RFC822 messages appended to segment files, with the
+        position of each message kept in the messages_store table and
+        the position of its MIME parts in the message_parts table.
+        Segments are read through mmap.
+        Keyword arguments:
+        db -- the sqlite3 connection of manager.db. put() does not
+              commit, the caller does.
+        store_path -- the folder of the segment files
+        compress -- whether new messages are compressed with zlib.
+                    Uncompressed messages are read without copying.
+                    (Default True)
+        '''
+        self.db = db
+        self.store_path = store_path
+        self.compress = compress
+        self.lock = Lock()
+        self.maps = {}         # {segment: mmap}
+        if not os.path.exists(self.store_path):
+            os.makedirs(self.store_path)
+        last = self.db.execute(
+            'SELECT MAX(segment) FROM messages_store'
+        ).fetchone()[0]
+        self.segment = last or 1
+
+    def _segment_path(self, segment):
+        return os.path.join(self.store_path, f'{segment:05d}.seg')
+
+    def put(self, email_id, raw):
+        '''
+        Stores the raw bytes of an email, replacing any stored before.
+        Replaced messages stay in their segment file as unused bytes.
+        '''
+        self.put_many([(email_id, raw)])
+
+    def put_many(self, messages):
+        '''
+        Stores a list of (email_id, raw bytes) tuples like put(), with one
+        write per segment file and one executemany per table.
+        '''
+        records = []
+        parts = []
+        for email_id, raw in messages:
+            data = zlib.compress(raw) if self.compress else raw
+            records.append((email_id, data, len(raw)))
+            parts.extend((email_id, part) for part in scan_parts(raw))
+
+        rows = []
+        with self.lock:
+            out = None
+            try:
+                for email_id, data, size in records:
+                    path = self._segment_path(self.segment)
+                    if out is None:
+                        out = open(path, 'ab')
+                    if (out.tell() > 0
+                            and out.tell() + len(data) > SEGMENT_SIZE):
+                        out.close()
+                        self.segment += 1
+                        out = open(self._segment_path(self.segment), 'ab')
+                    rows.append((email_id, self.segment, out.tell(),
+                                 len(data), size, int(self.compress)))
+                    out.write(data)
+            finally:
+                if out is not None:
+                    out.close()
+
+        self.db.executemany(
+            'INSERT OR REPLACE INTO messages_store'
+            ' (email_id, segment, offset, length, size, compressed)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        self.db.executemany(
+            'DELETE FROM message_parts WHERE email_id = ?',
+            [(email_id,) for email_id, data, size in records]
+        )
+        self._insert_parts(parts)
+
+    def _insert_parts(self, parts):
+        # parts -- list of (email_id, scan_parts() dict) tuples
+        self.db.executemany(
+            'INSERT INTO message_parts (email_id, section, type, attachment,'
+            ' header_start, body_start, body_end)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(email_id, part['section'], part['type'], part['attachment'],
+              part['header_start'], part['body_start'], part['body_end'])
+             for email_id, part in parts]
+        )
+
+    def _map(self, segment, end):
+        '''Returns an mmap of a segment that is at least end bytes long.'''
+        # Maps are only replaced, never changed, so a cached map that is
+        # long enough is used without taking the lock
+        seg_map = self.maps.get(segment)
+        if seg_map is not None and len(seg_map) >= end:
+            return seg_map
+        with self.lock:
+            seg_map = self.maps.get(segment)
+            if seg_map is None or len(seg_map) < end:
+                # The segment grew since it was mapped. Views into the old
+                # map keep it open until they are released.
+                with open(self._segment_path(segment), 'rb') as f:
+                    if os.fstat(f.fileno()).st_size < end:
+                        raise ValueError('segment is cut short')
+                    seg_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[segment] = seg_map
+            return seg_map
+
+    def _record(self, email_id):
+        ref = self.db.execute(
+            'SELECT segment, offset, length, compressed FROM messages_store'
+            ' WHERE email_id = ?',
+            (email_id,)
+        ).fetchone()
+        if ref is None:
+            raise KeyError(email_id)
+        try:
+            seg_map = self._map(ref[0], ref[1] + ref[2])
+        except (FileNotFoundError, ValueError):
+            raise KeyError(email_id)
+        data = memoryview(seg_map)[ref[1]:ref[1] + ref[2]]
+        return _Record(data, bool(ref[3]), (ref[0], ref[1]))
+
+    def get_raw(self, email_id):
+        '''
+        Returns the raw RFC822 bytes of an email as a memoryview.
+        Raises KeyError if the email is not stored or its segment is
+        missing or cut short.
+        '''
+        return self._record(email_id).read()
+
+    def get_parts(self, email_id):
+        '''
+        Returns the scan_parts() list of a stored email. Emails stored
+        before parts were recorded are scanned once and recorded.
+        '''
+        rows = self.db.execute(
+            'SELECT section, type, attachment, header_start, body_start,'
+            ' body_end FROM message_parts WHERE email_id = ?'
+            ' ORDER BY header_start',
+            (email_id,)
+        ).fetchall()
+        if len(rows) > 0:
+            return [dict(zip(PART_KEYS, row)) for row in rows]
+        parts = scan_parts(bytes(self.get_raw(email_id)))
+        self._insert_parts([(email_id, part) for part in parts])
+        return parts
+
+    def _record_parts(self, email_id, record):
+        '''
+        Returns the scan_parts() list of record, a _Record of the email
+        read earlier. The email may have been stored again since, then
+        the parts of record are scanned instead of read.
+        '''
+        rows = self.db.execute(
+            'SELECT message_parts.section, message_parts.type,'
+            ' message_parts.attachment, message_parts.header_start,'
+            ' message_parts.body_start, message_parts.body_end'
+            ' FROM message_parts JOIN messages_store'
+            ' ON messages_store.email_id = message_parts.email_id'
+            ' WHERE message_parts.email_id = ? AND messages_store.segment = ?'
+            ' AND messages_store.offset = ?'
+            ' ORDER BY message_parts.header_start',
+            (email_id,) + record.position
+        ).fetchall()
+        if len(rows) > 0:
+            return [dict(zip(PART_KEYS, row)) for row in rows]
+        try:
+            if self._record(email_id).position == record.position:
+                return self.get_parts(email_id)
+        except KeyError:
+            pass
+        return scan_parts(bytes(record.read()))
+
+    def get(self, email_id):
+        '''
+        Returns an email as a LazyMessage. The position of its parts is
+        only read when a part is first used, so reading its headers takes
+        one query.
+        '''
+        record = self._record(email_id)
+        return LazyMessage(record,
+                           partial(self._record_parts, email_id, record))
+
+    def get_part(self, email_id, section):
+        '''
+        Returns the body of one part of an email (still transfer
+        encoded) as a memoryview. Raises KeyError if the email or part is
+        not stored.
+        '''
+        return self.get(email_id).part_view(section)
+
+    def close(self):
+        '''Unmaps all segments that are not used by a view anymore.'''
+        with self.lock:
+            for seg_map in self.maps.values():
+                try:
+                    seg_map.close()
+                except BufferError:
+                    pass
+            self.maps = {}
+
+    def __contains__(self, email_id):
+        return self.db.execute(
+            'SELECT 1 FROM messages_store WHERE email_id = ?',
+            (email_id,)
+        ).fetchone() is not None
+## End class MessageStore ##
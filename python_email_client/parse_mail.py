@@ -1,6 +1,8 @@
 from html.parser import HTMLParser
-from fuzzywuzzy import fuzz
+import re
 import utils
+from fuzzy import FuzzyIndex
+from message_store import text_parts
 
 class EmailHTMLParser(HTMLParser):
     '''Extends the HTMLParser class for our own email parser'''
@@ -20,7 +22,7 @@ html_parser = EmailHTMLParser()
 def parse_html(part, html_parser):
     if part is not None:
         try:
-            html_parser.feed(part.get_payload())
+            html_parser.feed(utils.decode_payload(part))
         except NotImplementedError:
             return ['']
     else:
@@ -40,41 +42,154 @@ def get_words(part, html_parser):
 def get_words_txt(part):
     txt = ''
     if part is not None:
-        txt = part.get_payload()
+        txt = utils.decode_payload(part)
     else:
         return []
     data = txt.strip().lower().split()
     data = [x.strip() for x in data if not x.isspace()]
     return data
 
-def specific_match(termList, matchList, allMatch=False):
-    for term in termList:
-        matches = 0
-        for search in matchList:
-            if term in search:
-                if allMatch:
-                    matches += 1
-                else:
-                    return True
-        if allMatch:
-            if matches == len(matchList):
-                return True
-    return False
+def get_text(message):
+    '''Returns the text of an email's text parts as one string, with the
+    tags of HTML parts removed. Used to fill the full text index.
+    '''
+    parser = EmailHTMLParser()
+    texts = []
+    for part in text_parts(message):
+        if part.get_content_subtype() == 'html':
+            try:
+                parser.feed(utils.decode_payload(part))
+            except NotImplementedError:
+                pass
+            texts.extend(x.strip() for x in parser.data if not x.isspace())
+            parser.clear_data()
+        else:
+            texts.append(utils.decode_payload(part))
+    return ' '.join(texts)
 
-def ratio_is_match(termList, matchList, allMatch=False):
-    for item in termList:
-        matches = 0
-        for search in matchList:
-            if len(item) >= len(search) - 1 and fuzz.WRatio(item, search) > 90:
-                if allMatch:
-                    matches += 1
-                else:
-                    return True
-        if allMatch:
-            if matches == len(matchList):
-                return True
+def render_message(message):
+    '''Returns what the email viewer shows of an email: a tuple of the
+    text of its first text part (or None), whether that part is HTML
+    (so it can be viewed in a browser) and a dict of its header values.
+    Only the text parts of the email are parsed.
+    '''
+    payload = None
+    can_view = False
+    for part in text_parts(message):
+        if part.get_content_maintype() == 'text':
+            payload = utils.parse_payload(part)
+            if part.get_content_subtype() == 'html':
+                can_view = True
+            break
 
-    return False
+    email_info = {
+        'Subject:': utils.parse_complete_sub(message.get('Subject')),
+        'Date sent:': message.get('Date'),
+        'To:': utils.parse_complete_sub(message.get('To')),
+        'From:': utils.parse_complete_sub(message.get('From'))}
+    return (payload, can_view, email_info)
+
+# Version of the words get_tokens returns. Words cached in manager.db by
+# another version are extracted again, so change it whenever the
+# extraction changes.
+TOKEN_VERSION = 2
+
+def get_tokens(message):
+    '''Returns the distinct words of an email's text parts, as searched
+    by process_message.
+    '''
+    global html_parser
+    words = []
+    for part in text_parts(message):
+        if part.get_content_subtype() == 'html':
+            words.extend(get_words(part, html_parser))
+        else:
+            words.extend(get_words_txt(part))
+    html_parser.clear_data()
+    return list(dict.fromkeys(words))
+
+class SearchQuery():
+    def __init__(self, search_list, all_match=False):
+        '''
+        Compiles search values into one regex that finds every value in a
+        text in a single pass. Values are found anywhere in the text,
+        also inside words ('mail' in 'gmail'). EmailDatabase.search_emails,
+        used when the full text index can be used, only matches the
+        start of words, so the two can find different emails.
+        Keyword arguments:
+        search_list -- a list or tuple of search values (as strings)
+        all_match -- whether all search values must be found for a match,
+                     instead of any of them. (Default False)
+        '''
+        self.terms = list(dict.fromkeys(term.lower() for term in search_list
+                                        if term != ''))
+        self.all_match = all_match
+        self.index = {term: number for number, term in enumerate(self.terms)}
+        # The lookahead tries every position, so values overlapping a
+        # longer match are found too. Values inside a longer value are
+        # found with it.
+        alternatives = sorted(self.terms, key=len, reverse=True)
+        self.pattern = re.compile(
+            '(?=(' + '|'.join(re.escape(term) for term in alternatives) + '))'
+        )
+        self.contains = [
+            frozenset(number for number, other in enumerate(self.terms)
+                      if other in term)
+            for term in self.terms
+        ]
+        self.fuzzy_hits = {}   # {word: frozenset of value numbers}
+
+    def is_done(self, found):
+        '''Returns whether the found search value numbers are a match.'''
+        if self.all_match:
+            return len(found) == len(self.terms)
+        return len(found) > 0
+
+    def scan(self, text, found=None):
+        '''
+        Adds the numbers of the search values found in text to the set
+        found, stopping once is_done(found).
+        Returns: found
+        '''
+        if found is None:
+            found = set()
+        if text is None or len(self.terms) == 0 or self.is_done(found):
+            return found
+        for hit in self.pattern.finditer(text.lower()):
+            found |= self.contains[self.index[hit.group(1)]]
+            if self.is_done(found):
+                break
+        return found
+
+    def fuzzy_scan(self, words, found=None):
+        '''
+        Like scan, but adds the numbers of the search values that fuzzy
+        match one of words (see fuzzy.is_match). The words not seen by an
+        earlier call are put in a FuzzyIndex, so a value is only compared
+        with the words that are candidates for it, like the fuzzy matches
+        of EmailDatabase.search_emails. Results are kept per word.
+        '''
+        if found is None:
+            found = set()
+        if len(self.terms) == 0 or self.is_done(found):
+            return found
+        new = [word for word in dict.fromkeys(words)
+               if word not in self.fuzzy_hits]
+        if len(new) > 0:
+            index = FuzzyIndex(new)
+            hits = {}
+            for number, term in enumerate(self.terms):
+                for word in index.match(term):
+                    hits.setdefault(word, set()).add(number)
+            no_hits = frozenset()
+            for word in new:
+                self.fuzzy_hits[word] = frozenset(hits.get(word, no_hits))
+        for word in words:
+            found |= self.fuzzy_hits[word]
+            if self.is_done(found):
+                break
+        return found
+## End class SearchQuery ##
 
 def process_message(message_info, subject, to_ln, from_ln, search_list,
                     all_match=False):
@@ -82,8 +197,9 @@ def process_message(message_info, subject, to_ln, from_ln, search_list,
     the message's data if it matches a term in the search list, or False
     otherwise.
     Keyword arguments:
-    message_info -- a tuple of form (email_msg, email_num integer). See
-                    README.md, Documentation.
+    message_info -- a tuple of form (email_msg, email_num integer), or
+                    (email_msg, email_num, words) with the get_tokens()
+                    words of the email. See README.md, Documentation.
     subject -- a boolean value (or integer) that represents whether or
                not to search in the subject line of an email.
     to_ln -- a boolean value representing whether or not to search in
@@ -91,39 +207,44 @@ def process_message(message_info, subject, to_ln, from_ln, search_list,
     from_ln -- a boolean value representing whether or not to search in
                the from line of an email.
     search_list -- a list or tuple of possible search values (as
-                   strings)
+                   strings), or a SearchQuery of them.
     all_match -- a boolean value representing whether or not to match
-                 all search values in search_list. (Default False)
+                 all search values in search_list. Values may be found in
+                 different fields. Ignored if search_list is a
+                 SearchQuery. (Default False)
     '''
-    global html_parser
     message = message_info[0]
     num = message_info[1]
     important_keys = {
         'Date': utils.email_to_datetime(message.get('Date')),
         'To': message.get('To'),
         'From': message.get('From'),
-        'Subject': message.get('Subject')
+        'Subject': message.get('Subject'),
+        'Key': utils.message_key(message)
     }
-    if subject and specific_match([important_keys['Subject'].lower()],
-                                  search_list, all_match):
-        return important_keys
-    if to_ln and specific_match([important_keys['To'].lower()],
-                                search_list, all_match):
-        return important_keys
-    if from_ln and specific_match([important_keys['From'].lower()],
-                                  search_list, all_match):
+    query = search_list
+    if not isinstance(query, SearchQuery):
+        query = SearchQuery(search_list, all_match)
+    if len(message_info) > 2 and message_info[2] is not None:
+        words = message_info[2]
+    else:
+        words = get_tokens(message)
+    if match_fields(important_keys, words, subject, to_ln, from_ln, query):
         return important_keys
-    
-    for part in message.walk():
-        if part.get_content_maintype() == 'text':
-            if part.get_content_subtype() == 'html':
-                if ratio_is_match(get_words(part, html_parser),
-                                  search_list, all_match):
-                    return important_keys
-            elif part.get_content_subtype() == 'plain':
-                if ratio_is_match(get_words_txt(part),
-                                  search_list, all_match):
-                    return important_keys
+    return False
 
-    html_parser.clear_data()
-    return False
\ No newline at end of file
+def match_fields(important_keys, words, subject, to_ln, from_ln, query):
+    '''Returns whether an email matches a SearchQuery, given the header
+    values of process_message as important_keys and the get_tokens()
+    words of the email. See process_message for the other arguments.
+    '''
+    found = set()
+    for searched, name in ((subject, 'Subject'), (to_ln, 'To'),
+                           (from_ln, 'From')):
+        if searched:
+            query.scan(important_keys[name], found)
+    query.scan(' '.join(words), found)
+
+    # Values that are not in the text may still fuzzy match one of its words
+    query.fuzzy_scan(words, found)
+    return query.is_done(found)
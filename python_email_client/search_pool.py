@@ -0,0 +1,145 @@
+from array import array
+from functools import partial
+from multiprocessing import Pool
+import os
+import sqlite3
+
+# Own modules
+import parse_mail
+from message_store import MessageStore
+
+# State of each worker process, set up by _init_worker
+_db = None
+_store = None
+_words = {}            # {id: word} of the words table
+_query = (None, None)  # (search number, SearchQuery) of the last task
+
+def _init_worker(database_path, store_path):
+    global _db, _store
+    _db = sqlite3.connect(database_path,
+                          detect_types=sqlite3.PARSE_DECLTYPES)
+    _db.row_factory = sqlite3.Row
+    _store = MessageStore(_db, store_path)
+
+def _load_words(word_ids):
+    if any(word_id not in _words for word_id in word_ids):
+        # Words were added since the worker started
+        _words.update(_db.execute('SELECT id, word FROM words').fetchall())
+    return [_words[word_id] for word_id in word_ids]
+
+def _search_chunk(email_ids, search_num, query, subject, to_ln, from_ln):
+    '''
+    Returns the process_message results of the emails with the ids
+    email_ids. Runs in a worker process, which reads the emails itself.
+    '''
+    global _query
+    # Keeps one SearchQuery per search, so its fuzzy matches are reused
+    # by all the chunks this worker gets
+    if _query[0] != search_num:
+        _query = (search_num, query)
+    query = _query[1]
+
+    marks = ','.join('?' * len(email_ids))
+    cached = {}
+    for email_id, word_ids in _db.execute(
+            'SELECT email_id, word_ids FROM email_words'
+            f' WHERE version = ? AND email_id IN ({marks})',
+            [parse_mail.TOKEN_VERSION] + list(email_ids)):
+        ids = array('I')
+        ids.frombytes(word_ids)
+        cached[email_id] = ids
+
+    results = []
+    for row in _db.execute(
+            'SELECT id, subject, created, to_address, from_address,'
+            f' message_key FROM emails WHERE id IN ({marks})',
+            email_ids):
+        if row['id'] in cached:
+            words = _load_words(cached[row['id']])
+        else:
+            try:
+                words = parse_mail.get_tokens(_store.get(row['id']))
+            except KeyError:
+                continue
+        important_keys = {
+            'id': row['id'],
+            'Date': row['created'],
+            'To': row['to_address'],
+            'From': row['from_address'],
+            'Subject': row['subject'],
+            'Key': row['message_key']
+        }
+        if parse_mail.match_fields(important_keys, words, subject, to_ln,
+                                   from_ln, query):
+            results.append(important_keys)
+    return results
+
+class SearchPool():
+    def __init__(self, database_path, store_path, processes=None):
+        '''
+        A process pool kept between searches, whose workers read the
+        emails they search from manager.db and the message store by id.
+        Keyword arguments:
+        database_path -- the path of manager.db
+        store_path -- the folder of the message store
+        processes -- the amount of worker processes
+                     (Default os.cpu_count())
+        '''
+        self.database_path = database_path
+        self.store_path = store_path
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None
+        self.search_num = 0
+
+    def chunk_size(self, amount):
+        '''
+        Returns the amount of ids sent per task: about four tasks per
+        worker, so workers stay busy without a task per email.
+        '''
+        return max(50, min(2000, amount // (self.processes * 4) + 1))
+
+    def search(self, email_ids, subject, to_ln, from_ln, query,
+               bar_func=None, cancel=None):
+        '''
+        Searches emails like parse_mail.process_message.
+        Keyword arguments:
+        email_ids -- the ids of the emails to search
+        subject, to_ln, from_ln -- see parse_mail.process_message
+        query -- a parse_mail.SearchQuery
+        bar_func -- An Application() class's add_bar function
+        cancel -- an event_bus.CancelToken. The workers are stopped and
+                  event_bus.Cancelled is raised once it is cancelled.
+                  (Default None)
+        Returns: list of process_message results of matching emails,
+                 with their 'id' added
+        '''
+        if len(email_ids) == 0:
+            return []
+        if self.pool is None:
+            self.pool = Pool(self.processes, initializer=_init_worker,
+                             initargs=(self.database_path, self.store_path))
+        self.search_num += 1
+        size = self.chunk_size(len(email_ids))
+        chunks = [email_ids[index:index + size]
+                  for index in range(0, len(email_ids), size)]
+        search_chunk = partial(_search_chunk, search_num=self.search_num,
+                               query=query, subject=subject, to_ln=to_ln,
+                               from_ln=from_ln)
+        results = []
+        for index, found in enumerate(self.pool.imap(search_chunk, chunks)):
+            if cancel is not None and cancel.cancelled:
+                # The workers would still search the remaining chunks
+                self.pool.terminate()
+                self.pool = None
+                cancel.check()
+            results.extend(found)
+            if bar_func is not None:
+                bar_func(100 * len(chunks[index]) / len(email_ids))
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+## End class SearchPool ##
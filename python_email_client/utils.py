@@ -1,12 +1,13 @@
 from datetime import datetime
 import time
 from email.header import Header, decode_header, make_header
-import quopri
 import email.utils
+import hashlib
 from os import getenv
 from os import path
 from dotenv import load_dotenv
 import platform
+import re
 
 def askForBool(message):
     subject = ''
@@ -29,6 +30,29 @@ def email_to_datetime(email_date):
         time.mktime(email.utils.parsedate(email_date))
     )
 
+def header_key(subject, date, to_line, from_line):
+    """
+    Returns the identity key of an email without a Message-ID: a hash
+    of its subject, date (datetime.datetime obj), to and from lines.
+    """
+    values = '\0'.join((subject, str(date), to_line, from_line))
+    return 'sha1:' + hashlib.sha1(values.encode('utf-8', 'replace')).hexdigest()
+
+def message_key(message):
+    """
+    Returns the identity key of an email.message.Message, stored in the
+    message_key column of the emails table: its Message-ID, or
+    header_key() of its headers if it has none.
+    """
+    message_id = message.get('Message-ID')
+    if message_id is not None and str(message_id).strip() != '':
+        return 'mid:' + str(message_id).strip()
+    subject = message.get('Subject')
+    if subject is None:
+        subject = 'No subject provided...'
+    return header_key(str(subject), email_to_datetime(message.get('Date')),
+                      str(message.get('To')), str(message.get('From')))
+
 def parse_sub(subject):
     decoded = make_header(decode_header(subject))
     if len(str(decoded)) <= 40:
@@ -41,20 +65,38 @@ def parse_complete_sub(subject):
     decoded = make_header(decode_header(subject))
     return str(decoded).encode(encoding='ascii', errors='ignore')
 
-def parse_payload(payload):
-    decoded = payload.encode(encoding='ascii', errors='ignore').decode('utf-8')
-    decoded = quopri.decodestring(decoded).decode(encoding='utf-8', errors='ignore')
-    count = 0
-    terms = [] #[(search_term, value)]
-    while count < len(decoded):
-        if ord(decoded[count]) > 65535:
-            terms.append(decoded[count])
-        count += 1
+# Characters outside the Basic Multilingual Plane, which Tk cannot show
+ASTRAL_CHARS = re.compile('[\U00010000-\U0010FFFF]')
 
-    for t in terms:
-        decoded = decoded.replace(t, ''.join(('{U', str(ord(t)), '}')))
+def _escape_astral(match):
+    return ''.join(('{U', str(ord(match.group())), '}'))
 
-    return decoded
+def decode_payload(part):
+    """
+    Returns the text of an email.message.Message part, decoded by its
+    Content-Transfer-Encoding (base64, quoted-printable...) and then its
+    charset. Undecodable bytes and unknown charsets are decoded as
+    UTF-8 with replacement characters.
+    """
+    payload = part.get_payload(decode=True)
+    if payload is None:
+        return ''
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8',
+                              errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+def parse_payload(part):
+    """
+    Returns the text of an email.message.Message part to be shown by
+    Tkinter: decode_payload() of it, with every character Tk cannot show
+    replaced by '{U<codepoint>}' (eg. '{U128512}').
+    """
+    decoded = decode_payload(part)
+    if decoded.isascii():
+        return decoded
+    return ASTRAL_CHARS.sub(_escape_astral, decoded)
 
 def get_config():
     load_dotenv()
@@ -0,0 +1,76 @@
+'''
+Tests that the words searched without the full text index are read from
+decoded text parts.
+
+Usage: python -m unittest discover tests
+'''
+from email.message import EmailMessage
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'python_email_client'))
+
+import fuzzy
+import parse_mail
+
+def make_message(text, subtype, cte):
+    message = EmailMessage()
+    message['Subject'] = 'Test'
+    message['Date'] = 'Mon, 20 Nov 1995 19:12:08 -0500'
+    message.set_content(text, subtype=subtype, charset='utf-8', cte=cte)
+    return message
+
+class TestGetTokens(unittest.TestCase):
+    def test_base64_html(self):
+        message = make_message('<p>Hello zebrafish world</p>', 'html',
+                               'base64')
+        tokens = parse_mail.get_tokens(message)
+        self.assertIn('zebrafish', tokens)
+        self.assertIn('hello', tokens)
+
+    def test_quoted_printable_text(self):
+        message = make_message('caf\xe9 zebrafish = 3 ' + 'x' * 80, 'plain',
+                               'quoted-printable')
+        tokens = parse_mail.get_tokens(message)
+        self.assertIn('zebrafish', tokens)
+        self.assertIn('caf\xe9', tokens)
+        self.assertIn('x' * 80, tokens)
+
+    def test_matches_full_text(self):
+        message = make_message('<b>Zebrafish</b> tank', 'html', 'base64')
+        self.assertTrue(parse_mail.process_message(
+            (message, b'1', parse_mail.get_tokens(message)), False, False,
+            False, ['zebrafish']))
+## End class TestGetTokens ##
+
+class TestFuzzyScan(unittest.TestCase):
+    words = ['zebrafish', 'zebrafsh', 'zebra', 'fish', 'tank', 'tanks',
+             'aquarium', 'aquarim', 'zebrafishes', 'zebrafishtank', 'x']
+
+    def compare_all(self, terms):
+        '''fuzzy_scan of SearchQuery(terms) and the numbers of the terms
+        that fuzzy match a word when comparing every word with every term.
+        '''
+        query = parse_mail.SearchQuery(terms, all_match=True)
+        expected = {number for number, term in enumerate(query.terms)
+                    for word in self.words if fuzzy.is_match(word, term)}
+        return query.fuzzy_scan(self.words), expected
+
+    def test_matches_comparing_every_word(self):
+        for terms in (['zebrafish'], ['aquarium', 'tank'], ['zebra', 'fis'],
+                      ['nothing'], ['zebrafishtank', 'aquariums']):
+            found, expected = self.compare_all(terms)
+            self.assertEqual(found, expected, terms)
+
+    def test_misspelt_word(self):
+        query = parse_mail.SearchQuery(['aquarium'])
+        self.assertEqual(query.fuzzy_scan(['the', 'aquarim']), {0})
+        # Results of words seen before are kept
+        self.assertEqual(query.fuzzy_hits['aquarim'], frozenset({0}))
+        self.assertEqual(query.fuzzy_scan(['aquarim']), {0})
+## End class TestFuzzyScan ##
+
+if __name__ == '__main__':
+    unittest.main()